@@ -0,0 +1,206 @@
+"""
+Benchmarks the generate path of every diffusers wrapper on CPU with tiny randomly initialized checkpoints (see
+tiny_pipelines.py), so it needs no GPU, no downloads and no network. The numbers measure the wrapper code around the
+pipelines (text encoding and caching, batching, conversion and saving), not the real models.
+
+Each model runs in a fresh process, which reports:
+    - load_seconds: the time taken by the wrapper's __init__.
+    - latency: p50/p90/p99/mean seconds of single-prompt generate calls, after one warmup call.
+    - prompts_per_sec: the throughput of single-prompt calls at the median latency, and batch_prompts_per_sec that of
+      the median of batch_repeats generate_batch runs. Medians keep the comparison against a baseline stable.
+    - peak_rss_gb: the peak resident memory of the process.
+
+With --accelerate, the wrappers are loaded with accelerate=True (torch.compile, channels_last, fused attention) and
+warmed up for the single-prompt and batch shapes before timing, so load_seconds includes the compilation.
+
+With --preset, the wrappers run with the step count, scheduler and guidance of that preset (see models.presets)
+instead of the few steps used by default, to compare the latency of the presets.
+
+Usage:
+    python benchmarks/bench_models.py --output results.json
+    python benchmarks/bench_models.py --baseline results.json   # exits with status 1 on a throughput regression
+    python benchmarks/bench_models.py --accelerate --baseline results.json   # speedup of the compiled path over eager
+    python benchmarks/bench_models.py --preset draft --output draft.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from models.presets import PRESET_NAMES
+
+MODELS = ["SDXL_Base", "SDXL_Turbo", "SDXL_2_1", "DeepFloyd_I_XL_v1", "ZeroScope"]
+
+def model_arguments(model_name, accelerate=False, preset=None):
+    """ Returns the (__init__ kwargs, generate kwargs) used to run model_name on CPU with its tiny checkpoint. """
+    import torch
+    from models.embedding_cache import EmbeddingCache
+
+    cache = {"embedding_cache": EmbeddingCache(persist=False)} # every prompt is new, so nothing is reused across runs
+    fast = {"accelerate": True, "warmup_batch_sizes": ()} if accelerate else {} # warmed up by run_model with the benchmark shapes
+    if preset is not None: # the preset's step count replaces the few steps used by default
+        fast["preset"] = preset
+        steps = {}
+    else:
+        steps = {"num_inference_steps": 4}
+    return {
+        "SDXL_Base": (dict(cache, **fast), steps),
+        "SDXL_Turbo": (dict(cache, **fast), {}),
+        "SDXL_2_1": (dict(cache, **fast, torch_dtype=torch.float32), steps),
+        # Both load fully on CPU with a budget, instead of the model CPU offload they default to on CPU
+        "DeepFloyd_I_XL_v1": (dict(cache, **fast, memory_budget=64), {}),
+        "ZeroScope": (dict(fast, torch_dtype=torch.float32, memory_budget=64), dict(steps, height=32, width=32)),
+    }[model_name]
+
+def percentile(values, q):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q / 100 * (len(values) - 1))))
+    return values[index]
+
+def run_model(model_name, iterations, batch_size, output_folder_path, batch_repeats=3, accelerate=False, preset=None):
+    """ Benchmarks model_name in this process, with the tiny checkpoints in the working directory. """
+    from models import memory
+    if model_name == "ZeroScope":
+        from models.t2video import get_model_class
+        extension = "mp4"
+    else:
+        from models.t2image import get_model_class
+        extension = "png"
+    init_kwargs, generate_kwargs = model_arguments(model_name, accelerate, preset)
+
+    start = time.perf_counter()
+    model = get_model_class(model_name)(device="cpu", **init_kwargs)
+    if accelerate:
+        model.warmup(sorted({1, batch_size}), **generate_kwargs)
+    load_seconds = time.perf_counter() - start
+
+    def prompt(i):
+        return f"a photo of object number {i} on a table"
+
+    model.generate(prompt(-1), folder_path=output_folder_path, filename=f"warmup.{extension}", **generate_kwargs)
+
+    latencies = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        model.generate(prompt(i), folder_path=output_folder_path, filename=f"{i}.{extension}", **generate_kwargs)
+        latencies.append(time.perf_counter() - start)
+
+    batch_seconds = []
+    for repeat in range(batch_repeats):
+        prompts = [prompt((repeat + 1) * iterations + i) for i in range(iterations)]
+        start = time.perf_counter()
+        model.generate_batch(prompts, [f"batch-{repeat}-{i}.{extension}" for i in range(iterations)],
+                             folder_path=output_folder_path, batch_size=batch_size, **generate_kwargs)
+        batch_seconds.append(time.perf_counter() - start)
+
+    return {
+        "load_seconds": load_seconds,
+        "latency": {
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+            "mean": statistics.mean(latencies),
+        },
+        "prompts_per_sec": 1 / statistics.median(latencies),
+        "batch_prompts_per_sec": iterations / statistics.median(batch_seconds),
+        "peak_rss_gb": memory.peak_memory().get("rss"),
+    }
+
+def run_all(models, iterations, batch_size, checkpoints_path, accelerate=False, preset=None):
+    """ Runs every model in its own process and returns the results by model name. """
+    from benchmarks.tiny_pipelines import build_checkpoints
+
+    build_checkpoints(checkpoints_path, models)
+    env = dict(os.environ, HF_HUB_OFFLINE="1", PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.getenv("PYTHONPATH")])))
+    results = {}
+    for model_name in models:
+        print(f"Benchmarking {model_name}...")
+        with tempfile.TemporaryDirectory() as output_folder_path:
+            process = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", model_name,
+                                      "--iterations", str(iterations), "--batch-size", str(batch_size),
+                                      "--output", output_folder_path] + (["--accelerate"] if accelerate else [])
+                                     + (["--preset", preset] if preset else []),
+                                     cwd=checkpoints_path, env=env, capture_output=True, text=True)
+        if process.returncode != 0:
+            print(process.stderr[-2000:])
+            results[model_name] = {"error": f"exit code {process.returncode}"}
+            continue
+        results[model_name] = json.loads(process.stdout.strip().splitlines()[-1])
+    return results
+
+def environment():
+    import diffusers
+    import torch
+    return {"python": platform.python_version(), "torch": torch.__version__, "diffusers": diffusers.__version__,
+            "machine": platform.machine(), "cpu_count": os.cpu_count(), "torch_threads": torch.get_num_threads()}
+
+def compare(results, baseline, tolerance):
+    """ Prints the throughput of results against baseline. Return: the names of the models that regressed. """
+    regressions = []
+    print(f"{'model':<20}{'prompts/s':>12}{'baseline':>12}{'change':>10}")
+    for model_name, result in results.items():
+        reference = baseline.get(model_name)
+        if "error" in result or reference is None or "error" in reference:
+            continue
+        for key in ("prompts_per_sec", "batch_prompts_per_sec"):
+            change = result[key] / reference[key] - 1
+            label = model_name if key == "prompts_per_sec" else "  batched"
+            print(f"{label:<20}{result[key]:>12.2f}{reference[key]:>12.2f}{change:>+10.1%}")
+            if change < -tolerance:
+                regressions.append(f"{model_name} ({key})")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--models", nargs="+", default=MODELS, choices=MODELS)
+    parser.add_argument("--iterations", type=int, default=8, help="Number of timed prompts per model (and per batch run).")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--checkpoints", default=os.path.join(tempfile.gettempdir(), "t2visual-gen-tiny-checkpoints"),
+                        help="Folder where the tiny checkpoints are built (once) and loaded from.")
+    parser.add_argument("--output", help="Path to write the results as JSON (the output folder with --worker).")
+    parser.add_argument("--baseline", help="Results JSON of an earlier run to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative throughput drop against the baseline.")
+    parser.add_argument("--accelerate", action="store_true", help="Load the wrappers with accelerate=True (torch.compile).")
+    parser.add_argument("--preset", choices=PRESET_NAMES, help="Run the wrappers with this latency/quality preset.")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker: # child process: benchmark one model and print its results as the last line
+        result = run_model(args.worker, args.iterations, args.batch_size, args.output, accelerate=args.accelerate,
+                           preset=args.preset)
+        print(json.dumps(result))
+        return
+
+    results = run_all(args.models, args.iterations, args.batch_size, args.checkpoints, accelerate=args.accelerate,
+                      preset=args.preset)
+    for model_name, result in results.items():
+        if "error" in result:
+            print(f"{model_name:<20} failed: {result['error']}")
+        else:
+            print(f"{model_name:<20} p50 {result['latency']['p50'] * 1000:8.1f} ms  {result['prompts_per_sec']:6.2f} prompts/s"
+                  f"  batched {result['batch_prompts_per_sec']:6.2f} prompts/s  peak RSS {result['peak_rss_gb']:.2f} GB")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"environment": environment(), "accelerate": args.accelerate, "preset": args.preset, "models": results},
+                      f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["models"]
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("Throughput regressions:", ", ".join(regressions))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
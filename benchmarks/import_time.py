@@ -0,0 +1,64 @@
+"""
+Measures, in a fresh interpreter per model, how long resolving each model class takes and whether it loads the
+heavy backends (torch, diffusers, transformers, modelscope).
+
+Usage: python benchmarks/import_time.py [--repeat N] [--output results.json]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["torch", "diffusers", "transformers", "modelscope"]
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+from {package} import get_model_class
+try:
+    get_model_class({model_name!r})
+    error = None
+except Exception as e: # e.g. a backend that is not installed
+    error = repr(e)
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "error": error, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+def probe(package, model_name):
+    """ Resolves model_name from package in a new interpreter and returns its timing and loaded backends. """
+    code = _PROBE.format(package=package, model_name=model_name, heavy=HEAVY_MODULES)
+    output = subprocess.run([sys.executable, "-c", code], cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3, help="Number of fresh interpreters per model.")
+    parser.add_argument("--output", help="Optional path to write the results as JSON.")
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO_ROOT)
+    from models import t2image, t2video
+
+    results = {}
+    for package, module in (("models.t2image", t2image), ("models.t2video", t2video)):
+        for model_name in module.ALL_MODEL_NAMES:
+            runs = [probe(package, model_name) for _ in range(args.repeat)]
+            results[model_name] = {
+                "median_seconds": statistics.median(run["seconds"] for run in runs),
+                "loaded": runs[-1]["loaded"],
+                "error": runs[-1]["error"],
+            }
+            result = results[model_name]
+            print(f"{model_name:<20} {result['median_seconds']:7.3f}s  loaded: {', '.join(result['loaded']) or '-'}"
+                  + (f"  ({result['error']})" if result["error"] else ""))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == '__main__':
+    main()
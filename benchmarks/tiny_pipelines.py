@@ -0,0 +1,171 @@
+"""
+Builds tiny randomly initialized checkpoints for every diffusers wrapper, with the same pipeline classes the wrappers
+load, so their generate path can be benchmarked on CPU without downloading weights or touching the network.
+
+Checkpoints are saved under a root folder using the Hugging Face model ids as relative paths (e.g.
+'<root>/stabilityai/sdxl-turbo'). Running a wrapper with the root as working directory makes its from_pretrained(model_id)
+call load the local tiny checkpoint instead of the hub one.
+"""
+
+import json
+import os
+import tempfile
+
+import torch
+
+# Wrapper name -> [(model id, variant), ...] of the checkpoints it loads
+CHECKPOINTS = {
+    "SDXL_Base": [("stabilityai/stable-diffusion-xl-base-1.0", "fp16")],
+    "SDXL_Turbo": [("stabilityai/sdxl-turbo", "fp16")],
+    "SDXL_2_1": [("stabilityai/stable-diffusion-2-1", None)],
+    "DeepFloyd_I_XL_v1": [("DeepFloyd/IF-I-XL-v1.0", "fp16"), ("DeepFloyd/IF-II-L-v1.0", "fp16")],
+    "ZeroScope": [("cerspense/zeroscope_v2_576w", None)],
+}
+
+TEXT_HIDDEN_SIZE = 32
+
+def _bytes_to_unicode():
+    """ The byte -> printable character table of byte-level BPE tokenizers. """
+    codes = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    chars = codes[:]
+    n = 0
+    for code in range(256):
+        if code not in codes:
+            codes.append(code)
+            chars.append(256 + n)
+            n += 1
+    return dict(zip(codes, map(chr, chars)))
+
+def clip_tokenizer():
+    """ Returns a character-level CLIP tokenizer (no merges) and its vocabulary size. """
+    from transformers import CLIPTokenizer
+
+    folder_path = tempfile.mkdtemp()
+    chars = list(_bytes_to_unicode().values())
+    vocab = {token: i for i, token in enumerate(chars + [char + "</w>" for char in chars] + ["<|startoftext|>", "<|endoftext|>"])}
+    with open(os.path.join(folder_path, "vocab.json"), "w") as f:
+        json.dump(vocab, f)
+    with open(os.path.join(folder_path, "merges.txt"), "w") as f:
+        f.write("#version: 0.2\n")
+    return CLIPTokenizer(os.path.join(folder_path, "vocab.json"), os.path.join(folder_path, "merges.txt"), model_max_length=77), len(vocab)
+
+def t5_tokenizer():
+    """ Returns a character-level unigram T5 tokenizer and its vocabulary size. """
+    from transformers import T5Tokenizer
+
+    letters = [chr(c) for c in range(ord("a"), ord("z") + 1)]
+    pieces = ["<pad>", "</s>", "<unk>"] + ["\u2581" + letter for letter in letters] + letters
+    return T5Tokenizer(vocab=[(piece, -1.0) for piece in pieces], extra_ids=0, model_max_length=77), len(pieces)
+
+def clip_text_config(vocab_size, **kwargs):
+    from transformers import CLIPTextConfig
+    return CLIPTextConfig(bos_token_id=vocab_size - 2, eos_token_id=vocab_size - 1, hidden_size=TEXT_HIDDEN_SIZE,
+                          intermediate_size=37, layer_norm_eps=1e-05, num_attention_heads=4, num_hidden_layers=2,
+                          pad_token_id=1, vocab_size=vocab_size, hidden_act="gelu", projection_dim=TEXT_HIDDEN_SIZE, **kwargs)
+
+def tiny_vae(**kwargs):
+    from diffusers import AutoencoderKL
+    return AutoencoderKL(block_out_channels=[32, 64], in_channels=3, out_channels=3, latent_channels=4, norm_num_groups=32,
+                         down_block_types=["DownEncoderBlock2D"] * 2, up_block_types=["UpDecoderBlock2D"] * 2, **kwargs)
+
+def tiny_sdxl():
+    """ StableDiffusionXLPipeline, as loaded by SDXL_Base (DiffusionPipeline) and SDXL_Turbo (AutoPipelineForText2Image). """
+    from diffusers import EulerDiscreteScheduler, StableDiffusionXLPipeline, UNet2DConditionModel
+    from transformers import CLIPTextModel, CLIPTextModelWithProjection
+
+    tokenizer, vocab_size = clip_tokenizer()
+    unet = UNet2DConditionModel(
+        sample_size=32, in_channels=4, out_channels=4, layers_per_block=1, block_out_channels=(32, 64),
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"), up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        attention_head_dim=(2, 4), use_linear_projection=True, transformer_layers_per_block=(1, 1),
+        addition_embed_type="text_time", addition_time_embed_dim=8, projection_class_embeddings_input_dim=80,
+        cross_attention_dim=2 * TEXT_HIDDEN_SIZE, norm_num_groups=32,
+    )
+    scheduler = EulerDiscreteScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear",
+                                       steps_offset=1, timestep_spacing="leading")
+    return StableDiffusionXLPipeline(vae=tiny_vae(sample_size=128), text_encoder=CLIPTextModel(clip_text_config(vocab_size)),
+                                     tokenizer=tokenizer, text_encoder_2=CLIPTextModelWithProjection(clip_text_config(vocab_size)),
+                                     tokenizer_2=tokenizer, unet=unet, scheduler=scheduler)
+
+def tiny_sd():
+    """ StableDiffusionPipeline, as loaded by SDXL_2_1. """
+    from diffusers import DDIMScheduler, StableDiffusionPipeline, UNet2DConditionModel
+    from transformers import CLIPTextModel
+
+    tokenizer, vocab_size = clip_tokenizer()
+    unet = UNet2DConditionModel(
+        sample_size=32, in_channels=4, out_channels=4, layers_per_block=1, block_out_channels=(32, 64),
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"), up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim=TEXT_HIDDEN_SIZE, attention_head_dim=4, norm_num_groups=32,
+    )
+    scheduler = DDIMScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear", clip_sample=False, steps_offset=1)
+    return StableDiffusionPipeline(vae=tiny_vae(sample_size=128), text_encoder=CLIPTextModel(clip_text_config(vocab_size)),
+                                   tokenizer=tokenizer, unet=unet, scheduler=scheduler, safety_checker=None,
+                                   feature_extractor=None, requires_safety_checker=False)
+
+def _if_unet(sample_size, in_channels, **kwargs):
+    from diffusers import UNet2DConditionModel
+    return UNet2DConditionModel(
+        sample_size=sample_size, in_channels=in_channels, out_channels=6, layers_per_block=1, block_out_channels=(32, 64),
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"), up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim=TEXT_HIDDEN_SIZE, attention_head_dim=4, norm_num_groups=32, **kwargs,
+    )
+
+def _if_scheduler():
+    from diffusers import DDPMScheduler
+    return DDPMScheduler(beta_schedule="squaredcos_cap_v2", variance_type="learned_range", thresholding=True,
+                         dynamic_thresholding_ratio=0.95, sample_max_value=1.0)
+
+def tiny_if_stages():
+    """ IFPipeline and IFSuperResolutionPipeline, the two stages loaded by DeepFloyd_I_XL_v1. """
+    from diffusers import DDPMScheduler, IFPipeline, IFSuperResolutionPipeline
+    from transformers import T5Config, T5EncoderModel
+
+    tokenizer, vocab_size = t5_tokenizer()
+    text_encoder = T5EncoderModel(T5Config(vocab_size=vocab_size, d_model=TEXT_HIDDEN_SIZE, d_kv=8, d_ff=37, num_layers=2,
+                                           num_heads=4, pad_token_id=0, eos_token_id=1, decoder_start_token_id=0))
+    stage_1 = IFPipeline(tokenizer=tokenizer, text_encoder=text_encoder, unet=_if_unet(8, 3), scheduler=_if_scheduler(),
+                         safety_checker=None, feature_extractor=None, watermarker=None, requires_safety_checker=False)
+    stage_2 = IFSuperResolutionPipeline(
+        tokenizer=tokenizer, text_encoder=None, unet=_if_unet(16, 6, class_embed_type="timestep"),
+        scheduler=_if_scheduler(), image_noising_scheduler=DDPMScheduler(beta_schedule="squaredcos_cap_v2"),
+        safety_checker=None, feature_extractor=None, watermarker=None, requires_safety_checker=False,
+    )
+    return stage_1, stage_2
+
+def tiny_text_to_video():
+    """ TextToVideoSDPipeline, as loaded by ZeroScope. """
+    from diffusers import DDIMScheduler, TextToVideoSDPipeline, UNet3DConditionModel
+    from transformers import CLIPTextModel
+
+    tokenizer, vocab_size = clip_tokenizer()
+    unet = UNet3DConditionModel(
+        sample_size=32, in_channels=4, out_channels=4, layers_per_block=1, block_out_channels=(32, 64),
+        down_block_types=("CrossAttnDownBlock3D", "DownBlock3D"), up_block_types=("UpBlock3D", "CrossAttnUpBlock3D"),
+        cross_attention_dim=TEXT_HIDDEN_SIZE, attention_head_dim=4, norm_num_groups=32,
+    )
+    scheduler = DDIMScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear", clip_sample=False, steps_offset=1)
+    return TextToVideoSDPipeline(vae=tiny_vae(sample_size=128), text_encoder=CLIPTextModel(clip_text_config(vocab_size)),
+                                 tokenizer=tokenizer, unet=unet, scheduler=scheduler)
+
+def build_checkpoints(root:str, models=None, seed:int=0):
+    """
+    Saves the tiny checkpoints of models (default: every wrapper in CHECKPOINTS) under root. Existing ones are kept.
+
+    Return: root
+    """
+    builders = {
+        "SDXL_Base": lambda: [tiny_sdxl()],
+        "SDXL_Turbo": lambda: [tiny_sdxl()],
+        "SDXL_2_1": lambda: [tiny_sd()],
+        "DeepFloyd_I_XL_v1": lambda: list(tiny_if_stages()),
+        "ZeroScope": lambda: [tiny_text_to_video()],
+    }
+    for model_name in models or CHECKPOINTS:
+        checkpoints = CHECKPOINTS[model_name]
+        if all(os.path.isdir(os.path.join(root, model_id)) for model_id, _ in checkpoints):
+            continue
+        torch.manual_seed(seed)
+        for pipe, (model_id, variant) in zip(builders[model_name](), checkpoints):
+            pipe.save_pretrained(os.path.join(root, model_id), variant=variant)
+    return root
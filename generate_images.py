@@ -1,35 +1,93 @@
-import json
 import os
 from utils import detect_device
+from journal import GenerationJournal
+from models.instrumentation import Tracer
+from prompt_source import load_prompts
+from models.output_cache import OutputCache
+from models.sampling import resolve_seeds, sample_filenames
 from models.t2image import get_model_class, print_all_model_names
 from dotenv import load_dotenv
 load_dotenv()
 
-def load_prompts_dict(path):
-    with open(path, "r") as f:
-        return json.load(f)
-    
-def get_model(name):
+def get_model(name, device=None, memory_budget=None, batch_size=4, preset=None):
+    """
+    Returns the model instance for name. Local models are loaded on device, which defaults to detect_device(), and
+    fitted in memory_budget GB, which defaults to $MEMORY_BUDGET_GB (no budget if unset). With ACCELERATE=1, they are
+    compiled and warmed up for single prompts and micro-batches of batch_size, see models.acceleration. They run with
+    the latency/quality preset ('draft', 'balanced' or 'full'), which defaults to $PRESET, or to the model's own
+    default if unset, see models.presets.
+    """
+    if memory_budget is None and os.getenv("MEMORY_BUDGET_GB"):
+        memory_budget = float(os.getenv("MEMORY_BUDGET_GB"))
+    if device is None and name not in ("DALLE", "Midjourney"):
+        device, _ = detect_device()
+    local_args = {"preset": preset or os.getenv("PRESET") or None}
+    if os.getenv("ACCELERATE") == "1":
+        local_args.update(accelerate=True, warmup_batch_sizes=sorted({1, batch_size}))
+
     if name == "DALLE":
-        return get_model_class('DALLE')(OAI_KEY, version=3)
+        DALLE_RPM = os.getenv("DALLE_RPM")
+        # Images are downloaded from the returned URLs by default, set DALLE_RESPONSE_FORMAT=b64_json to receive them inline
+        return get_model_class('DALLE')(os.getenv("OAI_KEY"), version=3, requests_per_minute=float(DALLE_RPM) if DALLE_RPM else None,
+                                        response_format=os.getenv("DALLE_RESPONSE_FORMAT", "url"))
     elif name == "DeepFloyd_I_XL_v1":
-        return get_model_class('DeepFloyd_I_XL_v1')()
+        # With a second device for stage 2, both stages run at once on consecutive micro-batches
+        stage_2_device = os.getenv("DEEPFLOYD_STAGE_2_DEVICE")
+        return get_model_class('DeepFloyd_I_XL_v1')(device=device, memory_budget=memory_budget,
+                                                    stage_2_device=stage_2_device, pipelined=stage_2_device is not None, **local_args)
     elif name == "Midjourney":
         args = {
             'version': 6.0,
         }
-        return get_model_class('Midjourney')(MJ_SERVER_URL, **args)
+        # e.g. MJ_GRID_QUADRANTS=1,2,3,4 also saves the four candidates of every grid as '{id}_{q}.jpeg'
+        grid_quadrants = [int(q) for q in os.getenv("MJ_GRID_QUADRANTS", "").split(",") if q.strip()] or None
+        # With MJ_NOTIFY_HOOK_PORT (and MJ_NOTIFY_HOOK_URL if the proxy reaches this machine through another address),
+        # the proxy pushes task updates to a local receiver instead of waiting for the next poll
+        notify_hook = None
+        if os.getenv("MJ_NOTIFY_HOOK_PORT"):
+            from models.t2image.notify_hook import get_receiver
+            notify_hook = get_receiver(port=int(os.getenv("MJ_NOTIFY_HOOK_PORT")), public_url=os.getenv("MJ_NOTIFY_HOOK_URL"))
+        return get_model_class('Midjourney')(os.getenv("MJ_SERVER_URL"), grid_quadrants=grid_quadrants,
+                                             notify_hook=notify_hook, **args)
     elif name == "SDXL_Turbo":
-        return get_model_class('SDXL_Turbo')(device=DEVICE)
+        return get_model_class('SDXL_Turbo')(device=device, memory_budget=memory_budget, **local_args)
     elif name == "SDXL_Base":
-        return get_model_class('SDXL_Base')(device=DEVICE)
+        return get_model_class('SDXL_Base')(device=device, memory_budget=memory_budget, **local_args)
     elif name == "SDXL_2_1":
-        return get_model_class('SDXL_2_1')(device=DEVICE)
+        return get_model_class('SDXL_2_1')(device=device, memory_budget=memory_budget, **local_args)
     else:
         raise ValueError(f"Model {name} not found")
 
 
-def generate(model_name:str, prompts_path:str, output_folder_path="./", start_idx=None, end_idx=None):
+def generate(model_name:str, prompts_path:str, output_folder_path="./", start_idx=None, end_idx=None, batch_size=4,
+             shard_index=0, num_shards=1, ids=None, device=None, seeds=None, num_samples=1, output_cache=True,
+             on_record=None, preset=None, api_batch_size=None):
+    """
+    Generates the prompts in prompts_path with model_name, saving '{id}.jpeg' files and log.json in output_folder_path.
+    Local models run the prompts in micro-batches of batch_size. API models ignore batch_size: api_batch_size caps the
+    concurrent DALLE calls (8 if None) or the outstanding Midjourney tasks (every prompt at once if None).
+    With seeds (or num_samples > 1), several samples are drawn per prompt with local models, saved as '{id}_{k}.jpeg'.
+    DALLE has no seeds: num_samples images are requested in one call (n, DALL-E 2 only) and saved the same way.
+
+    With output_cache (True for the default OutputCache(), or an OutputCache), a prompt generated before by the same
+    model with the same seeds and parameters, under any id or prompt file, is linked from the cache instead of being
+    generated again, and recorded with "cache_hit": true.
+
+    If provided, on_record is called with every entry as it is journaled, possibly from a writer thread, e.g., to
+    report progress.
+
+    Local models run with preset ('draft', 'balanced' or 'full', $PRESET by default, see get_model), which is recorded
+    in every log.json entry.
+    """
+    seeds = resolve_seeds(seeds, num_samples)
+    if model_name in ("DALLE", "Midjourney"):
+        batch_args = {"batch_size": api_batch_size} if api_batch_size is not None else {}
+    else:
+        batch_args = {"batch_size": batch_size}
+    if model_name == "DALLE":
+        sample_args = {"n": len(seeds)} if seeds else {}
+    else:
+        sample_args = {"seeds": seeds} if seeds else {}
 
     if not os.path.exists(output_folder_path):
         os.makedirs(output_folder_path)
@@ -38,49 +96,95 @@ def generate(model_name:str, prompts_path:str, output_folder_path="./", start_id
     if not os.path.exists(folder_path):
         os.makedirs(folder_path)
 
-    model = get_model(model_name)
+    model = get_model(model_name, device=device, batch_size=batch_size, preset=preset)
     
-    log = {}
-    print("Loading model...")
-    prompts = load_prompts_dict(prompts_path)
+    journal_filename = f"log.{shard_index}-of-{num_shards}.jsonl" if num_shards > 1 else "log.jsonl"
+    journal = GenerationJournal(output_folder_path, journal_filename=journal_filename)
+    # Spans (text encoding, denoising steps, decoding, saving, API calls, downloads) are appended to spans.jsonl
+    shard_suffix = f".{shard_index}-of-{num_shards}" if num_shards > 1 else ""
+    model.tracer = Tracer(jsonl_path=os.path.join(output_folder_path, f"spans{shard_suffix}.jsonl"))
+    if model_name == "Midjourney":
+        # Submitted tasks are recorded, so a restarted run re-attaches to its pending tasks instead of paying for them again
+        from models.t2image.task_ledger import TaskLedger
+        model.ledger = TaskLedger(os.path.join(output_folder_path, f"mj_tasks{shard_suffix}.jsonl"))
+    print("Loading prompts...")
+    prompts = load_prompts(prompts_path, shard_index=shard_index, num_shards=num_shards, ids=ids,
+                           exclude_ids=journal, start_idx=start_idx, end_idx=end_idx)
     print("Done.")
-    prompts = prompts[start_idx:end_idx] if start_idx is not None and end_idx is not None else prompts
-
-    for prompt in prompts:
-        print("Prompt:", prompt["prompt"])
 
-        prompt_data = {}
-        id = prompt["id"]
-        prompt = prompt["prompt"]
+    cache = OutputCache() if output_cache is True else output_cache or None
+    identity = model.cache_identity()
+    sample_seeds = seeds or [None]
+    # Everything passed to generate_batch besides the seeds, e.g., n for DALLE, changes the outputs
+    params = {key: value for key, value in sample_args.items() if key != "seeds"}
 
-        filename = f"{id}.jpeg"
+    def cache_keys(index):
+        return [cache.key(identity, prompts[index]["prompt"], seed, params=params, extension=".jpeg") for seed in sample_seeds]
 
-        prompt_data["id"] = id
-        prompt_data["prompt"] = prompt
-
-        save_path = model.generate(text_prompt=prompt, 
-                                   folder_path=folder_path, 
-                                   filename=filename)
-        
+    def record(index, save_path, cache_hit=False):
+        if isinstance(save_path, list) and None in save_path:
+            return # some samples failed, the prompt is generated again on the next run
         if save_path is not None:
-            prompt_data["image_path"] = save_path
-            log[id] = prompt_data
-
-    #update log.json
-    with open(os.path.join(output_folder_path, "log.json"), "w") as f:
-        json.dump(log, f, indent=4)
+            if cache is not None and not cache_hit:
+                cache.store(cache_keys(index), save_path if isinstance(save_path, list) else [save_path])
+            prompt_data = {}
+            prompt_data["id"] = prompts[index]["id"]
+            prompt_data["prompt"] = prompts[index]["prompt"]
+            if isinstance(save_path, list):
+                prompt_data["image_path"] = save_path[0]
+                prompt_data["image_paths"] = save_path
+            else:
+                prompt_data["image_path"] = save_path
+            if "seeds" in sample_args:
+                prompt_data["seeds"] = seeds
+            if getattr(model, "preset", None) is not None:
+                prompt_data["preset"] = model.preset
+            prompt_data["cache_hit"] = cache_hit
+            journal.append(prompt_data)
+            if on_record is not None:
+                on_record(prompt_data)
+
+    with journal, model.tracer:
+        todo = []
+        for index, prompt in enumerate(prompts):
+            save_paths = [os.path.join(folder_path, name) for name in sample_filenames(f"{prompt['id']}.jpeg", len(sample_seeds))]
+            if cache is not None and cache.fetch(cache_keys(index), save_paths):
+                if model_name == "Midjourney":
+                    for save_path in save_paths: # only grids are cached, their quadrants are split again
+                        model.split_grid(save_path)
+                record(index, save_paths if len(save_paths) > 1 else save_paths[0], cache_hit=True)
+            else:
+                todo.append(index)
+        if cache is not None:
+            print(f"{len(prompts) - len(todo)} prompts found in the output cache, {len(todo)} to generate.")
+
+        text_prompts = [prompts[index]["prompt"] for index in todo]
+        filenames = [f"{prompts[index]['id']}.jpeg" for index in todo]
+
+        # Local diffusers models run the prompts in micro-batches, API models fall back to one call per prompt
+        save_paths = model.generate_batch(text_prompts, filenames, 
+                                          folder_path=folder_path, 
+                                          callback=lambda i, save_path: record(todo[i], save_path),
+                                          **batch_args,
+                                          **sample_args)
+
+        # Outputs found on disk from earlier runs are not reported through the callback
+        for index, save_path in zip(todo, save_paths):
+            if prompts[index]["id"] not in journal:
+                record(index, save_path)
+
+    model.tracer.write_prometheus(os.path.join(output_folder_path, f"metrics{shard_suffix}.prom"))
+    if model_name == "Midjourney":
+        model.ledger.close()
+    if model_name not in ("DALLE", "Midjourney"):
+        print("Peak memory (GB):", model.peak_memory())
         
 
 if __name__ == '__main__':
     MODEL = "Midjourney" # Change me
     prompt_path = "./data/t2v_prompts.json" # Change me
 
-
-    OAI_KEY = os.getenv("OAI_KEY")
     DEVICE, type = detect_device()
-
-    if MODEL == "Midjourney":
-        MJ_SERVER_URL = os.getenv("MJ_SERVER_URL") 
     
-    generate(model_name=MODEL, output_folder_path=f"./output/{MODEL}", prompts_path=prompt_path)
+    generate(model_name=MODEL, output_folder_path=f"./output/{MODEL}", prompts_path=prompt_path, device=DEVICE)
 
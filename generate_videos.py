@@ -1,22 +1,44 @@
-import json
 import os
 from utils import detect_device
+from journal import GenerationJournal
+from models.instrumentation import Tracer
+from prompt_source import iter_prompts
+from models.output_cache import OutputCache
+from models.sampling import resolve_seeds, sample_filenames
 from models.t2video import get_model_class, print_all_model_names
 
-def load_prompts_dict(path):
-    with open(path, "r") as f:
-        return json.load(f)
-    
-def get_model(name):
+def get_model(name, device=None, memory_budget=None, preset=None):
+    """
+    Returns the model instance for name, loaded on device, which defaults to detect_device(). ZeroScope is fitted in
+    memory_budget GB, which defaults to $MEMORY_BUDGET_GB (no budget if unset), compiled with ACCELERATE=1, see
+    models.acceleration, and runs with preset, which defaults to $PRESET, see models.presets.
+    """
+    if memory_budget is None and os.getenv("MEMORY_BUDGET_GB"):
+        memory_budget = float(os.getenv("MEMORY_BUDGET_GB"))
+    if device is None:
+        device, _ = detect_device()
+
     if name == "ZeroScope":
-        return get_model_class('ZeroScope')(device=DEVICE)
+        return get_model_class('ZeroScope')(device=device, memory_budget=memory_budget, accelerate=os.getenv("ACCELERATE") == "1",
+                                            preset=preset or os.getenv("PRESET") or None)
     elif name == "ModelScope":
-        return get_model_class('ModelScope')(device=DEVICE)
+        return get_model_class('ModelScope')(device=device)
     else:
         raise ValueError(f"Model {name} not found")
 
 
-def generate(model_name:str, prompts_path:str, model_folder_path="./",):
+def generate(model_name:str, prompts_path:str, model_folder_path="./", shard_index=0, num_shards=1, ids=None, device=None,
+             seeds=None, num_samples=1, output_cache=True,
+             on_record=None, preset=None):
+    """
+    Generates the prompts in prompts_path with model_name, saving '{id}.mp4' files in model_folder_path/data.
+    With seeds (or num_samples > 1), several videos are generated per prompt with ZeroScope, saved as '{id}_{k}.mp4'.
+    With output_cache (True for the default OutputCache(), or an OutputCache), videos generated before for the same
+    request are linked from the cache instead, and on_record is called with every journaled entry, see
+    generate_images.generate. ZeroScope runs with preset, recorded in every log.json entry.
+    """
+    seeds = resolve_seeds(seeds, num_samples)
+    sample_args = {"seeds": seeds} if seeds else {}
 
     if not os.path.exists(model_folder_path):
         os.makedirs(model_folder_path)
@@ -25,42 +47,81 @@ def generate(model_name:str, prompts_path:str, model_folder_path="./",):
     if not os.path.exists(folder_path):
         os.makedirs(folder_path)
 
-    model = get_model(model_name)
+    model = get_model(model_name, device=device, preset=preset)
     
-    log = {}
-    print("Loading model...")
-    prompts = load_prompts_dict(prompts_path)
-    print("Done.")
-
-    if os.path.exists(os.path.join(model_folder_path, "log.json")):
-        with open(os.path.join(model_folder_path, "log.json"), "r") as f:
-            log = json.load(f)
-            
-    for prompt in prompts:
-        print("Id:", prompt["id"], "Prompt:", prompt["prompt"])
-
-        prompt_data = {}
-        id = prompt["id"]
-        prompt = prompt["prompt"]
-
-        filename = f"{id}.mp4"
-
-        prompt_data["id"] = id
-        prompt_data["prompt"] = prompt
-
-        save_path = model.generate(prompt=prompt, 
-                                   folder_path=folder_path, 
-                                   filename=filename)
-        
-        save_path = os.path.join(folder_path, filename)
+    journal_filename = f"log.{shard_index}-of-{num_shards}.jsonl" if num_shards > 1 else "log.jsonl"
+    journal = GenerationJournal(model_folder_path, journal_filename=journal_filename)
+    # Spans (text encoding, denoising steps, decoding, encoding) are appended to spans.jsonl
+    shard_suffix = f".{shard_index}-of-{num_shards}" if num_shards > 1 else ""
+    model.tracer = Tracer(jsonl_path=os.path.join(model_folder_path, f"spans{shard_suffix}.jsonl"))
+    prompts = iter_prompts(prompts_path, shard_index=shard_index, num_shards=num_shards, ids=ids, exclude_ids=journal)
 
-        if save_path is not None:
-            prompt_data["video_path"] = save_path
-            log[id] = prompt_data
+    cache = OutputCache() if output_cache is True else output_cache or None
+    identity = model.cache_identity()
+    sample_seeds = seeds or [None]
 
-        #update log.json
-        with open(os.path.join(model_folder_path, "log.json"), "w") as f:
-            json.dump(log, f, indent=4)
+    params = {key: value for key, value in sample_args.items() if key != "seeds"}
+
+    def cache_keys(prompt):
+        return [cache.key(identity, prompt, seed, params=params, extension=".mp4") for seed in sample_seeds]
+
+    def record(prompt_data, save_path, cache_hit=False):
+        if isinstance(save_path, list) and None in save_path:
+            return # some samples failed, the prompt is generated again on the next run
+        if save_path is not None:
+            if cache is not None and not cache_hit:
+                cache.store(cache_keys(prompt_data["prompt"]), save_path if isinstance(save_path, list) else [save_path])
+            if isinstance(save_path, list):
+                prompt_data["video_path"] = save_path[0]
+                prompt_data["video_paths"] = save_path
+            else:
+                prompt_data["video_path"] = save_path
+            if seeds:
+                prompt_data["seeds"] = seeds
+            if getattr(model, "preset", None) is not None:
+                prompt_data["preset"] = model.preset
+            prompt_data["cache_hit"] = cache_hit
+            journal.append(prompt_data)
+            if on_record is not None:
+                on_record(prompt_data)
+
+    writes = []
+    with journal, model.tracer:
+        for prompt in prompts:
+            print("Id:", prompt["id"], "Prompt:", prompt["prompt"])
+
+            prompt_data = {}
+            id = prompt["id"]
+            prompt = prompt["prompt"]
+
+            filename = f"{id}.mp4"
+
+            prompt_data["id"] = id
+            prompt_data["prompt"] = prompt
+
+            save_paths = [os.path.join(folder_path, name) for name in sample_filenames(filename, len(sample_seeds))]
+            if cache is not None and cache.fetch(cache_keys(prompt), save_paths):
+                print("    Found in the output cache.")
+                record(prompt_data, save_paths if len(save_paths) > 1 else save_paths[0], cache_hit=True)
+                continue
+
+            # The video is encoded in the background while the next prompt is generated, and journaled once written
+            writes.append(model.generate(prompt=prompt, 
+                                         folder_path=folder_path, 
+                                         filename=filename,
+                                         background=True,
+                                         callback=lambda save_path, prompt_data=prompt_data: record(prompt_data, save_path),
+                                         **sample_args))
+            for future in writes: # surfaces what failed in the finished writes
+                if future.done():
+                    future.result()
+            writes = [future for future in writes if not future.done()]
+
+        for future in writes: # wait for the last videos to be written
+            future.result()
+
+    model.tracer.write_prometheus(os.path.join(model_folder_path, f"metrics{shard_suffix}.prom"))
+    print("Peak memory (GB):", model.peak_memory())
         
         
 if __name__ == '__main__':
@@ -68,7 +129,7 @@ if __name__ == '__main__':
     prompts_path = "./data/t2v_prompts2.json" # change me
     DEVICE, type = detect_device()
 
-    generate(model_name=MODEL, prompts_path=prompts_path, model_folder_path=f"./output/{MODEL}")
+    generate(model_name=MODEL, prompts_path=prompts_path, model_folder_path=f"./output/{MODEL}", device=DEVICE)
 
 
     
@@ -0,0 +1,113 @@
+"""
+This file defines the GenerationJournal class used by the generation drivers to record finished prompts.
+
+Every finished prompt is appended to log.jsonl as one line and flushed to disk right away, so a crash loses at
+most the prompt being written. On startup the journal is replayed to skip completed ids, and log.json is
+produced by compacting the journal into a single id -> entry manifest.
+"""
+
+import glob
+import json
+import os
+import threading
+
+from models.atomic_file import atomic_write
+
+def read_entries(output_folder_path:str, log_filename:str="log.json") -> dict:
+    """
+    Returns the id -> entry dict recorded in output_folder_path, in the manifest and every journal next to it,
+    without opening a journal for writing, e.g., to count the prompts a run still has to generate.
+    """
+    entries = {}
+    log_path = os.path.join(output_folder_path, log_filename)
+    if os.path.exists(log_path):
+        with open(log_path, "r", encoding="utf-8") as f:
+            entries.update(json.load(f))
+
+    journal_pattern = os.path.join(output_folder_path, os.path.splitext(log_filename)[0] + "*.jsonl")
+    for journal_path in sorted(glob.glob(journal_pattern)):
+        with open(journal_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue # partially written line from a crash
+                entries[entry["id"]] = entry
+    return entries
+
+class GenerationJournal:
+    def __init__(self, output_folder_path:str, journal_filename:str="log.jsonl", log_filename:str="log.json"):
+        """
+        Opens (or creates) the journal in output_folder_path and replays the entries already recorded.
+
+        Parameters:
+        - output_folder_path: The folder holding the journal and the compacted manifest.
+        - journal_filename: The name of the append-only JSONL journal. Workers sharing an output folder each use their
+          own journal, e.g., 'log.0-of-4.jsonl'; every 'log*.jsonl' journal in the folder is replayed and compacted.
+        - log_filename: The name of the compacted JSON manifest. Entries of an existing manifest are replayed too,
+          so runs started before the journal existed also resume.
+        """
+        if not os.path.exists(output_folder_path):
+            os.makedirs(output_folder_path)
+
+        self.journal_path = os.path.join(output_folder_path, journal_filename)
+        self.log_path = os.path.join(output_folder_path, log_filename)
+        self.lock = threading.Lock()
+        self.entries = self.replay()
+
+        self.file = open(self.journal_path, "a", encoding="utf-8")
+        if self.file.tell() > 0 and not self._ends_with_newline():
+            self.file.write("\n") # terminate a line cut short by a crash so the next entry starts cleanly
+
+    def _ends_with_newline(self):
+        with open(self.journal_path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def read_entries(self):
+        """ Returns the id -> entry dict currently recorded on disk in the manifest and all journals of the folder. """
+        return read_entries(os.path.dirname(self.log_path), os.path.basename(self.log_path))
+
+    def replay(self):
+        """ Returns the id -> entry dict recorded by previous runs. """
+        entries = self.read_entries()
+        if entries:
+            print(f"Resuming: {len(entries)} prompts already completed.")
+        return entries
+
+    def __contains__(self, id):
+        return id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def append(self, entry:dict):
+        """ Records a finished prompt. entry must contain an 'id' key. Safe to call from several threads. """
+        line = json.dumps(entry, ensure_ascii=False)
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.entries[entry["id"]] = entry
+
+    def compact(self):
+        """
+        Writes every recorded entry, including those journaled by other workers sharing the folder, to the manifest,
+        atomically replacing the previous one, see models.atomic_file.
+        """
+        with self.lock:
+            entries = self.read_entries()
+            entries.update(self.entries)
+            with atomic_write(self.log_path, "w", encoding="utf-8") as f:
+                json.dump(dict(sorted(entries.items())), f, indent=4)
+
+    def close(self):
+        """ Compacts the journal into the manifest and closes it. """
+        self.compact()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,77 @@
+"""
+Speed-ups shared by the diffusers wrappers, enabled with accelerate=True:
+    - fused attention: attention runs through torch's scaled_dot_product_attention (the diffusers '...2_0'
+      processors) wherever a fused variant of the current processor exists. Sliced attention is kept.
+    - channels_last: the 2D UNets and the VAE use the NHWC memory layout, which the convolution kernels of cuDNN
+      (tensor cores) and oneDNN (CPU) prefer.
+    - torch.compile: the UNets and the VAE decoder are compiled with inductor, which works on CPU as well as CUDA.
+
+Compiled artifacts are cached on disk in $TORCHINDUCTOR_CACHE_DIR (default: compiled_kernels in $TRANSFORMERS_CACHE),
+so later process starts reuse them instead of compiling again. Every new input shape (batch size, resolution) still
+has to be traced once, which BaseModel.warmup does at load time for the configured shapes.
+
+Pipelines with CPU offload (see models.memory) move their weights during the call, which breaks compiled graphs, so
+they only get fused attention.
+"""
+
+import os
+
+TRANSFORMERS_CACHE = os.getenv("TRANSFORMERS_CACHE")
+
+def default_compile_cache_dir():
+    """ Returns $TORCHINDUCTOR_CACHE_DIR, or a compiled_kernels folder in $TRANSFORMERS_CACHE (~/.cache by default). """
+    return os.getenv("TORCHINDUCTOR_CACHE_DIR") or os.path.join(TRANSFORMERS_CACHE or os.path.expanduser("~/.cache"), "compiled_kernels")
+
+def enable_compile_cache(cache_dir=None):
+    """ Makes inductor keep its compiled graphs and kernels in cache_dir across processes. """
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_dir or default_compile_cache_dir()
+    import torch._inductor.config as inductor_config
+    inductor_config.fx_graph_cache = True
+    if hasattr(inductor_config, "autotune_local_cache"):
+        inductor_config.autotune_local_cache = True
+
+def is_offloaded(pipe) -> bool:
+    """ Returns True if a component of pipe is moved between devices by accelerate hooks (model or sequential offload). """
+    return any(hasattr(component, "_hf_hook") for component in pipe.components.values())
+
+def use_fused_attention(model):
+    """ Replaces the attention processors of model that have a scaled_dot_product_attention ('2_0') variant with it. """
+    from diffusers.models import attention_processor
+    processors = getattr(model, "attn_processors", None)
+    if not processors:
+        return
+    fused = {}
+    for name, processor in processors.items():
+        fused_class = getattr(attention_processor, type(processor).__name__ + "2_0", None)
+        fused[name] = fused_class() if fused_class is not None else processor
+    model.set_attn_processor(fused)
+
+def accelerate_pipe(pipe, compile_mode=None):
+    """
+    Applies fused attention, channels_last and torch.compile to the UNet and VAE decoder of pipe, see above.
+
+    Parameters:
+    - pipe: A diffusers pipeline, already placed on its device.
+    - compile_mode: The torch.compile mode, e.g., 'max-autotune' to also benchmark kernel configurations on CUDA.
+      Defaults to torch's default mode, which compiles fastest.
+    """
+    import torch
+
+    unet = getattr(pipe, "unet", None)
+    vae = getattr(pipe, "vae", None)
+    for model in (unet, vae):
+        if model is not None:
+            use_fused_attention(model)
+    if is_offloaded(pipe):
+        print(f"{type(pipe).__name__} is offloaded, only fused attention is enabled.")
+        return
+
+    enable_compile_cache()
+    for model in (unet, vae):
+        # channels_last only applies to 4D weights, 3D UNets (text-to-video) keep their layout
+        if model is not None and all(parameter.dim() <= 4 for parameter in model.parameters()):
+            model.to(memory_format=torch.channels_last)
+    if unet is not None:
+        pipe.unet = torch.compile(unet, mode=compile_mode)
+    if vae is not None:
+        vae.decode = torch.compile(vae.decode, mode=compile_mode)
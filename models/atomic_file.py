@@ -0,0 +1,71 @@
+"""
+Helpers shared by everything that writes generated outputs to disk: downloads, encoded images and videos, Midjourney
+grid quadrants, cached outputs and metrics files.
+
+Files are written atomically. The content goes to a temporary file next to the destination, is flushed to disk, and
+only then renamed over the destination. An interrupted run therefore never leaves a truncated file behind, and readers
+(resumed runs, the output cache, a metrics collector) only ever see complete files.
+"""
+
+import contextlib
+import os
+import secrets
+
+def create_temp_file(save_path:str, suffix:str=".part"):
+    """
+    Creates an empty temporary file next to save_path, named '.{filename}.{random}{suffix}'.
+
+    Unlike tempfile.mkstemp, which makes files readable by their owner only, the file gets the permissions of any newly
+    created file (0o666 minus the umask). The OS applies the umask, so the process-wide umask is never read or changed.
+
+    Return: (fd, tmp_path), with fd open for writing.
+    """
+    folder_path = os.path.dirname(save_path) or "."
+    os.makedirs(folder_path, exist_ok=True)
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+    for _ in range(100):
+        tmp_path = os.path.join(folder_path, f".{os.path.basename(save_path)}.{secrets.token_hex(4)}{suffix}")
+        try:
+            return os.open(tmp_path, flags, 0o666), tmp_path
+        except FileExistsError:
+            continue
+    raise FileExistsError(f"No free temporary name next to {save_path}.")
+
+@contextlib.contextmanager
+def atomic_path(save_path:str, suffix:str=".part"):
+    """
+    Yields the path of an empty temporary file next to save_path, for code that writes by path, e.g., ffmpeg. When
+    the block exits normally, the file is flushed to disk and renamed to save_path. If the block raises, the file is
+    removed. The block may replace the temporary file, e.g., with a hardlink.
+
+    Parameters:
+    - save_path: The destination. An existing file there is replaced.
+    - suffix: The suffix of the temporary name, e.g., '.part.mp4' for writers that pick the format from the extension.
+    """
+    fd, tmp_path = create_temp_file(save_path, suffix)
+    os.close(fd)
+    try:
+        yield tmp_path
+        fd = os.open(tmp_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, save_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+@contextlib.contextmanager
+def atomic_write(save_path:str, mode:str="wb", encoding=None, suffix:str=".part"):
+    """ Yields a file object opened with mode whose content replaces save_path once the block exits normally, see atomic_path. """
+    with atomic_path(save_path, suffix) as tmp_path:
+        with open(tmp_path, mode, encoding=encoding) as file:
+            yield file
+
+def write_file(save_path:str, data) -> str:
+    """ Writes data (bytes, or str as UTF-8) to save_path atomically. Return: save_path """
+    with atomic_write(save_path, "wb" if isinstance(data, bytes) else "w", encoding=None if isinstance(data, bytes) else "utf-8") as file:
+        file.write(data)
+    return save_path
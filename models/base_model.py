@@ -1,7 +1,13 @@
 """
 This file contains the base class for all models.
 """
+import os
+import threading
 from typing import Optional
+from .image_writer import ImageWriter, get_image_writer
+from . import memory
+from .instrumentation import get_tracer
+from .sampling import resolve_seeds, sample_filenames
 from abc import ABC, abstractmethod
 
 class BaseModel:
@@ -12,9 +18,178 @@ class BaseModel:
 
     @abstractmethod
     def generate(self, text_prompt:str, folder_path:Optional[str]=None, filename:Optional[str]=None):
-        '''  Generates an image from a given text_prompt. 
-        
+        '''  Generates an image from a given text_prompt.
+
         @returns the URL of the generated image or save_path if download is True
-        
+
+        '''
+        pass
+
+    def generate_images(self, text_prompts:list, **kwargs):
+        ''' Generates one image (a PIL image or a uint8 array/tensor) per prompt in text_prompts with a single pipeline call.
+
+        Only models that support batched inference implement this; generate_batch falls back to
+        calling generate once per prompt otherwise.
         '''
-        pass
\ No newline at end of file
+        raise NotImplementedError
+
+    def generate_image_batches(self, batches:list, **kwargs):
+        ''' Yields the output of generate_images for each list of prompts in batches, in order.
+
+        Models that can overlap the work of consecutive batches, e.g., the two DeepFloyd stages, override this.
+        '''
+        for text_prompts in batches:
+            with self.span("batch", prompts=len(text_prompts)):
+                images = self.generate_images(text_prompts, **kwargs)
+            yield images
+
+    def apply_memory_budget(self, pipes:list, device, memory_budget:float):
+        ''' Places the diffusers pipes of the model on device using the fastest strategy of models.memory that is
+        expected to fit in memory_budget GB (device memory on an accelerator, RAM on CPU).
+        '''
+        self.device = device
+        self.memory_strategy = memory.choose_strategy(pipes, device, memory_budget)
+        print(f"Fitting the model in {memory_budget} GB on {device} with the '{self.memory_strategy}' strategy.")
+        for pipe in pipes:
+            memory.apply_strategy(pipe, device, self.memory_strategy)
+        memory.reset_peak_memory(device)
+
+    def apply_acceleration(self, pipes:list, warmup_batch_sizes=(1,), compile_mode=None):
+        ''' Enables fused attention, channels_last and torch.compile on the diffusers pipes of the model (see
+        models.acceleration), then runs warmup for warmup_batch_sizes so compilation happens at load time.
+        '''
+        from . import acceleration
+        for pipe in pipes:
+            acceleration.accelerate_pipe(pipe, compile_mode)
+        if warmup_batch_sizes:
+            self.warmup(warmup_batch_sizes)
+
+    def warmup(self, batch_sizes=(1,), **kwargs):
+        ''' Runs generate_images once per batch size in batch_sizes, so compilation and other first-call costs are paid
+        before the first prompts. kwargs are passed to generate_images and should match the later calls wherever they
+        change tensor shapes, e.g., height and width, seeds or num_samples.
+        '''
+        for batch_size in batch_sizes:
+            with self.span("warmup", prompts=batch_size):
+                self.generate_images(["a photo of a cat"] * batch_size, **kwargs)
+
+    def select_preset(self, preset:Optional[str]=None, **overrides) -> dict:
+        ''' Sets self.preset to preset (DEFAULT_PRESET of the model class if None) and self.preset_settings to its
+        settings, with overrides such as an explicit torch_dtype or variant applied. See models.presets.
+
+        @returns the settings
+        '''
+        from . import presets
+        self.preset = preset or type(self).DEFAULT_PRESET
+        self.preset_settings = presets.resolve_preset(type(self).PRESETS, self.preset, **overrides)
+        return self.preset_settings
+
+    def peak_memory(self):
+        ''' Returns the peak memory used so far in GB, see models.memory.peak_memory. '''
+        return memory.peak_memory(getattr(self, "device", None))
+
+    def cache_identity(self) -> dict:
+        ''' Returns what identifies the outputs of this model besides the prompt, seed and generation parameters, e.g.,
+        the model id and the settings of its preset. Outputs are only reused across runs by models with the same
+        identity, see models.output_cache.
+        '''
+        identity = {"model": type(self).__name__, "model_id": getattr(self, "model_id", None)}
+        if getattr(self, "preset_settings", None) is not None:
+            identity["preset"] = self.preset_settings # steps, scheduler and dtype change the outputs
+        return identity
+
+    def span(self, name:str, **attributes):
+        ''' Returns a span timing the code it wraps, labelled with the model class, e.g., `with self.span("pipeline"):`.
+        Spans go to self.tracer if the model was given one, to the shared get_tracer() otherwise. See models.instrumentation.
+        '''
+        tracer = getattr(self, "tracer", None) or get_tracer()
+        return tracer.span(name, model=type(self).__name__, **attributes)
+
+    def prompt_length(self, text_prompt:str):
+        ''' Returns the length used to bucket text_prompt into micro-batches of similar size. '''
+        return len(text_prompt.split())
+
+    def generate_batch(self, text_prompts:list, filenames:list, folder_path:str="./", batch_size:int=4, callback=None,
+                       image_writer:Optional[ImageWriter]=None, **kwargs):
+        '''
+        Generates an output for every prompt in text_prompts and saves it under the matching filename.
+
+        Prompts whose output already exists in folder_path are skipped. The remaining prompts are sorted by
+        prompt_length and sent to generate_images (through generate_image_batches) in micro-batches of at most batch_size
+        prompts. Outputs are encoded and saved by image_writer in the background while the next micro-batch is generated.
+
+        Parameters:
+        - text_prompts: The list of text prompts to generate from.
+        - filenames: The list of filenames (including extension) to save each output as, aligned with text_prompts.
+        - folder_path: The directory where the outputs will be saved.
+        - batch_size: The maximum number of prompts sent to the pipeline in one call.
+        - callback: If provided, called as callback(index, save_path) as soon as the output for text_prompts[index] is saved.
+          With generate_images, it is called from a writer thread.
+        - image_writer: The ImageWriter used to save outputs, e.g., ImageWriter(format='PNG'). Defaults to get_image_writer().
+        - kwargs: Additional arguments passed to generate_images (or generate), e.g., num_inference_steps. With seeds or
+          num_samples, several samples are drawn per prompt and saved as '{stem}_{k}{extension}'.
+
+        @returns a list of save paths aligned with text_prompts, with None for prompts that failed. With several samples
+        per prompt, each entry (and the save_path passed to callback) is the list of the sample paths.
+        '''
+        assert len(text_prompts) == len(filenames), "text_prompts and filenames must have the same length."
+        if not os.path.exists(folder_path):
+            os.makedirs(folder_path)
+
+        seeds = resolve_seeds(kwargs.get("seeds"), kwargs.get("num_samples", 1))
+        num_samples = len(seeds) if seeds else 1
+        sample_paths = [[os.path.join(folder_path, name) for name in sample_filenames(filename, num_samples)] for filename in filenames]
+
+        save_paths = [None] * len(text_prompts)
+        pending = []
+        for i, paths in enumerate(sample_paths):
+            if all(os.path.exists(save_path) for save_path in paths):
+                print(f"Output already exists at {paths[0]}")
+                save_paths[i] = paths if num_samples > 1 else paths[0]
+            else:
+                pending.append(i)
+
+        if type(self).generate_images is BaseModel.generate_images:
+            for i in pending:
+                with self.span("generate"):
+                    save_paths[i] = self.generate(text_prompts[i], folder_path=folder_path, filename=filenames[i], **kwargs)
+                if callback is not None:
+                    callback(i, save_paths[i])
+            return save_paths
+
+        image_writer = image_writer if image_writer is not None else get_image_writer()
+        kwargs.pop("num_samples", None)
+        if seeds:
+            kwargs["seeds"] = seeds
+        writes = []
+        lock = threading.Lock()
+        results = {i: [None] * num_samples for i in pending}
+        remaining = {i: num_samples for i in pending}
+
+        def saved(i, k):
+            def record(save_path):
+                results[i][k] = save_path
+                with lock:
+                    remaining[i] -= 1
+                    last = remaining[i] == 0
+                if last: # every sample of prompt i is written
+                    save_paths[i] = results[i] if num_samples > 1 else results[i][0]
+                    if callback is not None:
+                        callback(i, save_paths[i])
+            return record
+
+        pending.sort(key=lambda i: self.prompt_length(text_prompts[i]))
+        batches = [pending[start:start + batch_size] for start in range(0, len(pending), batch_size)]
+        outputs = self.generate_image_batches([[text_prompts[i] for i in batch] for batch in batches], **kwargs)
+        done = 0
+        for batch, images in zip(batches, outputs):
+            done += len(batch)
+            print(f"Generated batch of {len(batch)} prompts ({done}/{len(pending)})")
+            for n, i in enumerate(batch): # the samples of each prompt are consecutive
+                for k in range(num_samples):
+                    writes.append(image_writer.submit(images[n * num_samples + k], sample_paths[i][k], callback=saved(i, k),
+                                                      span=self.span("save")))
+
+        for future in writes: # wait for the last micro-batches to be written
+            future.result()
+        return save_paths
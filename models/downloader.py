@@ -0,0 +1,118 @@
+"""
+This file defines the ImageDownloader class shared by the API models (DALLE, Midjourney) to fetch generated images.
+
+Downloads reuse keep-alive connections from one pooled session and are streamed to disk atomically, see
+models.atomic_file.
+"""
+
+import os
+import contextlib
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .atomic_file import atomic_write
+from .rate_limit import RETRYABLE_STATUS_CODES, backoff_delay
+
+class ImageDownloader:
+    def __init__(self, pool_size:int=16, connect_timeout:float=10, read_timeout:float=60, max_retries:int=3,
+                 max_workers:int=4, chunk_size:int=1 << 16):
+        """
+        Initializes the downloader with a pooled session.
+
+        Parameters:
+        - pool_size: The maximum number of keep-alive connections kept per host.
+        - connect_timeout: Seconds to wait for a connection to be established.
+        - read_timeout: Seconds to wait between bytes received from the server.
+        - max_retries: The number of retries on connection errors and 429/5xx responses, done by the session, and
+          separately the number of times an interrupted transfer is restarted.
+        - max_workers: The number of threads used for background downloads.
+        - chunk_size: The number of bytes read from the response and written to disk at a time.
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+
+        retry = Retry(total=max_retries, backoff_factor=0.5, status_forcelist=sorted(RETRYABLE_STATUS_CODES),
+                      allowed_methods=["GET"], respect_retry_after_header=True, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def download(self, image_url:str, save_path:str) -> Optional[str]:
+        """
+        Downloads image_url to save_path.
+
+        Return: save_path if the download succeeded, None otherwise.
+        """
+        folder_path = os.path.dirname(save_path) or "."
+        os.makedirs(folder_path, exist_ok=True)
+
+        # The session retries connection errors and 429/5xx responses, this loop only retries interrupted transfers
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.get(image_url, stream=True, timeout=self.timeout)
+            except requests.RequestException as e:
+                print(f"Failed to download the image from {image_url}:", e)
+                return None
+            with response:
+                if response.status_code != 200:
+                    print(f"Failed to download the image. Status code: {response.status_code}")
+                    return None
+                try:
+                    with atomic_write(save_path) as file:
+                        for chunk in response.iter_content(chunk_size=self.chunk_size):
+                            file.write(chunk)
+                    return save_path
+                except requests.RequestException as e:
+                    if attempt == self.max_retries:
+                        print(f"Failed to download the image from {image_url}:", e)
+                        return None
+            time.sleep(backoff_delay(attempt, base_delay=0.5))
+
+    def submit(self, image_url:str, save_path:str, span=None, callback=None) -> Future:
+        """
+        Downloads image_url to save_path on a background thread. If provided, span is a context manager entered around
+        the download, e.g., a span of models.instrumentation, and callback is called on the download thread with the
+        download result. Return: a Future resolving to the download result once the callback has returned.
+        """
+        def task():
+            with span if span is not None else contextlib.nullcontext():
+                result = self.download(image_url, save_path)
+            if callback is not None:
+                callback(result)
+            return result
+
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="image-download")
+        return self.executor.submit(task)
+
+    def close(self):
+        """ Waits for background downloads to finish and closes the pooled connections. """
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        self.session.close()
+
+
+_shared_downloader = None
+_shared_downloader_lock = threading.Lock()
+
+def get_downloader() -> ImageDownloader:
+    """ Returns the ImageDownloader shared by all API models in this process. """
+    global _shared_downloader
+    with _shared_downloader_lock:
+        if _shared_downloader is None:
+            _shared_downloader = ImageDownloader()
+        return _shared_downloader
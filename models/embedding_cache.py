@@ -0,0 +1,179 @@
+"""
+This file defines the EmbeddingCache class, a content-addressed cache of text-encoder outputs shared by the
+diffusers wrappers, so rerunning the same prompts (e.g., with new seeds) skips text encoding entirely.
+
+Entries are keyed on a hash of (namespace, prompt), where the namespace identifies the text encoder. Recently used
+entries stay in memory on the device they were computed on; every entry is also written to disk as .npy files that
+are memory-mapped back on later runs.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import numpy as np
+import torch
+
+TRANSFORMERS_CACHE = os.getenv("TRANSFORMERS_CACHE")
+
+def default_cache_dir():
+    """ Returns $EMBEDDING_CACHE_DIR, or a prompt_embeds folder in $TRANSFORMERS_CACHE (~/.cache by default). """
+    return os.getenv("EMBEDDING_CACHE_DIR") or os.path.join(TRANSFORMERS_CACHE or os.path.expanduser("~/.cache"), "prompt_embeds")
+
+class EmbeddingCache:
+    def __init__(self, cache_dir:Optional[str]=None, max_items:int=256, persist:bool=True):
+        """
+        Initializes the cache.
+
+        Parameters:
+        - cache_dir: The directory of the on-disk tier. Defaults to default_cache_dir().
+        - max_items: The number of entries kept in the in-memory LRU tier.
+        - persist: If False, only the in-memory tier is used.
+        """
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_items = max_items
+        self.persist = persist
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(namespace:str, text:str) -> str:
+        return hashlib.sha256(f"{namespace}\0{text}".encode("utf-8")).hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _remember(self, key, tensors):
+        with self.lock:
+            self.memory[key] = tensors
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_items:
+                self.memory.popitem(last=False)
+
+    def _load(self, key):
+        entry_dir = self._entry_dir(key)
+        if not self.persist or not os.path.isdir(entry_dir):
+            return None
+        files = sorted(os.listdir(entry_dir), key=lambda name: int(name.split(".")[0]))
+        # copy-on-write mapping: pages are read lazily and the tensors stay writable
+        return tuple(torch.from_numpy(np.load(os.path.join(entry_dir, name), mmap_mode="c")) for name in files)
+
+    def _store(self, key, tensors):
+        entry_dir = self._entry_dir(key)
+        if not self.persist or os.path.isdir(entry_dir):
+            return
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(entry_dir))
+        for i, tensor in enumerate(tensors):
+            tensor = tensor.detach().cpu()
+            if tensor.dtype == torch.bfloat16: # not supported by numpy
+                tensor = tensor.float()
+            np.save(os.path.join(tmp_dir, f"{i}.npy"), tensor.numpy())
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError: # stored concurrently by another process
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def get(self, namespace:str, text:str, device=None, dtype=None):
+        """ Returns the cached tuple of tensors for text, moved to device and dtype, or None on a miss. """
+        key = self.key(namespace, text)
+        with self.lock:
+            tensors = self.memory.get(key)
+            if tensors is not None:
+                self.memory.move_to_end(key)
+        if tensors is None:
+            tensors = self._load(key)
+            if tensors is None:
+                return None
+            tensors = tuple(tensor.to(device=device, dtype=dtype) for tensor in tensors)
+            self._remember(key, tensors)
+        return tuple(tensor.to(device=device, dtype=dtype) for tensor in tensors)
+
+    def put(self, namespace:str, text:str, tensors:tuple):
+        """ Stores the tuple of tensors computed for text, each without a batch dimension. """
+        key = self.key(namespace, text)
+        tensors = tuple(tensor.detach() for tensor in tensors)
+        self._remember(key, tensors)
+        self._store(key, tensors)
+
+    def get_many(self, namespace:str, texts:list, encode_fn:Callable, device=None, dtype=None) -> tuple:
+        """
+        Returns the embeddings of texts, encoding only the texts that are not cached yet, in one call.
+
+        Parameters:
+        - namespace: Identifies the text encoder, e.g., the model id.
+        - texts: The list of prompts.
+        - encode_fn: Called with the list of missing prompts, returns a tuple of tensors batched along the first dimension.
+        - device, dtype: Where the returned tensors are placed.
+
+        Return: A tuple of tensors batched along the first dimension, aligned with texts.
+        """
+        cached = [self.get(namespace, text, device=device, dtype=dtype) for text in texts]
+        missing = [i for i, tensors in enumerate(cached) if tensors is None]
+        with self.lock: # get_many runs on several threads, e.g., the pipelined DeepFloyd producer and server requests
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+
+        if missing:
+            with torch.no_grad():
+                encoded = encode_fn([texts[i] for i in missing])
+            for row, i in enumerate(missing):
+                tensors = tuple(tensor[row].clone() for tensor in encoded)
+                self.put(namespace, texts[i], tensors)
+                cached[i] = tuple(tensor.to(device=device, dtype=dtype) for tensor in tensors)
+
+        return tuple(torch.stack(parts) for parts in zip(*cached))
+
+
+def encode_sdxl_prompts(cache:EmbeddingCache, namespace:str, pipe, text_prompts:list, do_classifier_free_guidance:bool) -> dict:
+    """
+    Returns the prompt_embeds, pooled_prompt_embeds (and negative_* with classifier-free guidance) keyword arguments
+    for a StableDiffusionXLPipeline call on text_prompts, encoding only prompts missing from cache.
+    The negative embedding of the empty prompt is encoded once and reused for every batch.
+    """
+    device, dtype = pipe._execution_device, pipe.text_encoder_2.dtype
+    encode_fn = lambda texts: pipe.encode_prompt(texts, device=device, do_classifier_free_guidance=False)[0::2]
+    prompt_embeds, pooled_prompt_embeds = cache.get_many(namespace, text_prompts, encode_fn, device=device, dtype=dtype)
+    embeds = {"prompt_embeds": prompt_embeds, "pooled_prompt_embeds": pooled_prompt_embeds}
+
+    if do_classifier_free_guidance:
+        if pipe.config.force_zeros_for_empty_prompt:
+            embeds["negative_prompt_embeds"] = torch.zeros_like(prompt_embeds)
+            embeds["negative_pooled_prompt_embeds"] = torch.zeros_like(pooled_prompt_embeds)
+        else:
+            negative_embeds, negative_pooled_embeds = cache.get_many(namespace, [""], encode_fn, device=device, dtype=dtype)
+            embeds["negative_prompt_embeds"] = negative_embeds.repeat(len(text_prompts), 1, 1)
+            embeds["negative_pooled_prompt_embeds"] = negative_pooled_embeds.repeat(len(text_prompts), 1)
+    return embeds
+
+def encode_sd_prompts(cache:EmbeddingCache, namespace:str, pipe, text_prompts:list, do_classifier_free_guidance:bool) -> dict:
+    """
+    Returns the prompt_embeds (and negative_prompt_embeds with classifier-free guidance) keyword arguments for a
+    StableDiffusionPipeline or TextToVideoSDPipeline call on text_prompts, encoding only prompts missing from cache.
+    """
+    device, dtype = pipe._execution_device, pipe.text_encoder.dtype
+    encode_fn = lambda texts: pipe.encode_prompt(texts, device, 1, False)[:1]
+    prompt_embeds, = cache.get_many(namespace, text_prompts, encode_fn, device=device, dtype=dtype)
+    embeds = {"prompt_embeds": prompt_embeds}
+
+    if do_classifier_free_guidance:
+        negative_embeds, = cache.get_many(namespace, [""], encode_fn, device=device, dtype=dtype)
+        embeds["negative_prompt_embeds"] = negative_embeds.repeat(len(text_prompts), 1, 1)
+    return embeds
+
+def encode_if_prompts(cache:EmbeddingCache, namespace:str, pipe, text_prompts:list) -> dict:
+    """
+    Returns the prompt_embeds and negative_prompt_embeds keyword arguments for the DeepFloyd IF stages on
+    text_prompts, running the T5 encoder of pipe only for prompts missing from cache.
+    """
+    device, dtype = pipe._execution_device, pipe.text_encoder.dtype
+    encode_fn = lambda texts: pipe.encode_prompt(texts, do_classifier_free_guidance=False, device=device)[:1]
+    prompt_embeds, = cache.get_many(namespace, text_prompts, encode_fn, device=device, dtype=dtype)
+    negative_embeds, = cache.get_many(namespace, [""], encode_fn, device=device, dtype=dtype)
+    return {"prompt_embeds": prompt_embeds, "negative_prompt_embeds": negative_embeds.repeat(len(text_prompts), 1, 1)}
@@ -0,0 +1,128 @@
+"""
+This file defines the ImageWriter class used by the local image models to encode and save generated images on
+background threads, so the accelerator can start on the next batch while the previous one is written.
+
+Images are handed over as PIL images or uint8 arrays/tensors (H, W, C or C, H, W) and written atomically, see
+models.atomic_file.
+"""
+
+import os
+import contextlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional
+
+import numpy as np
+from PIL import Image
+
+from .atomic_file import atomic_write
+
+def to_pil(image) -> Image.Image:
+    """ Returns image as a PIL image. image is a PIL image, or a uint8 numpy array or torch tensor on any device. """
+    if isinstance(image, Image.Image):
+        return image
+    if hasattr(image, "detach"): # torch tensor, possibly still on the accelerator
+        image = image.detach().cpu().numpy()
+    array = np.asarray(image)
+    if array.dtype != np.uint8:
+        raise ValueError(f"Images must be quantized to uint8 before writing, got {array.dtype}.")
+    if array.ndim == 3 and array.shape[0] in (1, 3, 4) and array.shape[-1] not in (1, 3, 4):
+        array = array.transpose(1, 2, 0) # channels first -> channels last
+    if array.ndim == 3 and array.shape[-1] == 1:
+        array = array[..., 0]
+    return Image.fromarray(np.ascontiguousarray(array))
+
+class ImageWriter:
+    def __init__(self, max_workers:int=2, max_pending:int=8, format:Optional[str]=None, quality:int=95):
+        """
+        Initializes the writer.
+
+        Parameters:
+        - max_workers: The number of threads encoding images.
+        - max_pending: The maximum number of images queued or being written. submit blocks once it is reached, so a
+          fast generator cannot pile up decoded images in memory.
+        - format: The PIL format to encode with, e.g., 'PNG'. Defaults to the format matching the filename extension.
+        - quality: The quality used for lossy formats (JPEG, WEBP).
+        """
+        self.max_workers = max_workers
+        self.format = format
+        self.quality = quality
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def image_format(self, save_path:str) -> str:
+        if self.format is not None:
+            return self.format
+        extension = os.path.splitext(save_path)[1].lower()
+        Image.init()
+        if extension not in Image.registered_extensions():
+            raise ValueError(f"Cannot infer the image format of {save_path}, pass format explicitly.")
+        return Image.registered_extensions()[extension]
+
+    def write(self, image, save_path:str) -> str:
+        """ Encodes image and saves it to save_path on the calling thread. Return: save_path. """
+        image_format = self.image_format(save_path)
+        image = to_pil(image)
+
+        options = {}
+        if image_format in ("JPEG", "WEBP"):
+            options["quality"] = self.quality
+            if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+
+        with atomic_write(save_path) as file:
+            image.save(file, format=image_format, **options)
+        return save_path
+
+    def submit(self, image, save_path:str, callback:Optional[Callable]=None, span=None) -> Future:
+        """
+        Writes image to save_path on a background thread, blocking while max_pending images are already queued.
+
+        Parameters:
+        - image: A PIL image or a uint8 array/tensor.
+        - save_path: The destination, whose extension selects the format unless the writer has a fixed one.
+        - callback: If provided, called on the writer thread with save_path once the image is written, or None if writing failed.
+        - span: If provided, a context manager entered around the write on the writer thread, e.g., a span of
+          models.instrumentation.
+
+        Return: a Future resolving to save_path (None if writing failed) once the callback has returned.
+        """
+        def task():
+            try:
+                try:
+                    with span if span is not None else contextlib.nullcontext():
+                        result = self.write(image, save_path)
+                except Exception as e:
+                    print(f"Failed to write the image to {save_path}:", repr(e))
+                    result = None
+                if callback is not None:
+                    callback(result)
+                return result
+            finally:
+                self.slots.release()
+
+        self.slots.acquire()
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="image-write")
+            return self.executor.submit(task)
+
+    def close(self):
+        """ Waits for queued images to be written. """
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+
+
+_shared_writer = None
+_shared_writer_lock = threading.Lock()
+
+def get_image_writer() -> ImageWriter:
+    """ Returns the ImageWriter shared by all local image models in this process. """
+    global _shared_writer
+    with _shared_writer_lock:
+        if _shared_writer is None:
+            _shared_writer = ImageWriter()
+        return _shared_writer
@@ -0,0 +1,215 @@
+"""
+This file defines the Tracer class used by the models to record named spans (text encoding, denoising, decoding,
+saving, API calls, downloads, ...) with their wall time and the peak memory of the process when they ended.
+
+Spans are cheap enough to leave on: entering and leaving one costs two clock reads and one getrusage call. Finished
+spans are appended to a JSONL file as they end (if one is set) and folded into per-(model, span) totals, so memory
+stays bounded however long the process runs. The totals can be written as a Prometheus textfile, e.g., for the
+node_exporter textfile collector.
+
+The diffusion wrappers also time every denoising step through the pipeline step callback: a span used as the
+callback records when each step ends, which splits the pipeline call into denoising and decoding time.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+def _cuda_initialized(torch) -> bool:
+    """ Returns True if torch has initialized CUDA. torch may still be importing on another thread, which counts as not. """
+    try:
+        return torch is not None and torch.cuda.is_initialized()
+    except AttributeError: # partially initialized module
+        return False
+
+def _peak_memory_bytes() -> dict:
+    """ Returns the peak RSS of the process and, if CUDA is in use, the peak memory allocated on the current device. """
+    report = {}
+    try:
+        import resource
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        report["peak_rss_bytes"] = max_rss if sys.platform == "darwin" else max_rss * 1024 # bytes on macOS, KB on Linux
+    except ImportError: # Windows
+        pass
+    torch = sys.modules.get("torch") # never imports torch for the API models
+    if _cuda_initialized(torch):
+        report["peak_cuda_bytes"] = torch.cuda.max_memory_allocated()
+    return report
+
+class Span:
+    def __init__(self, tracer, name:str, attributes:dict):
+        """ A timed section of code, created by Tracer.span. """
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.parent = None
+        self.start = None
+        self.step_ends = []
+
+    def __enter__(self):
+        stack = self.tracer._stack()
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        end = time.perf_counter()
+        stack = self.tracer._stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        record = {"name": self.name, "parent": self.parent, "time": time.time() - (end - self.start),
+                  "seconds": end - self.start, **_peak_memory_bytes(), **self.attributes}
+        if exc_type is not None:
+            record["error"] = exc_type.__name__
+        if self.step_ends:
+            steps = [self.start] + self.step_ends
+            record["step_seconds"] = [b - a for a, b in zip(steps, steps[1:])]
+            record["decode_seconds"] = end - self.step_ends[-1] # everything after the last step: decoding, post-processing
+        self.tracer._finish(record)
+        return False
+
+    def step(self, *args):
+        """
+        Records the end of a denoising step. Pass it as the pipeline step callback, either callback_on_step_end=span.step
+        or, for pipelines with the older interface (DeepFloyd IF, text-to-video), callback=span.step.
+
+        Return: the callback_kwargs passed by callback_on_step_end (unchanged), or {}.
+        """
+        if self.tracer.synchronize:
+            torch = sys.modules.get("torch")
+            if _cuda_initialized(torch):
+                torch.cuda.synchronize()
+        self.step_ends.append(time.perf_counter())
+        return args[-1] if args and isinstance(args[-1], dict) else {}
+
+
+class Tracer:
+    def __init__(self, jsonl_path:Optional[str]=None, max_records:int=1000, synchronize:bool=False):
+        """
+        Initializes the tracer.
+
+        Parameters:
+        - jsonl_path: If provided, every finished span is appended to this file as one JSON line.
+        - max_records: The number of most recent spans kept in memory, see records.
+        - synchronize: If True, waits for the accelerator at the end of every denoising step, so step times measure
+          the GPU work rather than the time taken to queue it. Costs a little throughput on CUDA, nothing on CPU.
+        """
+        self.jsonl_path = jsonl_path
+        self.synchronize = synchronize
+        self.recent = deque(maxlen=max_records)
+        self.totals = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.file = None
+        if jsonl_path is not None:
+            os.makedirs(os.path.dirname(jsonl_path) or ".", exist_ok=True)
+            self.file = open(jsonl_path, "a", encoding="utf-8")
+
+    def _stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def span(self, name:str, **attributes) -> Span:
+        """
+        Returns a context manager timing the code it wraps, e.g., `with tracer.span("decode", model="SDXL_Turbo"):`.
+        Spans opened on the same thread nest, and each record names its parent span.
+
+        Parameters:
+        - name: The name of the span, e.g., 'encode_prompt', 'pipeline', 'save', 'api_call'.
+        - attributes: Extra fields recorded with the span. 'model' is used as a label in the Prometheus textfile.
+        """
+        return Span(self, name, attributes)
+
+    def _finish(self, record):
+        key = (str(record.get("model", "")), record["name"])
+        line = json.dumps(record, default=str)
+        with self.lock:
+            self.recent.append(record)
+            total = self.totals.setdefault(key, {"count": 0, "seconds": 0.0, "steps": 0, "step_seconds": 0.0,
+                                                 "errors": 0, "peak_rss_bytes": 0, "peak_cuda_bytes": 0})
+            total["count"] += 1
+            total["seconds"] += record["seconds"]
+            total["steps"] += len(record.get("step_seconds", ()))
+            total["step_seconds"] += sum(record.get("step_seconds", ()))
+            total["errors"] += "error" in record
+            for name in ("peak_rss_bytes", "peak_cuda_bytes"):
+                total[name] = max(total[name], record.get(name, 0))
+            if self.file is not None:
+                self.file.write(line + "\n")
+                self.file.flush()
+
+    def records(self) -> list:
+        """ Returns the most recent finished spans, oldest first. """
+        with self.lock:
+            return list(self.recent)
+
+    def summary(self) -> dict:
+        """ Returns the totals of every (model, span name) pair: count, seconds, steps, step_seconds, errors and peaks. """
+        with self.lock:
+            return {key: dict(total) for key, total in self.totals.items()}
+
+    def prometheus_text(self, prefix:str="t2v") -> str:
+        """ Returns the totals in the Prometheus text exposition format. """
+        metrics = [
+            ("span_seconds", "summary", "Wall time spent in each span.", "seconds", "count"),
+            ("step_seconds", "summary", "Wall time of the denoising steps recorded in each span.", "step_seconds", "steps"),
+            ("span_errors_total", "counter", "Spans that ended with an exception.", "errors", None),
+            ("span_peak_rss_bytes", "gauge", "Peak resident memory of the process when a span ended.", "peak_rss_bytes", None),
+            ("span_peak_cuda_bytes", "gauge", "Peak CUDA memory allocated when a span ended.", "peak_cuda_bytes", None),
+        ]
+        summary = self.summary()
+        lines = []
+        for metric, kind, help, value_key, count_key in metrics:
+            name = f"{prefix}_{metric}"
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+            for (model, span), total in sorted(summary.items()):
+                if (count_key == "steps" or value_key == "peak_cuda_bytes") and not total[value_key]:
+                    continue # spans without denoising steps, or not on CUDA
+                labels = f'{{model="{_escape(model)}",span="{_escape(span)}"}}'
+                if kind == "summary":
+                    lines.append(f"{name}_sum{labels} {total[value_key]}")
+                    lines.append(f"{name}_count{labels} {total[count_key]}")
+                else:
+                    lines.append(f"{name}{labels} {total[value_key]}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path:str, prefix:str="t2v"):
+        """
+        Writes prometheus_text to path atomically, as the node_exporter textfile collector expects.
+        """
+        from .atomic_file import write_file
+        write_file(path, self.prometheus_text(prefix))
+
+    def close(self):
+        """ Closes the JSONL file. Spans finished afterwards are still counted in the totals. """
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+def _escape(value:str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+_shared_tracer = None
+_shared_tracer_lock = threading.Lock()
+
+def get_tracer() -> Tracer:
+    """ Returns the Tracer used by models that were not given their own, which keeps totals but writes no file. """
+    global _shared_tracer
+    with _shared_tracer_lock:
+        if _shared_tracer is None:
+            _shared_tracer = Tracer()
+        return _shared_tracer
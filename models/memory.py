@@ -0,0 +1,93 @@
+"""
+Memory helpers shared by the diffusers wrappers: picking how a pipeline is placed and executed so it fits a memory
+budget, and reporting the peak memory a run actually used.
+
+Strategies, from fastest to most frugal:
+    - full: the whole pipeline on the device.
+    - sliced: the whole pipeline on the device, with attention computed in slices and the VAE decoding one image (and
+      one tile) at a time, which bounds the activation memory of large images and batches.
+    - model_offload: sliced, with each model (text encoder, UNet, VAE) moved to the accelerator only while it runs.
+    - sequential_offload: sliced, with each layer moved to the accelerator only while it runs. Slowest, smallest.
+Offloading needs an accelerator, so on CPU only full and sliced are used.
+"""
+
+import sys
+
+STRATEGIES = ["full", "sliced", "model_offload", "sequential_offload"]
+
+# The weights of a model are assumed to need this much extra room for activations when run unsliced
+ACTIVATION_HEADROOM = 1.5
+
+def component_sizes(pipe) -> dict:
+    """ Returns the bytes taken by the parameters and buffers of each torch module of pipe, by component name. """
+    sizes = {}
+    for name, component in pipe.components.items():
+        if hasattr(component, "parameters") and hasattr(component, "buffers"):
+            tensors = list(component.parameters()) + list(component.buffers())
+            sizes[name] = sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+    return sizes
+
+def choose_strategy(pipes:list, device, memory_budget:float) -> str:
+    """
+    Returns the fastest strategy expected to run pipes within memory_budget GB on device.
+
+    Parameters:
+    - pipes: The diffusers pipelines of the model, e.g., both DeepFloyd stages.
+    - device: The device the model runs on.
+    - memory_budget: The memory available to the model in GB: device memory on an accelerator, RAM on CPU.
+    """
+    budget = memory_budget * 1024**3
+    sizes = [size for pipe in pipes for size in component_sizes(pipe).values()]
+    total = sum(sizes)
+
+    if total * ACTIVATION_HEADROOM <= budget:
+        return "full"
+    if str(device).startswith("cpu") and total > budget:
+        print(f"Warning: the model weights alone take {total / 1024**3:.1f} GB, more than the {memory_budget} GB budget.")
+    if total <= budget or str(device).startswith("cpu"):
+        return "sliced"
+    if max(sizes, default=0) * ACTIVATION_HEADROOM <= budget:
+        return "model_offload"
+    return "sequential_offload"
+
+def apply_strategy(pipe, device, strategy:str):
+    """ Places pipe on device and enables the memory savings of strategy, see STRATEGIES. """
+    assert strategy in STRATEGIES, f"strategy must be one of {STRATEGIES}"
+    if strategy == "model_offload":
+        pipe.enable_model_cpu_offload(device=device)
+    elif strategy == "sequential_offload":
+        pipe.enable_sequential_cpu_offload(device=device)
+    elif not str(device).startswith("cpu"):
+        pipe.to(device)
+
+    if strategy != "full":
+        if hasattr(pipe, "enable_attention_slicing"):
+            pipe.enable_attention_slicing()
+        vae = getattr(pipe, "vae", None)
+        if vae is not None and hasattr(vae, "enable_slicing"):
+            vae.enable_slicing()
+        if vae is not None and hasattr(vae, "enable_tiling"):
+            vae.enable_tiling()
+
+def reset_peak_memory(device=None):
+    """ Resets the accelerator peak memory counter, so peak_memory reports the peak of what runs next. """
+    if device is not None and str(device).startswith("cuda"):
+        import torch
+        torch.cuda.reset_peak_memory_stats(device)
+
+def peak_memory(device=None) -> dict:
+    """
+    Returns the peak memory used by this process in GB: 'rss' for RAM (over the whole process lifetime), plus 'cuda'
+    for the memory allocated on device since the last reset_peak_memory.
+    """
+    report = {}
+    try:
+        import resource
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        report["rss"] = max_rss / 1024**3 if sys.platform == "darwin" else max_rss / 1024**2 # bytes on macOS, KB on Linux
+    except ImportError: # Windows
+        pass
+    if device is not None and str(device).startswith("cuda"):
+        import torch
+        report["cuda"] = torch.cuda.max_memory_allocated(device) / 1024**3
+    return report
@@ -0,0 +1,98 @@
+"""
+This file defines the OutputCache class, a content-addressed store of generated images and videos shared by the
+generation drivers, so the same request is never generated twice, whatever its prompt id, prompt file or run.
+
+Outputs are keyed on a hash of the request that produced them: the model identity (class, model id, version, see
+BaseModel.cache_identity), the prompt, the seed, the generation parameters and the file extension. A cached output is
+hardlinked into the requested path, or copied when the cache is on another filesystem. Outputs are always replaced
+as new files rather than modified in place, so a hardlinked copy never changes the cached one.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+from typing import Optional
+
+from .atomic_file import atomic_path
+
+TRANSFORMERS_CACHE = os.getenv("TRANSFORMERS_CACHE")
+
+def default_cache_dir():
+    """ Returns $OUTPUT_CACHE_DIR, or a generated_outputs folder in $TRANSFORMERS_CACHE (~/.cache by default). """
+    return os.getenv("OUTPUT_CACHE_DIR") or os.path.join(TRANSFORMERS_CACHE or os.path.expanduser("~/.cache"), "generated_outputs")
+
+class OutputCache:
+    def __init__(self, cache_dir:Optional[str]=None, link:bool=True):
+        """
+        Initializes the cache.
+
+        Parameters:
+        - cache_dir: The directory holding the cached outputs. Defaults to default_cache_dir().
+        - link: If True, outputs are hardlinked between the cache and the output folders when both are on the same
+          filesystem. If False, they are always copied.
+        """
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.link = link
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(identity:dict, prompt:str, seed=None, params:Optional[dict]=None, extension:str="") -> str:
+        """
+        Returns the key of a request.
+
+        Parameters:
+        - identity: The model identity, see BaseModel.cache_identity.
+        - prompt: The text prompt.
+        - seed: The seed of the sample, or None for the model's default randomness.
+        - params: The generation parameters passed to the model, e.g., num_inference_steps.
+        - extension: The extension of the output file, e.g., '.jpeg', which selects its format.
+        """
+        request = {"identity": identity, "prompt": prompt, "seed": seed, "params": params or {}, "extension": extension.lower()}
+        return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def path(self, key:str, extension:str) -> str:
+        """ Returns where the output of key is stored. """
+        return os.path.join(self.cache_dir, key[:2], key + extension.lower())
+
+    def contains(self, key:str, extension:str) -> bool:
+        return os.path.exists(self.path(key, extension))
+
+    def _place(self, source_path, destination_path):
+        """ Hardlinks (or copies) source_path to destination_path atomically, replacing any existing file. """
+        with atomic_path(destination_path) as tmp_path:
+            try:
+                if not self.link:
+                    raise OSError("linking disabled")
+                os.remove(tmp_path) # os.link needs a free name
+                os.link(source_path, tmp_path)
+            except OSError: # other filesystem, or links not supported
+                shutil.copyfile(source_path, tmp_path)
+
+    def fetch(self, keys:list, save_paths:list) -> bool:
+        """
+        Places the cached outputs of keys at save_paths if all of them are cached, e.g., every sample of a prompt.
+
+        Return: True on a hit, False if any output is missing (nothing is placed then).
+        """
+        cached_paths = [self.path(key, os.path.splitext(save_path)[1]) for key, save_path in zip(keys, save_paths)]
+        if not all(os.path.exists(cached_path) for cached_path in cached_paths):
+            with self.lock:
+                self.misses += 1
+            return False
+        for cached_path, save_path in zip(cached_paths, save_paths):
+            if not (os.path.exists(save_path) and os.path.samefile(cached_path, save_path)):
+                self._place(cached_path, save_path)
+        with self.lock:
+            self.hits += 1
+        return True
+
+    def store(self, keys:list, save_paths:list):
+        """ Adds the outputs at save_paths to the cache under keys. Outputs already cached are kept. """
+        for key, save_path in zip(keys, save_paths):
+            cached_path = self.path(key, os.path.splitext(save_path)[1])
+            if not os.path.exists(cached_path) and os.path.exists(save_path):
+                self._place(save_path, cached_path)
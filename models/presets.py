@@ -0,0 +1,49 @@
+"""
+Latency/quality presets of the diffusers wrappers.
+
+Every wrapper defines a PRESETS dict mapping the preset names below to its settings, and a DEFAULT_PRESET that
+reproduces the settings it used before presets existed. The settings of a preset are:
+    - scheduler: The name of the diffusers scheduler class swapped into the pipeline, e.g., 'DPMSolverMultistepScheduler',
+      or None for the scheduler the checkpoint ships with.
+    - num_inference_steps, guidance_scale: The defaults of generate and generate_images.
+    - torch_dtype, variant: The dtype the weights are loaded in, e.g., 'float16', and the checkpoint variant downloaded,
+      e.g., 'fp16', or None for the full precision files.
+Wrappers with several stages may add settings of their own, e.g., stage_2_num_inference_steps for DeepFloyd.
+
+The resolved settings are part of BaseModel.cache_identity and the preset name is recorded in the log.json entry of
+every prompt, so outputs of different presets are never mixed up.
+"""
+
+from typing import Optional
+
+PRESET_NAMES = ("draft", "balanced", "full")
+
+def resolve_preset(presets:dict, name:str, **overrides) -> dict:
+    """
+    Returns a copy of the settings of preset name in presets.
+
+    Parameters:
+    - presets: The PRESETS of a model class.
+    - name: One of PRESET_NAMES.
+    - overrides: Settings that replace those of the preset when they are not None, e.g., the torch_dtype and variant
+      passed to the model's __init__. torch dtypes are stored by name, e.g., torch.float32 as 'float32'.
+    """
+    if name not in presets:
+        raise ValueError(f"Unknown preset {name}. Choose from {list(presets)}.")
+    settings = dict(presets[name])
+    for key, value in overrides.items():
+        if value is not None:
+            settings[key] = str(value).replace("torch.", "") if key == "torch_dtype" else value
+    return settings
+
+def torch_dtype(settings:dict):
+    """ Returns the torch dtype named by settings['torch_dtype']. """
+    import torch
+    return getattr(torch, settings["torch_dtype"])
+
+def set_scheduler(pipe, scheduler:Optional[str]):
+    """ Replaces the scheduler of pipe with a new instance of the diffusers class named scheduler, keeping its config. """
+    if scheduler is None or type(pipe.scheduler).__name__ == scheduler:
+        return
+    import diffusers
+    pipe.scheduler = getattr(diffusers, scheduler).from_config(pipe.scheduler.config)
@@ -0,0 +1,66 @@
+"""
+This file contains helpers shared by the API models to stay under provider rate limits:
+a thread-safe token bucket and a retry-after-aware backoff schedule.
+"""
+
+import random
+import threading
+import time
+from typing import Optional
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+class TokenBucket:
+    def __init__(self, requests_per_minute:float, burst:Optional[int]=None):
+        """
+        Initializes a token bucket that refills at requests_per_minute.
+
+        Parameters:
+        - requests_per_minute: The sustained number of requests allowed per minute.
+        - burst: The maximum number of requests that can be made back to back. Defaults to 1.
+        """
+        assert requests_per_minute > 0, "requests_per_minute must be positive."
+        self.rate = requests_per_minute / 60.0
+        self.capacity = burst if burst is not None else 1
+        self.tokens = float(self.capacity)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Blocks until a token is available and consumes it. """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def retry_after_seconds(headers) -> Optional[float]:
+    """
+    Returns the delay requested by the server through the 'retry-after-ms' or 'retry-after' headers, or None.
+    Only the delta-seconds form of 'retry-after' is supported.
+    """
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers.get("retry-after-ms")) / 1000
+        if headers.get("retry-after") is not None:
+            return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        pass
+    return None
+
+def backoff_delay(attempt:int, retry_after:Optional[float]=None, base_delay:float=1.0, max_delay:float=60.0) -> float:
+    """
+    Returns how long to wait before retry number attempt (starting at 0).
+
+    The server-provided retry_after takes precedence; otherwise the delay grows exponentially with full jitter.
+    """
+    if retry_after is not None:
+        return min(max(retry_after, 0.0), max_delay)
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
@@ -0,0 +1,37 @@
+"""
+Helpers shared by the local wrappers to draw several reproducible samples per prompt in one pipeline call.
+
+Every sample gets its own torch.Generator seeded with its seed, so a (prompt, seed) pair gives the same output
+whatever else is in the batch. Generators live on the CPU, so a seed gives the same initial noise on every device.
+"""
+
+import os
+from typing import Optional
+
+def resolve_seeds(seeds:Optional[list]=None, num_samples:int=1) -> Optional[list]:
+    """
+    Returns the list of per-sample seeds, or None for a single unseeded sample (the pipelines' own randomness).
+    seeds takes precedence over num_samples; num_samples alone uses the seeds 0, 1, ..., num_samples - 1.
+    """
+    if seeds is not None:
+        seeds = list(seeds)
+        if not seeds:
+            raise ValueError("seeds must not be empty.")
+        return seeds
+    if num_samples < 1:
+        raise ValueError("num_samples must be at least 1.")
+    return list(range(num_samples)) if num_samples > 1 else None
+
+def sample_generators(seeds:Optional[list], num_prompts:int):
+    """ Returns one generator per (prompt, seed) in prompt-major order, the order of num_images_per_prompt outputs. """
+    if seeds is None:
+        return None
+    import torch
+    return [torch.Generator("cpu").manual_seed(int(seed)) for _ in range(num_prompts) for seed in seeds]
+
+def sample_filenames(filename:str, num_samples:int) -> list:
+    """ Returns ['{stem}_0{ext}', '{stem}_1{ext}', ...] for several samples, or [filename] for one. """
+    if num_samples == 1:
+        return [filename]
+    stem, extension = os.path.splitext(filename)
+    return [f"{stem}_{k}{extension}" for k in range(num_samples)]
@@ -1,26 +1,30 @@
-from .dalle import DALLE
-from .deepfloyd_i_xl_v1 import DeepFloyd_I_XL_v1
-from .midjourney import Midjourney
-from .sdxl_2_1 import SDXL_2_1
-from .sdxl_base import SDXL_Base
-from .sdxl_turbo import SDXL_Turbo
+import importlib
 
+# Model name -> module defining it. Modules are only imported when their model is requested, so e.g. an API-only
+# worker using DALLE or Midjourney does not load torch, diffusers and transformers.
+_MODEL_MODULES = {
+    "DALLE": ".dalle",
+    "DeepFloyd_I_XL_v1": ".deepfloyd_i_xl_v1",
+    "Midjourney": ".midjourney",
+    "SDXL_2_1": ".sdxl_2_1",
+    "SDXL_Base": ".sdxl_base",
+    "SDXL_Turbo": ".sdxl_turbo",
+}
 
-ALL_MODELS = [
-    DALLE,
-    DeepFloyd_I_XL_v1,
-    Midjourney,
-    SDXL_2_1,
-    SDXL_Base,
-    SDXL_Turbo
-]
-
-ALL_MODEL_NAMES = [model.__name__ for model in ALL_MODELS]
+ALL_MODEL_NAMES = list(_MODEL_MODULES)
 
 def print_all_model_names():
     print("ALL_MODEL_NAMES:", ALL_MODEL_NAMES)
 
 def get_model_class(model_name):
-    """ Returns the model class corresponding to the provided model_name. """
+    """ Returns the model class corresponding to the provided model_name, importing its module on first use. """
     assert model_name in ALL_MODEL_NAMES, f"model_name must be one of {ALL_MODEL_NAMES}"
-    return ALL_MODELS[ALL_MODEL_NAMES.index(model_name)]
\ No newline at end of file
+    return getattr(importlib.import_module(_MODEL_MODULES[model_name], __name__), model_name)
+
+def __getattr__(name):
+    # Keeps `from models.t2image import SDXL_Turbo` and ALL_MODELS working; both import the backends they need.
+    if name in _MODEL_MODULES:
+        return get_model_class(name)
+    if name == "ALL_MODELS":
+        return [get_model_class(model_name) for model_name in ALL_MODEL_NAMES]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,15 +1,29 @@
 """
 This file defines the Dalle class, which integrates with OpenAI's DALL-E API to generate images based on text prompts.
+
+With response_format='b64_json', images are returned inline in the API response and decoded straight to disk (or to
+an in-memory image), without a second request to the image CDN. Every image of a call with n > 1 is kept, saved as
+'{id}_{k}' like the samples of the local models.
 """
 
+import base64
+import io
 from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import openai
 from openai import OpenAI
 from ..base_model import BaseModel
+from ..atomic_file import write_file
+from ..downloader import get_downloader
+from ..sampling import sample_filenames
+from ..rate_limit import TokenBucket, RETRYABLE_STATUS_CODES, backoff_delay, retry_after_seconds
 import os
-import requests 
+import time
 
 class DALLE(BaseModel):
-    def __init__(self, openai_api_key:str, version:int, usr_provided_prompt:Optional[str]=None):
+    def __init__(self, openai_api_key:str, version:int, usr_provided_prompt:Optional[str]=None,
+                 base_url:Optional[str]=None, requests_per_minute:Optional[float]=None, max_retries:int=5,
+                 response_format:str="url", size:str="1024x1024", quality:str="standard"):
         """
         Initializes the DALLE class with the provided OpenAI API key, version, and an optional user-provided prompt.
         
@@ -17,14 +31,27 @@ class DALLE(BaseModel):
         - openai_api_key: The API key to be used for the OpenAI API.
         - version: The version of DALL-E to be used. Must be 2 or 3.
         - usr_provided_prompt: If provided, it will be used as the prompt for the generation, excluding sample specific caption.
+        - base_url: If provided, API calls are sent to this URL instead of the OpenAI API, e.g., a local fake endpoint.
+        - requests_per_minute: If provided, concurrent generation is throttled to this many API calls per minute.
+        - max_retries: The number of times a concurrent API call is retried on 429/5xx and connection errors.
+        - response_format: 'url' to download each image from the returned URL, or 'b64_json' to receive it inline.
+        - size, quality: The defaults of the size and quality of API calls, e.g., '1792x1024' and 'hd' (DALL-E 3 only).
         """
 
         if version == 3 or version == 2: 
             self.version = version
         else:
             raise ValueError("Version must be 2 or 3.")
+        if response_format not in ("url", "b64_json"):
+            raise ValueError("response_format must be 'url' or 'b64_json'.")
+        self.response_format = response_format
+        self.size = size
+        self.quality = quality
 
-        self.client = OpenAI(api_key=openai_api_key) 
+        self.base_url = base_url
+        self.client = OpenAI(api_key=openai_api_key, base_url=base_url) 
+        self.rate_limiter = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.max_retries = max_retries
 
         # Setting up the prompt
         if usr_provided_prompt:
@@ -52,6 +79,12 @@ class DALLE(BaseModel):
         """
         return self.prompt + text_prompt
 
+    def cache_identity(self):
+        """ Returns the model version, the prompt prepended to every text prompt and the default request settings, see
+        BaseModel.cache_identity. Settings passed to a single call, e.g., n, are part of the cache key instead. """
+        return {"model": "DALLE", "version": self.version, "prompt": self.prompt, "size": self.size,
+                "quality": self.quality, "response_format": self.response_format}
+
     def reset_api_key(self, new_api_key):
         """
         Resets the OpenAI API key for the DALLE class.
@@ -59,29 +92,128 @@ class DALLE(BaseModel):
         Parameters:
         - new_api_key: The new API key to be set.
         """
-        self.client = OpenAI(api_key=new_api_key)
+        self.client = OpenAI(api_key=new_api_key, base_url=self.base_url)
 
-    def _call_dalle_api_helper(self, prompt, **kwargs):
+    def _call_dalle_api_helper(self, prompt, client=None, **kwargs):
         """
         Helper function to call the DALL-E API with the provided prompt and additional arguments.
         
         Parameters:
         - prompt: The prompt to be used for the API call.
+        - client: The OpenAI client to use. Defaults to self.client.
         - kwargs: Additional arguments to be passed to the API call, e.g., size, quality, n.
         """
+        client = client if client is not None else self.client
         # Setting default values
-        size = kwargs.get("size", "1024x1024")
-        quality = kwargs.get("quality", "standard")
+        size = kwargs.get("size", self.size)
+        quality = kwargs.get("quality", self.quality)
         n = kwargs.get("n", 1)
+        if self.version == 3 and n != 1:
+            raise ValueError("DALL-E 3 only generates n=1 image per call.")
         
-        response = self.client.images.generate(
-            model=f"dall-e-{self.version}",
-            prompt=prompt,
-            size=size,
-            quality=quality,
-            n=n,
-        )
+        with self.span("api_call", n=n):
+            response = client.images.generate(
+                model=f"dall-e-{self.version}",
+                prompt=prompt,
+                size=size,
+                quality=quality,
+                n=n,
+                response_format=self.response_format,
+            )
         return response
+
+    def _call_dalle_api_with_retry(self, prompt, **kwargs):
+        """
+        Calls the DALL-E API like _call_dalle_api_helper, waiting for the rate limiter before every attempt and
+        retrying 429/5xx and connection errors with backoff. A 'retry-after' header sent by the server takes
+        precedence over the exponential backoff.
+        """
+        client = self.client.with_options(max_retries=0) # retries are handled here
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            try:
+                return self._call_dalle_api_helper(prompt, client=client, **kwargs)
+            except openai.APIStatusError as e:
+                if e.status_code not in RETRYABLE_STATUS_CODES or attempt == self.max_retries:
+                    raise
+                delay = backoff_delay(attempt, retry_after_seconds(e.response.headers))
+                print(f"DALL-E API returned {e.status_code}. Retrying in {delay:.1f} seconds...")
+            except openai.APIConnectionError:
+                if attempt == self.max_retries:
+                    raise
+                delay = backoff_delay(attempt)
+                print(f"DALL-E API connection error. Retrying in {delay:.1f} seconds...")
+            time.sleep(delay)
+
+    def _generate_job(self, prompt_id, text_prompt, folder_path, filename, **kwargs):
+        """ Generates and downloads the image for one prompt of generate_concurrent. """
+        prompt = self.get_dalle_prompt(text_prompt)
+        try:
+            dalle_response = self._call_dalle_api_with_retry(prompt, **kwargs)
+        except openai.OpenAIError as e:
+            print(f"Error occurred for prompt {prompt_id}:", e)
+            return prompt_id, None
+
+        if 'errors' in vars(dalle_response).keys():
+            print(f"Error occurred for prompt {prompt_id}. Response:", dalle_response)
+            return prompt_id, None
+
+        save_paths = self.save_response(dalle_response, folder_path, filename)
+        return prompt_id, save_paths[0] if len(save_paths) == 1 else save_paths
+
+    def generate_concurrent(self, jobs, folder_path:str="./", max_workers:int=8, **kwargs):
+        """
+        Generates and downloads images for many prompts with a bounded thread pool.
+
+        API calls are throttled by the requests_per_minute token bucket and retried on 429/5xx with
+        retry-after-aware backoff. Results are yielded as soon as each prompt finishes, so they arrive
+        out of order and are tagged with their prompt id.
+
+        Parameters:
+        - jobs: An iterable of (prompt_id, text_prompt, filename) tuples.
+        - folder_path: The folder path where the images will be downloaded.
+        - max_workers: The maximum number of prompts in flight at once.
+        - kwargs: Additional arguments to be passed to the API call, e.g., size, quality, n.
+
+        Yields:
+        - (prompt_id, save_path) tuples, with save_path None if the prompt failed. With n > 1, save_path is the list
+          of the '{id}_{k}' paths of the n images.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self._generate_job, prompt_id, text_prompt, folder_path, filename, **kwargs)
+                       for prompt_id, text_prompt, filename in jobs]
+            for future in as_completed(futures):
+                yield future.result()
+
+    def generate_batch(self, text_prompts:list, filenames:list, folder_path:str="./", batch_size:int=8, callback=None, **kwargs):
+        """
+        Generates images for a list of prompts concurrently, skipping prompts whose images already exist.
+        batch_size is the number of concurrent API calls, see generate_concurrent. If provided, callback(index, save_path)
+        is called as each prompt finishes. With n > 1 in kwargs, each prompt's save_path is the list of its n images.
+
+        @returns a list of save paths aligned with text_prompts, with None for prompts that failed.
+        """
+        assert len(text_prompts) == len(filenames), "text_prompts and filenames must have the same length."
+        os.makedirs(folder_path, exist_ok=True)
+        n = kwargs.get("n", 1)
+        if self.version == 3 and n != 1:
+            raise ValueError("DALL-E 3 only generates n=1 image per call.")
+        save_paths = [None] * len(text_prompts)
+        jobs = []
+        for i, (text_prompt, filename) in enumerate(zip(text_prompts, filenames)):
+            existing_paths = [os.path.join(folder_path, name) for name in sample_filenames(filename, n)]
+            if all(os.path.exists(save_path) for save_path in existing_paths):
+                print(f"Image already exists at {existing_paths[0]}")
+                save_paths[i] = existing_paths[0] if n == 1 else existing_paths
+            else:
+                jobs.append((i, text_prompt, filename))
+
+        for i, save_path in self.generate_concurrent(jobs, folder_path=folder_path, max_workers=batch_size, **kwargs):
+            save_paths[i] = save_path
+            if callback is not None:
+                callback(i, save_path)
+        return save_paths
     
     def generate(self, text_prompt:str, folder_path:str="./", filename:str="dalle-image.jpeg", download:bool=True, **kwargs):
         """ 
@@ -95,7 +227,8 @@ class DALLE(BaseModel):
         - kwargs: Additional arguments to be passed to the API call, e.g., size, quality, n.
         
         Returns:
-        - The URL of the generated image, or None if an error occurred.
+        - The save path of the generated image if download is True, else its URL, or the decoded PIL image with
+          response_format='b64_json'. None if an error occurred. With n > 1, a list with one item per image.
         """
         # Validating parameters for download
         if download:
@@ -111,38 +244,63 @@ class DALLE(BaseModel):
             print("Error occurred. Response:", dalle_response)
             return None
 
-        image_url = dalle_response.data[0].url
-
         if download:
-            return self.download_image(image_url, folder_path, filename)
-        else:   
-            print(f"Generated image: {image_url}")
-            return image_url
+            save_paths = self.save_response(dalle_response, folder_path, filename)
+            return save_paths[0] if len(save_paths) == 1 else save_paths
+
+        results = []
+        for image in dalle_response.data:
+            if image.b64_json is not None:
+                results.append(self.decode_image(image.b64_json))
+            else:
+                print(f"Generated image: {image.url}")
+                results.append(image.url)
+        return results[0] if len(results) == 1 else results
+
+    def save_response(self, dalle_response, folder_path:str, filename:str) -> list:
+        """
+        Saves every image of dalle_response: inline images are decoded to disk, the others are downloaded concurrently.
+        A single image is saved as filename, n images as '{stem}_{k}{ext}'.
+
+        Return: The list of save paths, with None for images that failed to download.
+        """
+        filenames = sample_filenames(filename, len(dalle_response.data))
+        save_paths = [None] * len(filenames)
+        downloads = {}
+        for k, (image, image_filename) in enumerate(zip(dalle_response.data, filenames)):
+            if image.b64_json is not None:
+                with self.span("decode"):
+                    save_paths[k] = write_file(os.path.join(folder_path, image_filename), base64.b64decode(image.b64_json))
+            elif len(filenames) == 1:
+                save_paths[k] = self.download_image(image.url, folder_path, image_filename)
+            else:
+                downloads[k] = self.download_image(image.url, folder_path, image_filename, background=True)
+        for k, download in downloads.items():
+            save_paths[k] = download.result()
+        return save_paths
+
+    def decode_image(self, b64_json:str):
+        """ Returns the PIL image of an inline (b64_json) result, decoded in memory. """
+        from PIL import Image
+        with self.span("decode"):
+            image = Image.open(io.BytesIO(base64.b64decode(b64_json)))
+            image.load()
+        return image
     
 
     
-    def download_image(self, image_url:str, folder_path:str, filename:str):
+    def download_image(self, image_url:str, folder_path:str, filename:str, background:bool=False):
         """
-        Downloads an image from a given URL to a specified file path.
+        Downloads an image from a given URL to a specified file path with the shared pooled downloader.
         
         Parameters:
         - image_url: URL of the image to download.
         - folder_path: The folder path where the image will be saved.
         - filename: The name of the file to save the image as.
+        - background: If True, the download runs on a background thread and a Future resolving to the save path is returned.
         """
-        # Checking if the folder exists, if not, create it
-        if not os.path.exists(folder_path):
-            os.makedirs(folder_path)
-
         save_path = os.path.join(folder_path, filename)
-        
-        response = requests.get(image_url) # Sending a GET request to the image URL
-
-        # Saving the image if the request was successful
-        if response.status_code == 200:
-            with open(save_path, 'wb') as file:
-                file.write(response.content)
-            return save_path
-        else:
-            print(f"Failed to download the image. Status code: {response.status_code}")
-            return None
+        if background:
+            return get_downloader().submit(image_url, save_path, span=self.span("download"))
+        with self.span("download"):
+            return get_downloader().download(image_url, save_path)
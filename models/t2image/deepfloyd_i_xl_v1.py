@@ -5,11 +5,17 @@ DeepFloyd-I-XL-v1 model, a part of the Hugging Face Diffusers library.
 To access this model, you need to be authenticated, please visit https://huggingface.co/DeepFloyd/IF-I-XL-v1.0 for instructions to authenticate and access the gated model.
 """
 
+import contextlib
 import os
+import queue
+import threading
 import torch
 from diffusers import DiffusionPipeline
-from diffusers.utils import pt_to_pil
 from ..base_model import BaseModel
+from .. import memory, presets
+from ..image_writer import get_image_writer
+from ..sampling import resolve_seeds, sample_generators, sample_filenames
+from ..embedding_cache import EmbeddingCache, encode_if_prompts
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -21,21 +27,59 @@ class DeepFloyd_I_XL_v1(BaseModel):
     This class leverages pre-trained models from Hugging Face's Diffusers library.
     """
 
-    def __init__(self, device: str):
+    # See models.presets. Settings prefixed with 'stage_2_' apply to stage 2. timesteps names one of the step schedules
+    # DeepFloyd tuned for its DDPM scheduler (e.g., 'fast27' is diffusers.pipelines.deepfloyd_if.fast27_timesteps), run
+    # instead of num_inference_steps evenly spaced steps.
+    PRESETS = {
+        "draft": {"scheduler": None, "num_inference_steps": 27, "timesteps": "fast27", "guidance_scale": 7.0,
+                  "stage_2_num_inference_steps": 27, "stage_2_timesteps": "super27", "stage_2_guidance_scale": 4.0,
+                  "torch_dtype": "float16", "variant": "fp16"},
+        "balanced": {"scheduler": None, "num_inference_steps": 50, "timesteps": "smart50", "guidance_scale": 7.0,
+                     "stage_2_num_inference_steps": 27, "stage_2_timesteps": "super27", "stage_2_guidance_scale": 4.0,
+                     "torch_dtype": "float16", "variant": "fp16"},
+        "full": {"scheduler": None, "num_inference_steps": 100, "timesteps": None, "guidance_scale": 7.0,
+                 "stage_2_num_inference_steps": 50, "stage_2_timesteps": None, "stage_2_guidance_scale": 4.0,
+                 "torch_dtype": "float16", "variant": "fp16"},
+    }
+    DEFAULT_PRESET = "full"
+
+    def __init__(self, device: str, embedding_cache=None, memory_budget=None, stage_2_device=None, pipelined=False,
+                 queue_size=2, accelerate=False, warmup_batch_sizes=(1,), preset=None, torch_dtype=None, variant=None):
         """
         Initializes the model pipeline components and configures them for the specified device.
         
         Parameters
         - device: The computing device ('cpu' or 'cuda') the model should run on. It determines whether to use GPU acceleration if available.
+        - embedding_cache: The EmbeddingCache used to reuse T5 prompt embeddings across calls and runs. Defaults to a new EmbeddingCache().
+        - memory_budget: If provided, the memory in GB both stages must fit in (device memory, or RAM on CPU). Attention and
+          VAE slicing/tiling and model or sequential CPU offload are enabled as needed, see models.memory. With
+          stage_2_device, each stage must fit in memory_budget GB on its own device.
+        - stage_2_device: If provided, the device stage 2 runs on, e.g., 'cuda:1' with device 'cuda:0'. Defaults to device.
+        - pipelined: If True, generate_batch runs stage 1 on the next micro-batch while stage 2 refines the current one,
+          see generate_image_batches. Most useful with stage_2_device.
+        - queue_size: The number of stage 1 micro-batches that may wait for stage 2 in pipelined mode.
+        - accelerate: If True, the UNet and VAE decoder are compiled with torch.compile and use channels_last and fused
+          attention, see models.acceleration. Compiled kernels are cached on disk for later runs.
+        - warmup_batch_sizes: With accelerate, the batch sizes generated once at load time so they are compiled
+          before the first prompts, e.g., (1, 4) for generate_batch with batch_size=4.
+        - preset: The latency/quality preset, 'draft', 'balanced' or 'full' (the default), choosing the step schedule
+          and guidance scale of both stages, and the dtype and variant unless given. See PRESETS.
+        - torch_dtype, variant: The torch data type and the variant of the weights of both stages. Default to the
+          preset's (torch.float16 and 'fp16').
         """
         super().__init__()  # Initialize base class
+        self.model_id = "DeepFloyd/IF-I-XL-v1.0"
+        self.embedding_cache = embedding_cache if embedding_cache is not None else EmbeddingCache()
+        self.pipelined = pipelined
+        self.queue_size = queue_size
+        settings = self.select_preset(preset, torch_dtype=torch_dtype, variant=variant)
         
         print("Loading DeepFloyd-I-XL-v1 model...")
         # Stage 1 model initialization
         self.stage_1 = DiffusionPipeline.from_pretrained(
-            "DeepFloyd/IF-I-XL-v1.0",
-            variant="fp16",
-            torch_dtype=torch.float16,
+            self.model_id,
+            variant=settings["variant"],
+            torch_dtype=presets.torch_dtype(settings),
             cache_dir=os.getenv("TRANSFORMERS_CACHE")
         )
 
@@ -43,22 +87,180 @@ class DeepFloyd_I_XL_v1(BaseModel):
         self.stage_2 = DiffusionPipeline.from_pretrained(
             "DeepFloyd/IF-II-L-v1.0",
             text_encoder=None,
-            variant="fp16",
-            torch_dtype=torch.float16,
+            variant=settings["variant"],
+            torch_dtype=presets.torch_dtype(settings),
             cache_dir=TRANSFORMERS_CACHE
         )
+        presets.set_scheduler(self.stage_1, settings["scheduler"])
+        presets.set_scheduler(self.stage_2, settings["scheduler"])
 
         # Device configuration
-        if device == "cpu":
+        if stage_2_device is not None and str(stage_2_device) != str(device):
+            self.device = device
+            self.place_stage(self.stage_1, device, memory_budget)
+            self.place_stage(self.stage_2, stage_2_device, memory_budget)
+        elif memory_budget is not None:
+            self.apply_memory_budget([self.stage_1, self.stage_2], device, memory_budget)
+        elif device == "cpu":
             self.stage_1.enable_model_cpu_offload()
             self.stage_2.enable_model_cpu_offload()
         else:
             self.stage_1.to(device)
             self.stage_2.to(device)
+
+        if accelerate:
+            self.apply_acceleration([self.stage_1, self.stage_2], warmup_batch_sizes)
         
         print("Finished loading models.")
 
-    def generate(self, text_prompt, seed=0, folder_path=None, filename=None, noise_level=100):
+    def place_stage(self, pipe, device, memory_budget=None):
+        """ Places one stage on its own device, fitted in memory_budget GB if provided. """
+        if memory_budget is not None:
+            strategy = memory.choose_strategy([pipe], device, memory_budget)
+            print(f"Fitting {type(pipe).__name__} in {memory_budget} GB on {device} with the '{strategy}' strategy.")
+            memory.apply_strategy(pipe, device, strategy)
+            memory.reset_peak_memory(device)
+        elif str(device) != "cpu":
+            pipe.to(device)
+
+    def step_arguments(self, prefix=""):
+        """ Returns the num_inference_steps (or timesteps) and guidance_scale arguments of a stage, from the preset
+        settings starting with prefix, e.g., 'stage_2_'. """
+        settings = {key[len(prefix):]: value for key, value in self.preset_settings.items() if key.startswith(prefix)}
+        if settings["timesteps"] is not None:
+            from diffusers.pipelines import deepfloyd_if
+            return {"timesteps": getattr(deepfloyd_if, f"{settings['timesteps']}_timesteps"), "guidance_scale": settings["guidance_scale"]}
+        return {"num_inference_steps": settings["num_inference_steps"], "guidance_scale": settings["guidance_scale"]}
+
+    def run_stage_1(self, text_prompts, seed=0, seeds=None, num_samples=1):
+        """
+        Runs stage 1 on text_prompts.
+
+        Return: a dict of the 64px images and everything stage 2 needs to refine them, see run_stage_2.
+        """
+        seeds = resolve_seeds(seeds, num_samples)
+        num_images_per_prompt = len(seeds) if seeds else 1
+
+        # Reuse the cached T5 embeddings of prompts that were encoded before
+        with self.span("encode_prompt", prompts=len(text_prompts)):
+            embeds = encode_if_prompts(self.embedding_cache, self.model_id, self.stage_1, list(text_prompts))
+        prompt_embeds, negative_embeds = embeds["prompt_embeds"], embeds["negative_prompt_embeds"]
+        # One generator per prompt, seeded like a single-prompt call, so a prompt's noise does not depend on the other
+        # prompts of its micro-batch. Never torch.manual_seed's global generator, which other threads may draw from
+        generator = sample_generators(seeds or [seed], len(text_prompts))
+
+        # Initial image generation with stage 1
+        with self.span("stage_1", prompts=len(text_prompts)) as span:
+            image = self.stage_1(
+                prompt_embeds=prompt_embeds, 
+                negative_prompt_embeds=negative_embeds, 
+                num_images_per_prompt=num_images_per_prompt,
+                generator=generator, 
+                output_type="pt",
+                callback=span.step, # records the end of every denoising step
+                **self.step_arguments()
+            ).images
+
+        # One embedding per stage 1 sample, on the device of stage 2
+        stage_2_device = self.stage_2._execution_device
+        return {
+            "image": image.to(stage_2_device, non_blocking=True),
+            "prompt_embeds": prompt_embeds.repeat_interleave(num_images_per_prompt, dim=0).to(stage_2_device, non_blocking=True),
+            "negative_prompt_embeds": negative_embeds.repeat_interleave(num_images_per_prompt, dim=0).to(stage_2_device, non_blocking=True),
+            "generator": generator,
+        }
+
+    def run_stage_2(self, stage_1_output):
+        """
+        Refines the output of run_stage_1 with stage 2.
+
+        Return: a list of uint8 (H, W, C) tensors, left on the device so the conversion to PIL happens on the image
+        writer threads.
+        """
+        with self.span("stage_2", prompts=len(stage_1_output["image"])) as span:
+            image = self.stage_2(**stage_1_output, output_type="pt", callback=span.step, **self.step_arguments("stage_2_")).images
+
+        # Quantize like diffusers' pt_to_pil, but on the device and without building the PIL images here
+        image = ((image / 2 + 0.5).clamp(0, 1) * 255).round().to(torch.uint8).permute(0, 2, 3, 1)
+        return list(image)
+
+    def generate_images(self, text_prompts, seed=0, noise_level=100, seeds=None, num_samples=1):
+        """
+        Generates num_samples images per prompt in text_prompts, running each stage once on the whole batch.
+
+        Parameters:
+        - text_prompts: The list of text prompts guiding the image generation.
+        - seed: Seed for random number generation to ensure reproducible results. Every prompt gets a generator seeded
+          with it, so its image does not depend on the rest of the batch.
+        - noise_level: The noise level applied during image generation (currently unused in this implementation).
+        - seeds: If provided, one sample is drawn per seed for every prompt, each with its own generator, so it is
+          reproducible whatever else is in the batch. Overrides seed.
+        - num_samples: The number of samples per prompt when seeds is not provided, drawn with the seeds 0 to num_samples - 1.
+
+        Returns:
+        A list of uint8 (H, W, C) tensors, the samples of each prompt in turn, left on the device so the conversion
+        to PIL happens on the image writer threads.
+        """
+        return self.run_stage_2(self.run_stage_1(text_prompts, seed=seed, seeds=seeds, num_samples=num_samples))
+
+    def generate_image_batches(self, batches, **kwargs):
+        """
+        Yields the images of each list of prompts in batches, like generate_images. In pipelined mode, stage 1 runs
+        on a background thread (on its own CUDA stream) and hands its outputs to stage 2 through a queue of at most
+        queue_size micro-batches, so both stages are busy at once. Outputs are the same as without pipelining.
+        """
+        if not self.pipelined or len(batches) < 2:
+            yield from super().generate_image_batches(batches, **kwargs)
+            return
+        kwargs.pop("noise_level", None)
+
+        outputs = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        stage_1_device = self.stage_1._execution_device
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    outputs.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def produce():
+            stream = torch.cuda.Stream(stage_1_device) if stage_1_device.type == "cuda" else None
+            try:
+                with torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext():
+                    for text_prompts in batches:
+                        if stop.is_set():
+                            return
+                        output = self.run_stage_1(text_prompts, **kwargs)
+                        ready = None
+                        if stream is not None: # stage 2 waits for the stage 1 kernels, not the whole device
+                            ready = torch.cuda.Event()
+                            ready.record(stream)
+                        put((output, ready, None))
+            except BaseException as e:
+                put((None, None, e))
+
+        producer = threading.Thread(target=produce, name="deepfloyd-stage-1", daemon=True)
+        producer.start()
+        try:
+            for _ in batches:
+                output, ready, error = outputs.get()
+                if error is not None:
+                    raise error
+                if ready is not None:
+                    consumer_stream = torch.cuda.current_stream(self.stage_2._execution_device)
+                    consumer_stream.wait_event(ready)
+                    for value in output.values():
+                        if torch.is_tensor(value) and value.is_cuda:
+                            value.record_stream(consumer_stream) # not reused by stage 1 while stage 2 reads it
+                yield self.run_stage_2(output)
+        finally:
+            stop.set()
+            producer.join()
+
+    def generate(self, text_prompt, seed=0, folder_path=None, filename=None, noise_level=100, seeds=None, num_samples=1):
         """
         Generates an image based on a text prompt and saves it to the specified location.
         
@@ -68,36 +270,21 @@ class DeepFloyd_I_XL_v1(BaseModel):
         - folder_path: The directory where the generated image will be saved.
         - filename: The name for the saved image file, including its file extension (e.g., 'image.jpg').
         - noise_level: The noise level applied during image generation (currently unused in this implementation).
+        - seeds, num_samples: Draw several samples, see generate_images. They are saved as '{stem}_{k}{extension}'.
         
-        @returns The file path to the saved image. If the file already exists, it returns the existing path.
+        @returns The file path to the saved image, or the list of paths for several samples. Existing files are not regenerated.
         """
-        save_path = os.path.join(folder_path, filename)
-        if os.path.exists(save_path):
-            print(f"Image already exists at {save_path}")
-            return save_path
+        seeds = resolve_seeds(seeds, num_samples)
+        save_paths = [os.path.join(folder_path, name) for name in sample_filenames(filename, len(seeds) if seeds else 1)]
+        if all(os.path.exists(save_path) for save_path in save_paths):
+            print(f"Image already exists at {save_paths[0]}")
+            return save_paths if len(save_paths) > 1 else save_paths[0]
 
-        # Generate image from text prompt
-        prompt_embeds, negative_embeds = self.stage_1.encode_prompt(text_prompt)
-        generator = torch.manual_seed(seed)
+        images = self.generate_images([text_prompt], seed=seed, noise_level=noise_level, seeds=seeds)
 
-        # Initial image generation with stage 1
-        image = self.stage_1(
-            prompt_embeds=prompt_embeds, 
-            negative_prompt_embeds=negative_embeds, 
-            generator=generator, 
-            output_type="pt"
-        ).images
-
-        # Image refinement with stage 2
-        image = self.stage_2(
-            image=image, 
-            prompt_embeds=prompt_embeds, 
-            negative_prompt_embeds=negative_embeds, 
-            generator=generator, 
-            output_type="pt"
-        ).images
-
-        # Save the final image
-        pt_to_pil(image)[0].save(save_path)
-
-        return save_path
+        # Save the final images
+        for image, save_path in zip(images, save_paths):
+            with self.span("save"):
+                get_image_writer().write(image, save_path)
+
+        return save_paths if len(save_paths) > 1 else save_paths[0]
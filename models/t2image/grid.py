@@ -0,0 +1,125 @@
+"""
+Splits the 2x2 grids returned by Midjourney into their four candidate images.
+
+Quadrants are numbered like Midjourney's U1-U4 buttons: 1 top-left, 2 top-right, 3 bottom-left, 4 bottom-right.
+The quadrants of '{id}.jpeg' are saved as '{id}_{q}.jpeg'. Each grid is decoded once and every requested quadrant is
+cropped from the decoded image, so splitting right after a download costs one decode, and folders of existing grids
+are split in a process pool with split_grid_folder.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Optional
+
+from PIL import Image
+
+from ..atomic_file import atomic_write
+
+QUADRANTS = (1, 2, 3, 4)
+GRID_EXTENSIONS = (".jpeg", ".jpg", ".png")
+
+def quadrant_boxes(width:int, height:int, quadrants=QUADRANTS) -> dict:
+    """ Returns the (left, upper, right, lower) crop box of each quadrant of a width x height grid. """
+    if width < 2 or height < 2:
+        raise ValueError(f"A {width}x{height} image is too small to be a 2x2 grid.")
+    half_width, half_height = width // 2, height // 2
+    boxes = {
+        1: (0, 0, half_width, half_height),
+        2: (half_width, 0, 2 * half_width, half_height),
+        3: (0, half_height, half_width, 2 * half_height),
+        4: (half_width, half_height, 2 * half_width, 2 * half_height),
+    }
+    unknown = [q for q in quadrants if q not in boxes]
+    if unknown:
+        raise ValueError(f"Unknown quadrants {unknown}. Choose from {list(QUADRANTS)}.")
+    return {q: boxes[q] for q in quadrants}
+
+def quadrant_path(grid_path:str, q:int, output_folder:Optional[str]=None, name_format:str="{stem}_{q}{ext}") -> str:
+    """ Returns where quadrant q of grid_path is saved: '{id}_{q}.jpeg' next to the grid, or in output_folder. """
+    stem, extension = os.path.splitext(os.path.basename(grid_path))
+    filename = name_format.format(stem=stem, q=q, ext=extension)
+    return os.path.join(output_folder if output_folder is not None else os.path.dirname(grid_path), filename)
+
+def split_grid(image:Image.Image, quadrants=QUADRANTS) -> dict:
+    """ Returns the requested quadrants of a decoded grid image, by quadrant number. """
+    image.load()
+    return {q: image.crop(box) for q, box in quadrant_boxes(*image.size, quadrants).items()}
+
+def split_grid_file(grid_path:str, output_folder:Optional[str]=None, quadrants=QUADRANTS, overwrite:bool=True,
+                    name_format:str="{stem}_{q}{ext}", quality:int=95) -> list:
+    """
+    Saves the quadrants of the grid at grid_path as separate files.
+
+    Parameters:
+    - grid_path: Path to the grid image, e.g., a Midjourney download.
+    - output_folder: The folder of the quadrant files. Defaults to the folder of the grid.
+    - quadrants: The quadrants to save, e.g., [1] for the top-left candidate only.
+    - overwrite: If False, the grid is not decoded again when all its quadrant files already exist.
+    - name_format: The filename of each quadrant, formatted with the grid's stem, the quadrant number q and the
+      grid's extension ext.
+    - quality: The JPEG quality of the quadrant files.
+
+    Return: The quadrant paths, in the order of quadrants.
+    """
+    save_paths = {q: quadrant_path(grid_path, q, output_folder, name_format) for q in quadrants}
+    if not overwrite and all(os.path.exists(save_path) for save_path in save_paths.values()):
+        return list(save_paths.values())
+
+    with Image.open(grid_path) as image:
+        crops = split_grid(image, quadrants)
+    for q, crop in crops.items():
+        save_path = save_paths[q]
+        image_format = Image.registered_extensions().get(os.path.splitext(save_path)[1].lower(), "JPEG")
+        with atomic_write(save_path) as file:
+            if image_format == "JPEG":
+                crop.convert("RGB").save(file, format=image_format, quality=quality)
+            else:
+                crop.save(file, format=image_format)
+    return list(save_paths.values())
+
+def split_grid_folder(input_folder:str, output_folder:Optional[str]=None, quadrants=QUADRANTS, overwrite:bool=False,
+                      name_format:str="{stem}_{q}{ext}", processes:Optional[int]=None, extensions=GRID_EXTENSIONS,
+                      chunksize:int=16, quality:int=95) -> dict:
+    """
+    Splits every grid in input_folder in a process pool.
+
+    Files that are themselves quadrants of another grid in the folder (e.g., '{id}_1.jpeg' next to '{id}.jpeg') are
+    not split again, so the quadrants can be written next to their grids and the folder processed repeatedly. With a
+    name_format that keeps the grid's name, e.g., '{stem}{ext}' with a single quadrant, each grid is replaced by its
+    quadrant in place.
+
+    Parameters:
+    - input_folder: The folder holding the grids.
+    - output_folder, quadrants, overwrite, name_format, quality: See split_grid_file. Grids whose quadrants all exist are
+      skipped unless overwrite is True.
+    - processes: The number of worker processes. Defaults to the number of CPUs. With 1, grids are split in this process.
+    - extensions: The extensions of the grid files.
+    - chunksize: The number of grids sent to a worker at a time.
+
+    Return: A dict mapping each grid path to its quadrant paths, or to None if it could not be split.
+    """
+    filenames = sorted(filename for filename in os.listdir(input_folder) if filename.lower().endswith(tuple(extensions)))
+    if output_folder is None or os.path.abspath(output_folder) == os.path.abspath(input_folder):
+        quadrant_names = {os.path.basename(quadrant_path(filename, q, None, name_format))
+                          for filename in filenames for q in quadrants}
+        quadrant_names -= {filename for filename in filenames
+                           if all(os.path.basename(quadrant_path(filename, q, None, name_format)) == filename for q in quadrants)}
+        filenames = [filename for filename in filenames if filename not in quadrant_names]
+    grid_paths = [os.path.join(input_folder, filename) for filename in filenames]
+    if output_folder is not None:
+        os.makedirs(output_folder, exist_ok=True)
+
+    split = partial(_split_grid_file_or_none, output_folder=output_folder, quadrants=tuple(quadrants),
+                    overwrite=overwrite, name_format=name_format, quality=quality)
+    if processes == 1 or len(grid_paths) <= 1:
+        return dict(zip(grid_paths, map(split, grid_paths)))
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return dict(zip(grid_paths, executor.map(split, grid_paths, chunksize=chunksize)))
+
+def _split_grid_file_or_none(grid_path, **kwargs):
+    try:
+        return split_grid_file(grid_path, **kwargs)
+    except (OSError, ValueError) as e: # unreadable or truncated image, or not a grid
+        print(f"Failed to split {grid_path}:", e)
+        return None
@@ -7,32 +7,63 @@ Midjourney
 
     Interface:
         - generate(text_prompt): generates an image using Dalle3 from the given text_prompt, returns the image url.
+        - generate_batch(text_prompts, filenames): submits every prompt up front, bulk-polls the tasks and downloads each image as it finishes.
         - reset_api_key(new_api_key): resets the API key to a new one.
         - set_prompt(prompt): sets the prompt to be used for the generation.
         - get_dalle_3_prompt(text_prompt): returns the prompt to be used for the generation.
+
+    With grid_quadrants, every downloaded grid '{id}.jpeg' is also split into '{id}_{q}.jpeg' files, see grid.py.
+    With notify_hook, the proxy pushes task updates to an embedded receiver (see notify_hook.py) and polling is only
+    a slow fallback for updates that never arrive.
+    With a ledger, submitted tasks are recorded on disk (see task_ledger.py), and a restarted run re-attaches to its
+    pending tasks instead of submitting them again.
 """
 
+import hashlib
 import os
+import queue
 import requests 
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from urllib.parse import urljoin
 from ..base_model import BaseModel
+from ..downloader import get_downloader
+from .grid import QUADRANTS, split_grid_file
+from .notify_hook import NotifyHookReceiver
+from .task_ledger import TaskLedger
 import time
 
 class Midjourney(BaseModel):
-    def __init__(self, host_url, **kwargs):
+    def __init__(self, host_url, grid_quadrants=None, notify_hook=None, ledger=None, connect_timeout:float=10,
+                 read_timeout:float=30, **kwargs):
         """
         Initialize the Midjourney instance.
 
         Parameters:
         - host_url: The base URL of the Midjourney API.
+        - grid_quadrants: If provided, the quadrants (1 top-left to 4 bottom-right) saved as '{id}_{q}' files next to
+          every downloaded grid, e.g., [1, 2, 3, 4], or True for all four.
+        - notify_hook: If provided, a NotifyHookReceiver whose URL is sent as the notifyHook of every task, or True to
+          start one on a free port. The proxy must be able to reach its URL.
+        - ledger: If provided, a TaskLedger, or the path of one, recording every submitted task across runs.
+        - connect_timeout, read_timeout: Seconds to wait for a connection to the proxy and for its response. A status
+          check that times out is retried on the next tick, see generate_batch.
         - kwargs: Additional parameters for API requests, to be concatenated with the prompt.
         """
         self.host_url = host_url
+        self.grid_quadrants = list(QUADRANTS) if grid_quadrants is True else grid_quadrants
+        self.notify_hook = NotifyHookReceiver() if notify_hook is True else notify_hook
+        self.ledger = TaskLedger(ledger) if isinstance(ledger, str) else ledger
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session() # keeps the connection to the proxy open between calls
         
         # Store additional parameters for concatenation with the prompt
         self.additional_params = " ".join(f"--{key} {value}" for key, value in kwargs.items())
 
 
+    def cache_identity(self):
+        """ Returns the parameters appended to every prompt, e.g., '--version 6.0', see BaseModel.cache_identity. """
+        return {"model": "Midjourney", "params": self.additional_params}
+
     def set_prompt(self, prompt):
         """
         Set the prompt for the API request, including additional parameters.
@@ -41,6 +72,10 @@ class Midjourney(BaseModel):
         - prompt: The prompt to be set.
         """
         self.prompt = prompt + " " + self.additional_params
+
+    def submission_id(self, prompt):
+        """ Returns the deterministic id of submitting prompt with the additional parameters, the key of the ledger. """
+        return hashlib.sha256((prompt + " " + self.additional_params).encode("utf-8")).hexdigest()[:32]
     
     def call_submit_imagine_task_api(self, prompt):
         """
@@ -56,15 +91,16 @@ class Midjourney(BaseModel):
         body = {
             "prompt": self.prompt,
             "base64Array": [],
-            "notifyHook": "",
-            "state": "",
-            "id":"17056193041129" # TODO: Placeholder
+            "notifyHook": self.notify_hook.url if self.notify_hook is not None else "",
+            "state": self.submission_id(prompt), # echoed back in every task update
+            "id": self.submission_id(prompt),
         }
 
         print("URL:", submit_imagine_url)
         print("Body:", body)
 
-        response = requests.post(submit_imagine_url, json=body)
+        with self.span("submit"):
+            response = self.session.post(submit_imagine_url, json=body, timeout=self.timeout)
         return response.json()
     
     def call_task_status_api(self, task_id):
@@ -77,10 +113,20 @@ class Midjourney(BaseModel):
         """
         task_status_endpoint = f"mj/task/{task_id}/fetch"
         task_status_url = urljoin(self.host_url, task_status_endpoint)
-        response = requests.get(task_status_url)
+        with self.span("poll"):
+            response = self.session.get(task_status_url, timeout=self.timeout)
 
         return response.json()
 
+    def poll_task_status(self, task_id):
+        """ Returns the response of call_task_status_api, or an IN_PROGRESS status if the call timed out, so a slow
+        proxy delays the task instead of failing it. """
+        try:
+            return self.call_task_status_api(task_id)
+        except requests.Timeout as e:
+            print(f"Status check of task {task_id} timed out, checking again later:", repr(e))
+            return {"status": "IN_PROGRESS"}
+
     def call_task_status_list_api(self, task_id_list: list[str]):
         """
         Make a call to the Midjourney API to check the status of a list of tasks.
@@ -88,12 +134,13 @@ class Midjourney(BaseModel):
         :param task_id_list: The list of task IDs to check.
         :return: Response from the API call.
         """
-        task_status_list_endpoint = "/mj/task/list-by-condition"
+        task_status_list_endpoint = "mj/task/list-by-condition"
         task_status_list_url = urljoin(self.host_url, task_status_list_endpoint)
         body = {
             "ids": task_id_list
         }
-        response = requests.post(task_status_list_url, json=body)
+        with self.span("poll", tasks=len(task_id_list)):
+            response = self.session.post(task_status_list_url, json=body, timeout=self.timeout)
 
         return response.json()
 
@@ -104,7 +151,7 @@ class Midjourney(BaseModel):
                 print(f"Task {id} submitted successfully.")
                 return "SUBMITTED"
             elif response["code"] == 21:
-                print("Task already exists.")
+                print(f"Task {response.get('result')} already exists, attaching to it.")
                 return "ALREADY_EXISTS"
             elif response["code"] == 22:
                 print("Task is in queue.")
@@ -115,7 +162,7 @@ class Midjourney(BaseModel):
         except:
             print(response)
     
-    def process_task_status_response(self, response, task_id):
+    def process_task_status_response(self, response, task_id, verbose=True):
 
         try:
             id = task_id
@@ -123,8 +170,9 @@ class Midjourney(BaseModel):
                 image_url = response["imageUrl"]
                 print(f"Task ID {id} completed successfully. URL:", image_url)
                 return "SUCCESS", image_url
-            elif response["status"] == "IN_PROGRESS" or response["status"] == "SUBMITTED":
-                print(f"Task ID {id} in progress. Check back later.")
+            elif response["status"] in ("IN_PROGRESS", "SUBMITTED", "NOT_START"):
+                if verbose:
+                    print(f"Task ID {id} in progress. Check back later.")
                 return "IN_PROGRESS", None
             elif response["status"] == "FAILURE":
                 print(f"Task ID {id} failed. Reason", response["failureReason"])
@@ -137,24 +185,96 @@ class Midjourney(BaseModel):
             return "FAILURE", None
         
     def process_task_status_list_response(self, response):
-        image_urls = []
-        for task in response["result"]:
-            status, image_url = self.process_task_status_response(task, task["id"])
-            if image_url is not None:
-                image_urls.append(image_url)
-        return image_urls
+        """
+        Processes the response of call_task_status_list_api.
+
+        Return: A dict mapping each task id in the response to its (status, image_url).
+        """
+        # The proxy returns a bare list of tasks, older versions wrap it in "result"
+        tasks = response["result"] if isinstance(response, dict) else response
+        statuses = {}
+        for task in tasks:
+            statuses[task["id"]] = self.process_task_status_response(task, task["id"], verbose=False)
+        return statuses
+
+    def submit_task(self, text_prompt, prompt_id=None):
+        """
+        Submits an imagine task for the given text prompt, or re-attaches to the task the ledger recorded for it.
+
+        Return: The task id, or None if the submission failed.
+        """
+        return self.attach_or_submit_task(text_prompt, prompt_id)[0]
+
+    def attach_or_submit_task(self, text_prompt, prompt_id=None):
+        """
+        Returns the task of text_prompt: the pending or successful task recorded in the ledger by an earlier run if
+        there is one, otherwise a newly submitted task. A submission answered with ALREADY_EXISTS (code 21) attaches
+        to the existing task.
+
+        Parameters:
+        - text_prompt: The text prompt.
+        - prompt_id: The id of the prompt, recorded in the ledger.
+
+        Return: (task id or None if the submission failed, True if the task was re-attached from the ledger)
+        """
+        submission_id = self.submission_id(text_prompt)
+        if self.ledger is not None:
+            task_id = self.ledger.reusable_task_id(submission_id)
+            if task_id is not None:
+                print(f"Re-attaching to task {task_id} submitted by an earlier run.")
+                return task_id, True
+
+        submit_response = self.call_submit_imagine_task_api(text_prompt)
+        submission_status = self.process_submit_imagine_response(submit_response)
+        if submission_status in ("ERROR", None):
+            return None, False
+        try:
+            task_id = submit_response["result"]
+        except:
+            print("Error submitting task. Response:", submit_response)
+            return None, False
+
+        print("status", submission_status, "submit_response", submit_response)
+        if self.ledger is not None:
+            self.ledger.record(submission_id, id=prompt_id, prompt=self.prompt, task_id=task_id, status="SUBMITTED")
+        return task_id, False
+
+    def record_task_status(self, text_prompt, status, image_url=None):
+        """ Records the final status of the task of text_prompt in the ledger, if there is one. """
+        if self.ledger is not None:
+            self.ledger.record(self.submission_id(text_prompt), status=status, image_url=image_url)
         
-    def check_progress(self, task_id):
+    def check_progress(self, task_id, poll_interval=20, fallback_poll_interval=120):
+        """
+        Waits for task_id to finish, polling its status every poll_interval seconds. With a notify_hook, returns as
+        soon as the proxy pushes the final update and only polls every fallback_poll_interval seconds without one.
+
+        Return: (status, image_url)
+        """
+        pushed = self.notify_hook.expect(task_id) if self.notify_hook is not None else None
+        # Checked once right away, e.g., a task re-attached after a restart may have finished already
+        status_response = self.poll_task_status(task_id)
         while True:
-            status_response = self.call_task_status_api(task_id)
             status, image_url = self.process_task_status_response(status_response, task_id)
+            if status == "IN_PROGRESS":
+                status_response = None
+                if pushed is not None:
+                    try:
+                        status_response = pushed.result(timeout=fallback_poll_interval)
+                    except FutureTimeoutError:
+                        print(f"No update pushed for task {task_id} in {fallback_poll_interval} seconds, polling.")
+                else:
+                    print(f"Task in progress. Waiting {poll_interval} seconds...")
+                    time.sleep(poll_interval)
+                if status_response is None:
+                    status_response = self.poll_task_status(task_id)
+                continue
+            if self.notify_hook is not None:
+                self.notify_hook.forget(task_id)
             if status == "FAILURE":
                 return status, None
             elif status == "SUCCESS":
                 return status, image_url
-            elif status == "IN_PROGRESS":
-                print("Task in progress. Waiting 20 seconds...")
-                time.sleep(20)
             else:
                 print("Unknown status:", status)
                 return status, None
@@ -176,19 +296,13 @@ class Midjourney(BaseModel):
 
         # Submit the task
         if task_id is None:
-            submit_response = self.call_submit_imagine_task_api(text_prompt)
-            submission_status = self.process_submit_imagine_response(submit_response)
-            if submission_status == "ERROR":
+            task_id = self.submit_task(text_prompt, prompt_id=os.path.splitext(filename)[0] if filename else None)
+            if task_id is None:
                 return None
-            try:
-                task_id = submit_response["result"]
-            except:
-                print("Error submitting task. Response:", submit_response)
-                return None
-
-            print("status", submission_status, "submit_response", submit_response)
+            submitted_prompt = text_prompt
         else:
             assert submit_only is False, "submit_only must be False when task_id is provided."
+            submitted_prompt = None
         
         if submit_only:
             return f"Submitted only {task_id}"
@@ -196,38 +310,170 @@ class Midjourney(BaseModel):
         # Check the status of the task    
         status, image_url = self.check_progress(task_id)
         print("Status:", status, "Image URL:", image_url)
+        if submitted_prompt is not None:
+            self.record_task_status(submitted_prompt, status, image_url)
         
         if download and image_url is not None:
             return self.download_image(image_url, folder_path, filename)
         else:
             return image_url
 
+    def generate_batch(self, text_prompts, filenames, folder_path="./", batch_size=None, callback=None,
+                       min_poll_interval=5, max_poll_interval=60):
+        """
+        Generates images for a list of prompts by submitting every task up front and polling all outstanding
+        tasks with one list-by-condition call per tick. Each image is downloaded as soon as its task succeeds.
+        With a ledger, prompts whose task is still pending from an earlier run re-attach to it; re-attached tasks the
+        proxy no longer knows are submitted again.
+
+        The poll interval starts at min_poll_interval, grows by 1.5x on every tick where no task finished
+        (up to max_poll_interval) and resets once a task finishes. With a notify_hook, each task is handled (and its
+        download started) as soon as its final update is pushed, and outstanding tasks are only polled after
+        max_poll_interval seconds without any update.
+
+        Parameters:
+        - text_prompts: The list of text prompts to generate from.
+        - filenames: The list of filenames to save each image as, aligned with text_prompts.
+        - folder_path: The folder where the images will be downloaded in the background. Prompts whose image already exists are skipped.
+        - batch_size: If provided, at most this many tasks are outstanding at once, e.g., to stay within the proxy queue size.
+        - callback: If provided, called as callback(index, save_path) as soon as each prompt finishes, from the download thread.
+
+        Return: A list of save paths aligned with text_prompts, with None for prompts that failed.
+        """
+        assert len(text_prompts) == len(filenames), "text_prompts and filenames must have the same length."
+        save_paths = [None] * len(text_prompts)
+        to_submit = []
+        for i, filename in enumerate(filenames):
+            save_path = os.path.join(folder_path, filename)
+            if os.path.exists(save_path):
+                print(f"Image already exists at {save_path}")
+                save_paths[i] = save_path
+            else:
+                to_submit.append(i)
+        to_submit.reverse() # pop() from the end in prompt order
+
+        downloads = {} # prompt index -> background download Future
+        outstanding = {} # task id -> prompt index
+        pushed = queue.Queue() # (task id, final update) pushed to the notify_hook
+        reattached = set() # task ids of earlier runs, not yet seen by a poll
+        poll_interval = min_poll_interval
+        while to_submit or outstanding:
+            timed_out = False
+            while to_submit and (batch_size is None or len(outstanding) < batch_size):
+                i = to_submit.pop()
+                try:
+                    task_id, was_reattached = self.attach_or_submit_task(text_prompts[i], prompt_id=os.path.splitext(filenames[i])[0])
+                except requests.Timeout as e:
+                    # Submitted again on the next tick, a submission the proxy did accept is answered with code 21
+                    print(f"Submitting prompt {i} timed out, retrying on the next tick:", repr(e))
+                    to_submit.append(i)
+                    timed_out = True
+                    break
+                if was_reattached:
+                    reattached.add(task_id)
+                if task_id is not None:
+                    outstanding[task_id] = i
+                    if self.notify_hook is not None:
+                        self.notify_hook.expect(task_id).add_done_callback(
+                            lambda update, task_id=task_id: pushed.put((task_id, update.result())))
+                elif callback is not None:
+                    callback(i, None)
+
+            if not outstanding:
+                if timed_out:
+                    time.sleep(poll_interval)
+                    poll_interval = min(poll_interval * 1.5, max_poll_interval)
+                continue
+
+            statuses = None
+            if reattached and not timed_out:
+                pass # poll right away, re-attached tasks may have finished while no run was watching
+            elif self.notify_hook is not None:
+                try:
+                    updates = [pushed.get(timeout=max_poll_interval)]
+                    while not pushed.empty():
+                        updates.append(pushed.get_nowait())
+                    statuses = {task_id: self.process_task_status_response(update, task_id, verbose=False) for task_id, update in updates}
+                except queue.Empty:
+                    print(f"No update pushed in {max_poll_interval} seconds, polling.")
+            else:
+                time.sleep(poll_interval)
+            if statuses is None:
+                try:
+                    statuses = self.process_task_status_list_response(self.call_task_status_list_api(list(outstanding)))
+                except requests.Timeout as e: # a missed tick, outstanding tasks are polled again on the next one
+                    print("Polling outstanding tasks timed out, retrying on the next tick:", repr(e))
+                    statuses = {}
+                    timed_out = True
+            if not timed_out:
+                for task_id in reattached:
+                    if task_id in outstanding and task_id not in statuses: # lost by the proxy, e.g., after its restart
+                        i = outstanding.pop(task_id)
+                        print(f"Task {task_id} is unknown to the proxy, submitting its prompt again.")
+                        self.record_task_status(text_prompts[i], "LOST")
+                        to_submit.append(i)
+                reattached.clear()
+
+            finished = 0
+            for task_id, (status, image_url) in statuses.items():
+                if task_id not in outstanding or status == "IN_PROGRESS":
+                    continue
+                i = outstanding.pop(task_id)
+                finished += 1
+                if self.notify_hook is not None:
+                    self.notify_hook.forget(task_id)
+                self.record_task_status(text_prompts[i], status, image_url)
+                if status == "SUCCESS":
+                    # The callback runs inside the download task, so it has returned once generate_batch does
+                    downloads[i] = self.download_image(image_url, folder_path, filenames[i], background=True,
+                                                       callback=(lambda save_path, i=i: callback(i, save_path)) if callback else None)
+                elif callback is not None:
+                    callback(i, None)
+
+            print(f"{finished} tasks finished, {len(outstanding)} outstanding, {len(to_submit)} waiting to be submitted.")
+            poll_interval = min_poll_interval if finished else min(poll_interval * 1.5, max_poll_interval)
+
+        for i, download in downloads.items():
+            save_paths[i] = download.result()
+        return save_paths
+
     
-    def download_image(self, image_url, folder_path, filename):
+    def download_image(self, image_url, folder_path, filename, background=False, callback=None):
         """
-        Saves an image from a given URL to a specified file path.
+        Saves an image from a given URL to a specified file path with the shared pooled downloader.
 
         Paremeter
         - image_url: URL of the image to download.
+        - background: If True, the download runs on a background thread and a Future resolving to the save path is returned.
+        - callback: With background, called on the download thread with the save path (None if the download failed).
         """
         assert folder_path is not None, "folder_path must be provided when download is True."
         assert filename is not None, "filename must be provided when download is True."
         assert image_url is not None, "image_url must be provided when download is True."
 
-        if not os.path.exists(folder_path):
-            os.makedirs(folder_path)
-
         save_path = os.path.join(folder_path, filename)
-        
-        response = requests.get(image_url) # Send a GET request to the image URL
-
-        # Return image if the request was successful
-        if response.status_code == 200:
-            # Save the image
-            with open(save_path, 'wb') as file:
-                file.write(response.content)
-            return save_path
-        else:
-            print(f"Failed to download the image. Status code: {response.status_code}")
+        if background:
+            def on_download(save_path):
+                self.split_grid(save_path)
+                if callback is not None:
+                    callback(save_path)
+            return get_downloader().submit(image_url, save_path, span=self.span("download"), callback=on_download)
+        with self.span("download"):
+            save_path = get_downloader().download(image_url, save_path)
+        self.split_grid(save_path)
+        return save_path
+
+    def split_grid(self, save_path):
+        """
+        Saves the grid_quadrants of the downloaded grid at save_path, decoding it once, on the calling (download) thread.
+
+        Return: The quadrant paths, or None if grid_quadrants is not set, the download failed or the image is not a grid.
+        """
+        if not self.grid_quadrants or save_path is None:
             return None
-        
\ No newline at end of file
+        with self.span("split_grid", quadrants=len(self.grid_quadrants)):
+            try:
+                return split_grid_file(save_path, quadrants=self.grid_quadrants)
+            except (OSError, ValueError) as e:
+                print(f"Failed to split the grid at {save_path}:", e)
+                return None
@@ -0,0 +1,119 @@
+"""
+This file defines the NotifyHookReceiver class, an embedded HTTP server receiving the task updates that
+midjourney-proxy pushes to the 'notifyHook' URL of a submission, so the Midjourney class learns that a task finished
+the moment it does instead of at its next poll.
+
+The proxy posts the task (the same JSON as mj/task/{id}/fetch) on every status change. Each final update (SUCCESS,
+FAILURE, CANCEL) resolves the Future returned by expect(task_id). Updates that arrive before expect is called, e.g.,
+for a task that finishes before its submit call returns, are kept until it is.
+"""
+
+import json
+import socket
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+FINAL_STATUSES = ("SUCCESS", "FAILURE", "CANCEL")
+
+class _NotifyHookHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        try:
+            task = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError:
+            task = None
+        valid = isinstance(task, dict) and "id" in task
+        self.send_response(200 if valid else 400)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        if valid:
+            self.server.receiver.notify(task)
+
+
+class NotifyHookReceiver:
+    def __init__(self, host:str="0.0.0.0", port:int=0, public_url:Optional[str]=None, max_unclaimed:int=10000):
+        """
+        Initializes the receiver and starts serving on a background thread.
+
+        Parameters:
+        - host: The interface to listen on. The default listens on every interface, so a proxy running on another
+          machine or container can reach it.
+        - port: The port to listen on. 0 picks a free port.
+        - public_url: The URL the proxy posts to, e.g., when the proxy reaches this machine through a different name
+          or port. Defaults to http://{host}:{port}/mj/notify, with this machine's hostname if host is 0.0.0.0.
+        - max_unclaimed: The number of final updates kept for tasks that expect has not been called for.
+        """
+        self.server = ThreadingHTTPServer((host, port), _NotifyHookHandler)
+        self.server.daemon_threads = True
+        self.server.receiver = self
+        self.port = self.server.server_address[1]
+        advertised_host = socket.gethostname() if host in ("0.0.0.0", "") else host
+        self.url = public_url or f"http://{advertised_host}:{self.port}/mj/notify"
+        self.max_unclaimed = max_unclaimed
+
+        self.futures = {} # task id -> Future resolving to the final task update
+        self.unclaimed = OrderedDict() # task id -> final task update received before expect
+        self.lock = threading.Lock()
+        self.num_notifications = 0
+        self.thread = threading.Thread(target=self.server.serve_forever, name="mj-notify-hook", daemon=True)
+        self.thread.start()
+
+    def expect(self, task_id:str) -> Future:
+        """ Returns a Future resolving to the final update pushed for task_id, as returned by mj/task/{id}/fetch. """
+        with self.lock:
+            if task_id in self.futures:
+                return self.futures[task_id]
+            future = Future()
+            task = self.unclaimed.pop(task_id, None)
+            if task is None:
+                self.futures[task_id] = future
+        if task is not None:
+            future.set_result(task)
+        return future
+
+    def forget(self, task_id:str):
+        """ Drops the Future of task_id, e.g., once a poll found the task finished before its update was received. """
+        with self.lock:
+            self.futures.pop(task_id, None)
+
+    def notify(self, task:dict):
+        """ Handles one update pushed by the proxy. """
+        with self.lock:
+            self.num_notifications += 1
+            if task.get("status") not in FINAL_STATUSES:
+                return
+            future = self.futures.pop(task["id"], None)
+            if future is None:
+                self.unclaimed[task["id"]] = task
+                while len(self.unclaimed) > self.max_unclaimed:
+                    self.unclaimed.popitem(last=False)
+                return
+        future.set_result(task)
+
+    def close(self):
+        """ Stops the server. Tasks still expected are left to the polling fallback. """
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+
+_shared_receiver = None
+_shared_receiver_lock = threading.Lock()
+
+def get_receiver(port:int=0, public_url:Optional[str]=None) -> NotifyHookReceiver:
+    """ Returns the NotifyHookReceiver shared by the Midjourney instances of this process, started on first use. """
+    global _shared_receiver
+    with _shared_receiver_lock:
+        if _shared_receiver is None:
+            _shared_receiver = NotifyHookReceiver(port=port, public_url=public_url)
+        return _shared_receiver
@@ -6,34 +6,101 @@ For more details, visit: https://huggingface.co/stabilityai/sdxl-turbo
 import os
 from diffusers import AutoPipelineForText2Image
 from ..base_model import BaseModel
+from ..image_writer import get_image_writer
+from ..sampling import resolve_seeds, sample_generators, sample_filenames
+from ..embedding_cache import EmbeddingCache, encode_sdxl_prompts
+from .. import presets
 import torch
 from dotenv import load_dotenv
 load_dotenv()
 TRANSFORMERS_CACHE = os.getenv("TRANSFORMERS_CACHE")
 
 class SDXL_Turbo(BaseModel):
-    def __init__(self, device:str, variant="fp16", torch_dtype=torch.float32):
+    # See models.presets. SDXL-Turbo is distilled for 1 to 4 steps without guidance; 'draft' is its recommended single step.
+    PRESETS = {
+        "draft": {"scheduler": None, "num_inference_steps": 1, "guidance_scale": 0.0,
+                  "torch_dtype": "float32", "variant": "fp16"},
+        "balanced": {"scheduler": None, "num_inference_steps": 2, "guidance_scale": 0.0,
+                     "torch_dtype": "float32", "variant": "fp16"},
+        "full": {"scheduler": None, "num_inference_steps": 4, "guidance_scale": 0.0,
+                 "torch_dtype": "float32", "variant": "fp16"},
+    }
+    DEFAULT_PRESET = "draft"
+
+    def __init__(self, device:str, variant=None, torch_dtype=None, embedding_cache=None, memory_budget=None,
+                 accelerate=False, warmup_batch_sizes=(1,), preset=None):
         """
         Initializes the SDXL_Turbo class with the specified computing device, variant, and torch data type.
 
         Parameters:
         - device: The computing device ('cpu' or 'cuda') for the model to run on. Defaults to 'cuda'.
-        - variant: The variant of the model to use, affecting performance and precision. Defaults to 'fp16'.
-        - torch_dtype: The torch data type (e.g., torch.float32) for the model. Defaults to torch.float32.
+        - variant: The variant of the model to use, affecting performance and precision. Defaults to the preset's ('fp16').
+        - torch_dtype: The torch data type (e.g., torch.float32) for the model. Defaults to the preset's (torch.float32).
+        - embedding_cache: The EmbeddingCache used to reuse prompt embeddings across calls and runs. Defaults to a new EmbeddingCache().
+        - memory_budget: If provided, the memory in GB the model must fit in (device memory, or RAM on CPU). Attention and
+          VAE slicing/tiling and model or sequential CPU offload are enabled as needed, see models.memory.
+        - accelerate: If True, the UNet and VAE decoder are compiled with torch.compile and use channels_last and fused
+          attention, see models.acceleration. Compiled kernels are cached on disk for later runs.
+        - warmup_batch_sizes: With accelerate, the batch sizes generated once at load time so they are compiled
+          before the first prompts, e.g., (1, 4) for generate_batch with batch_size=4.
+        - preset: The latency/quality preset, 'draft' (the default), 'balanced' or 'full', choosing the default step
+          count and guidance scale, and the dtype and variant unless given. See PRESETS.
         """
+        self.model_id = "stabilityai/sdxl-turbo"
+        self.embedding_cache = embedding_cache if embedding_cache is not None else EmbeddingCache()
+        settings = self.select_preset(preset, torch_dtype=torch_dtype, variant=variant)
         self.model_pipe = AutoPipelineForText2Image.from_pretrained(
-            "stabilityai/sdxl-turbo", 
-            torch_dtype=torch_dtype, 
-            variant=variant, 
+            self.model_id, 
+            torch_dtype=presets.torch_dtype(settings), 
+            variant=settings["variant"], 
             cache_dir=TRANSFORMERS_CACHE
         )
+        presets.set_scheduler(self.model_pipe, settings["scheduler"])
 
-        if device != "cpu":
+        if memory_budget is not None:
+            self.apply_memory_budget([self.model_pipe], device, memory_budget)
+        elif device != "cpu":
             print(f"Moving model to GPU... device {device}")
             self.model_pipe.to(device)
+
+        if accelerate:
+            self.apply_acceleration([self.model_pipe], warmup_batch_sizes)
     
+    def generate_images(self, text_prompts, num_inference_steps=None, guidance_scale=None, seeds=None, num_samples=1):
+        """
+        Generates num_samples images per prompt in text_prompts with a single batched pipeline call.
+
+        Parameters:
+        - text_prompts: The list of text prompts for guiding the image generation.
+        - num_inference_steps: The number of inference steps to perform for image generation. Defaults to the preset's (1 for 'draft', as recommended for SDXL-Turbo).
+        - guidance_scale: The scale of guidance for adherence to the text prompt. Defaults to the preset's (0.0, as SDXL-Turbo may not require guidance scaling).
+        - seeds: If provided, one sample is drawn per seed for every prompt, each reproducible on its own.
+        - num_samples: The number of samples per prompt when seeds is not provided, drawn with the seeds 0 to num_samples - 1.
+
+        Returns:
+        A list of PIL images, the samples of each prompt in turn (aligned with text_prompts for a single sample).
+        """
+        seeds = resolve_seeds(seeds, num_samples)
+        num_inference_steps = num_inference_steps or self.preset_settings["num_inference_steps"]
+        guidance_scale = guidance_scale if guidance_scale is not None else self.preset_settings["guidance_scale"]
+        with self.span("encode_prompt", prompts=len(text_prompts)):
+            embeds = encode_sdxl_prompts(self.embedding_cache, self.model_id, self.model_pipe, list(text_prompts), guidance_scale > 1)
+        with self.span("pipeline", prompts=len(text_prompts), num_inference_steps=num_inference_steps) as span:
+            return self.model_pipe(
+                **embeds,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scale,
+                num_images_per_prompt=len(seeds) if seeds else 1,
+                generator=sample_generators(seeds, len(text_prompts)),
+                callback_on_step_end=span.step # records the end of every denoising step
+            ).images
+
+    def prompt_length(self, text_prompt):
+        """ Returns the number of CLIP tokens in text_prompt, used to bucket prompts into micro-batches. """
+        return len(self.model_pipe.tokenizer(text_prompt).input_ids)
+
     def generate(self, text_prompt, folder_path="./", filename="sdxl-turbo-image.jpeg", 
-                 num_inference_steps=1, guidance_scale=0.0):
+                 num_inference_steps=None, guidance_scale=None, seeds=None, num_samples=1):
         """
         Generates and saves an image based on the provided text prompt.
 
@@ -41,24 +108,25 @@ class SDXL_Turbo(BaseModel):
         - text_prompt: The text prompt for guiding the image generation.
         - folder_path: The directory path where the generated image will be saved. Defaults to './'.
         - filename: The filename for the saved image, including its extension (e.g., 'image.jpeg'). Defaults to 'sdxl-turbo-image.jpeg'.
-        - num_inference_steps: The number of inference steps to perform for image generation. Defaults to 1, as recommended for SDXL-Turbo.
-        - guidance_scale: The scale of guidance for adherence to the text prompt. Defaults to 0.0, as SDXL-Turbo may not require guidance scaling.
+        - num_inference_steps: The number of inference steps to perform for image generation. Defaults to the preset's (1 for 'draft', as recommended for SDXL-Turbo).
+        - guidance_scale: The scale of guidance for adherence to the text prompt. Defaults to the preset's (0.0, as SDXL-Turbo may not require guidance scaling).
+        - seeds, num_samples: Draw several samples, see generate_images. They are saved as '{stem}_{k}{extension}'.
 
         Returns:
-        The path to the saved image file. If the file already exists, the existing path is returned.
+        The path to the saved image file, or the list of paths for several samples. Existing files are not regenerated.
         """
 
-        save_path = os.path.join(folder_path, filename)
-        if os.path.exists(save_path):
-            print(f"Image already exists at {save_path}")
-            return save_path
+        seeds = resolve_seeds(seeds, num_samples)
+        save_paths = [os.path.join(folder_path, name) for name in sample_filenames(filename, len(seeds) if seeds else 1)]
+        if all(os.path.exists(save_path) for save_path in save_paths):
+            print(f"Image already exists at {save_paths[0]}")
+            return save_paths if len(save_paths) > 1 else save_paths[0]
 
         print(f"Generating image with caption: {text_prompt}")
-        image = self.model_pipe(
-            prompt=text_prompt, 
-            num_inference_steps=num_inference_steps, 
-            guidance_scale=guidance_scale
-        ).images[0]
+        images = self.generate_images([text_prompt], num_inference_steps=num_inference_steps, guidance_scale=guidance_scale,
+                                      seeds=seeds)
 
-        image.save(save_path)
-        return save_path
+        for image, save_path in zip(images, save_paths):
+            with self.span("save"):
+                get_image_writer().write(image, save_path)
+        return save_paths if len(save_paths) > 1 else save_paths[0]
@@ -0,0 +1,81 @@
+"""
+This file defines the TaskLedger class used by the Midjourney class to remember the tasks it submitted across runs.
+
+Every submission has a deterministic id derived from its full prompt (with the --parameters appended), see
+Midjourney.submission_id. The ledger maps each submission id to the prompt id, the proxy's task id and the last known
+status, as an append-only JSONL file flushed on every update like the generation journal. On restart, submissions
+with a pending or successful task re-attach to it instead of being submitted (and paid for) again.
+"""
+
+import json
+import os
+import threading
+from typing import Optional
+
+PENDING_STATUSES = ("SUBMITTED", "IN_PROGRESS")
+
+class TaskLedger:
+    def __init__(self, ledger_path:str):
+        """
+        Opens (or creates) the ledger at ledger_path and replays the tasks already recorded.
+
+        Parameters:
+        - ledger_path: Path to the JSONL ledger, e.g., 'mj_tasks.jsonl' in the output folder.
+        """
+        folder_path = os.path.dirname(ledger_path) or "."
+        os.makedirs(folder_path, exist_ok=True)
+        self.ledger_path = ledger_path
+        self.lock = threading.Lock()
+        self.tasks = {} # submission id -> latest entry
+        if os.path.exists(ledger_path):
+            with open(ledger_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue # partially written line from a crash
+                    self.tasks[entry["submission_id"]] = entry
+        pending = sum(entry.get("status") in PENDING_STATUSES for entry in self.tasks.values())
+        if pending:
+            print(f"Task ledger: {pending} Midjourney tasks still pending from earlier runs.")
+
+        self.file = open(ledger_path, "a", encoding="utf-8")
+        if self.file.tell() > 0:
+            with open(ledger_path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self.file.write("\n") # terminate a line cut short by a crash so the next entry starts cleanly
+
+    def get(self, submission_id:str) -> Optional[dict]:
+        """ Returns the latest entry of submission_id, or None if it was never submitted. """
+        with self.lock:
+            entry = self.tasks.get(submission_id)
+            return dict(entry) if entry is not None else None
+
+    def reusable_task_id(self, submission_id:str) -> Optional[str]:
+        """ Returns the task id to re-attach submission_id to, or None if it has to be submitted (again). """
+        entry = self.get(submission_id)
+        if entry is None or entry.get("task_id") is None:
+            return None
+        if entry.get("status") not in PENDING_STATUSES + ("SUCCESS",):
+            return None # failed or lost by the proxy
+        return entry["task_id"]
+
+    def record(self, submission_id:str, **fields):
+        """ Updates the entry of submission_id with fields, e.g., task_id, status, image_url. Safe to call from several threads. """
+        with self.lock:
+            entry = dict(self.tasks.get(submission_id, {"submission_id": submission_id}), **fields)
+            self.tasks[submission_id] = entry
+            self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,18 +1,30 @@
-from .modelscope import ModelScope
-from .zeroscope import ZeroScope
+import importlib
 
+# Model name -> module defining it. Modules are only imported when their model is requested, so using ZeroScope
+# does not require modelscope to be installed.
+_MODEL_MODULES = {
+    "ModelScope": ".modelscope",
+    "ZeroScope": ".zeroscope",
+}
 
-ALL_MODELS = [
-    ModelScope,
-    ZeroScope
-]
+ALL_MODEL_NAMES = list(_MODEL_MODULES)
 
-ALL_MODEL_NAMES = [model.__name__ for model in ALL_MODELS]
+def is_video_model(model_name) -> bool:
+    """ Returns True if model_name is a model of this registry, without importing it. """
+    return model_name in _MODEL_MODULES
 
 def print_all_model_names():
     print("ALL_MODEL_NAMES:", ALL_MODEL_NAMES)
 
 def get_model_class(model_name):
-    """ Returns the model class corresponding to the provided model_name. """
+    """ Returns the model class corresponding to the provided model_name, importing its module on first use. """
     assert model_name in ALL_MODEL_NAMES, f"model_name must be one of {ALL_MODEL_NAMES}"
-    return ALL_MODELS[ALL_MODEL_NAMES.index(model_name)]
\ No newline at end of file
+    return getattr(importlib.import_module(_MODEL_MODULES[model_name], __name__), model_name)
+
+def __getattr__(name):
+    # Keeps `from models.t2video import ZeroScope` and ALL_MODELS working; both import the backends they need.
+    if name in _MODEL_MODULES:
+        return get_model_class(name)
+    if name == "ALL_MODELS":
+        return [get_model_class(model_name) for model_name in ALL_MODEL_NAMES]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
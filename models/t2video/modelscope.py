@@ -1,11 +1,12 @@
 import pathlib
 from huggingface_hub import snapshot_download
 from ..base_model import BaseModel
+from ..atomic_file import atomic_path
 from modelscope.pipelines import pipeline
 from modelscope.outputs import OutputKeys
 import os
-import shutil
 import torch
+from concurrent.futures import Future
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -33,13 +34,14 @@ class ModelScope(BaseModel):
         model_dir = pathlib.Path(os.path.join(TRANSFORMERS_CACHE, 'modelscope_weights'))
         
         # Download model weights to the specified directory.
-        snapshot_download('damo-vilab/modelscope-damo-text-to-video-synthesis', 
+        self.model_id = 'damo-vilab/modelscope-damo-text-to-video-synthesis'
+        snapshot_download(self.model_id, 
                           repo_type='model', local_dir=model_dir)
 
         # Initialize the pipeline with the model directory.
         self.pipe = pipeline('text-to-video-synthesis', model_dir.as_posix())
 
-    def generate(self, prompt, folder_path="./", filename="modelscope_video.mp4"):
+    def generate(self, prompt, folder_path="./", filename="modelscope_video.mp4", background=False, callback=None):
         """
         Generates a video based on the provided textual prompt and saves it to the specified location.
 
@@ -47,25 +49,38 @@ class ModelScope(BaseModel):
         - prompt: The textual prompt to guide video generation.
         - folder_path: The directory path where the generated video will be saved. Defaults to './'.
         - filename: The filename for the saved video. Defaults to 'modelscope_video.mp4'.
+        - background: If True, a completed Future is returned, for drivers that also run ZeroScope in the background.
+          The ModelScope pipeline encodes the video itself, so encoding always happens on this thread.
+        - callback: If provided, called with the video path (or None if generation failed) once the video is written.
 
         Returns:
-        The path to the saved video file.
+        The path to the saved video file, or a Future resolving to it if background is True.
         """
         # Package the prompt into the expected input format.
         test_text = {'text': prompt}
-        
-        # Generate the video.
-        output = self.pipe(test_text)
-        output_video_path = output[OutputKeys.OUTPUT_VIDEO]
-
         final_path = pathlib.Path(folder_path) / filename
-        
-        # Move the generated video file to the desired location.
-        if pathlib.Path(output_video_path).exists():
-            shutil.move(output_video_path, final_path)
-        else:
-            print(f'Error: Generated video not found at {output_video_path}')
+
+        # The pipeline writes straight into the destination folder under a temporary name, see models.atomic_file.
+        try:
+            with atomic_path(final_path.as_posix(), suffix=f".part{final_path.suffix}") as tmp_path:
+                with self.span("pipeline"):
+                    output = self.pipe(test_text, output_video=tmp_path)
+                output_video_path = output[OutputKeys.OUTPUT_VIDEO]
+                if not (pathlib.Path(output_video_path).exists() and os.path.getsize(output_video_path) > 0):
+                    raise FileNotFoundError(output_video_path)
+                if os.path.abspath(output_video_path) != os.path.abspath(tmp_path):
+                    os.replace(output_video_path, tmp_path)
+            result = final_path.as_posix()
+        except FileNotFoundError as e:
+            print(f'Error: Generated video not found at {e}')
+            result = None
 
         # Log the final path of the generated video.
         print(f'Generated video path: {final_path}')
-        return final_path.as_posix()
\ No newline at end of file
+        if callback is not None:
+            callback(result)
+        if background:
+            future = Future()
+            future.set_result(result)
+            return future
+        return result
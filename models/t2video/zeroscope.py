@@ -6,9 +6,11 @@ ZeroScope
 
 import os
 import torch
-from diffusers import DiffusionPipeline, DPMSolverMultistepScheduler
-from diffusers.utils import export_to_video
+from diffusers import DiffusionPipeline
 from ..base_model import BaseModel
+from ..video_writer import get_video_writer
+from ..sampling import resolve_seeds, sample_generators, sample_filenames
+from .. import presets
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -20,28 +22,113 @@ class ZeroScope(BaseModel):
     This class is used to generate videos from descriptions using the ZeroScope v2 model.
     https://huggingface.co/cerspense/zeroscope_v2_576w
     """
-    def __init__(self, device:str, torch_dtype=torch.float16):
-        self.pipe = DiffusionPipeline.from_pretrained("cerspense/zeroscope_v2_576w", torch_dtype=torch_dtype, cache_dir=TRANSFORMERS_CACHE)
-        self.pipe.scheduler = DPMSolverMultistepScheduler.from_config(self.pipe.scheduler.config)
+    # See models.presets. Every preset uses DPM-Solver++ and the pipeline's guidance scale of 9.0.
+    PRESETS = {
+        "draft": {"scheduler": "DPMSolverMultistepScheduler", "num_inference_steps": 15, "guidance_scale": 9.0,
+                  "torch_dtype": "float16", "variant": None},
+        "balanced": {"scheduler": "DPMSolverMultistepScheduler", "num_inference_steps": 25, "guidance_scale": 9.0,
+                     "torch_dtype": "float16", "variant": None},
+        "full": {"scheduler": "DPMSolverMultistepScheduler", "num_inference_steps": 40, "guidance_scale": 9.0,
+                 "torch_dtype": "float16", "variant": None},
+    }
+    DEFAULT_PRESET = "full"
+
+    def __init__(self, device:str, torch_dtype=None, memory_budget=None, accelerate=False,
+                 warmup_batch_sizes=(1,), preset=None, variant=None):
+        """
+        Initializes the ZeroScope pipeline on device.
+
+        Parameters:
+        - device: The computing device ('cpu' or 'cuda') for the model to run on.
+        - torch_dtype: The torch data type (e.g., torch.float16) for the model. Defaults to the preset's (torch.float16).
+        - memory_budget: If provided, the memory in GB the model must fit in (device memory, or RAM on CPU). Attention and
+          VAE slicing/tiling and model or sequential CPU offload are enabled as needed, see models.memory.
+        - accelerate: If True, the UNet and VAE decoder are compiled with torch.compile and use channels_last and fused
+          attention, see models.acceleration. Compiled kernels are cached on disk for later runs.
+        - warmup_batch_sizes: With accelerate, the batch sizes generated once at load time so they are compiled
+          before the first prompts, e.g., (1, 4) for generate_batch with batch_size=4.
+        - preset: The latency/quality preset, 'draft', 'balanced' or 'full' (the default), choosing the scheduler,
+          the default step count and guidance scale, and the dtype and variant unless given. See PRESETS.
+        - variant: The variant of the weights to download. Defaults to the preset's (the full precision files).
+        """
+        self.model_id = "cerspense/zeroscope_v2_576w"
+        settings = self.select_preset(preset, torch_dtype=torch_dtype, variant=variant)
+        self.pipe = DiffusionPipeline.from_pretrained(self.model_id, torch_dtype=presets.torch_dtype(settings),
+                                                      variant=settings["variant"], cache_dir=TRANSFORMERS_CACHE)
+        presets.set_scheduler(self.pipe, settings["scheduler"])
         
-        if device != "cpu":
+        if memory_budget is not None:
+            self.apply_memory_budget([self.pipe], device, memory_budget)
+        elif device != "cpu":
             print(f"Moving model to GPU... device {device}")
             self.pipe.to(device)
         else:
             print("Running on CPU. Enabling CPU offload...")
             self.pipe.enable_model_cpu_offload()
 
+        if accelerate:
+            self.apply_acceleration([self.pipe], warmup_batch_sizes)
+
+    def warmup(self, batch_sizes=(1,), **kwargs):
+        """ Generates one video per batch size in batch_sizes (as that many samples) into a temporary folder, see BaseModel.warmup. """
+        import tempfile
+        with tempfile.TemporaryDirectory() as folder_path:
+            for batch_size in batch_sizes:
+                with self.span("warmup", prompts=batch_size):
+                    self.generate("a photo of a cat", folder_path=folder_path, num_samples=batch_size, **kwargs)
+
     def generate(self, prompt, folder_path="./", filename="zeroscope-video.mp4", 
-                  num_inference_steps=40, height=320, width=576, num_frames=24):
-        
-        video_frames = self.pipe(prompt=prompt, 
-                                 num_inference_steps=num_inference_steps, 
-                                 height=height, width=width, 
-                                 ).frames[0]
-        
-        video_path = os.path.join(folder_path, filename)
+                  num_inference_steps=None, height=320, width=576, num_frames=24, background=False, callback=None,
+                  seeds=None, num_samples=1, guidance_scale=None):
+        """
+        Generates a video based on the provided textual prompt and saves it to the specified location.
+
+        Parameters:
+        - prompt: The textual prompt to guide video generation.
+        - folder_path: The directory path where the generated video will be saved. Defaults to './'.
+        - filename: The filename for the saved video. Defaults to 'zeroscope-video.mp4'.
+        - num_inference_steps, height, width: Passed to the pipeline. num_inference_steps defaults to the preset's (40 for 'full').
+        - background: If True, the video is encoded on the shared VideoWriter thread and a Future is returned, so the
+          next prompt can be generated in the meantime.
+        - callback: If provided, called with the video path (or None if encoding failed) once the video is written.
+        - seeds: If provided, one video is generated per seed in a single batch, each with its own generator so it is
+          reproducible on its own. The videos are saved as '{stem}_{k}{extension}'.
+        - num_samples: The number of videos when seeds is not provided, drawn with the seeds 0 to num_samples - 1.
+        - guidance_scale: The scale of guidance for adherence to the prompt. Defaults to the preset's (9.0).
 
+        Returns:
+        The path to the saved video file, or a Future resolving to it if background is True. With several samples,
+        the list of paths, also passed to callback.
+        """
         print(f"    Generating video with caption: {prompt}")
-        export_to_video(video_frames, output_video_path=video_path)
+        seeds = resolve_seeds(seeds, num_samples)
+        num_inference_steps = num_inference_steps or self.preset_settings["num_inference_steps"]
+        guidance_scale = guidance_scale if guidance_scale is not None else self.preset_settings["guidance_scale"]
+        if seeds:
+            # The pipeline always makes one video per prompt, so the prompt is encoded once and its embeddings repeated
+            with self.span("encode_prompt"):
+                prompt_embeds, negative_embeds = self.pipe.encode_prompt(prompt, self.pipe._execution_device, 1, True)
+            inputs = {"prompt_embeds": prompt_embeds.repeat_interleave(len(seeds), dim=0),
+                      "negative_prompt_embeds": negative_embeds.repeat_interleave(len(seeds), dim=0),
+                      "generator": sample_generators(seeds, 1)}
+        else:
+            inputs = {"prompt": prompt}
+        with self.span("pipeline", videos=len(seeds) if seeds else 1, num_inference_steps=num_inference_steps) as span:
+            videos = self.pipe(**inputs, 
+                               num_inference_steps=num_inference_steps, 
+                               guidance_scale=guidance_scale,
+                               height=height, width=width, 
+                               output_type="pt",
+                               callback=span.step # records the end of every denoising step
+                               ).frames
+
+        # (B, T, C, H, W) floats in [0, 1] -> contiguous uint8 (T, H, W, C) arrays, quantized on the device
+        videos = (videos * 255).round().clamp(0, 255).to(torch.uint8).permute(0, 1, 3, 4, 2).contiguous()
         
-        return video_path
+        video_paths = [os.path.join(folder_path, name) for name in sample_filenames(filename, len(videos))]
+        if len(video_paths) == 1:
+            future = get_video_writer().submit(videos[0], video_paths[0], callback=callback, span=self.span("encode_video"))
+        else:
+            future = get_video_writer().submit_all(videos, video_paths, callback=callback,
+                                                   spans=[self.span("encode_video") for _ in video_paths])
+        return future if background else future.result()
@@ -0,0 +1,161 @@
+"""
+This file defines the VideoWriter class used by the local video models to encode generated frames to video files on
+a background thread, so the next prompt is generated while the previous video is encoded.
+
+Frames are handed over as one contiguous uint8 (T, H, W, C) array or tensor and streamed to ffmpeg (through
+imageio-ffmpeg) frame by frame without copies. Videos are written atomically, see models.atomic_file.
+"""
+
+import os
+import contextlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional
+
+import numpy as np
+
+from .atomic_file import atomic_path
+
+class VideoWriter:
+    def __init__(self, fps:int=10, codec:str="libx264", bitrate:Optional[str]=None, quality:Optional[float]=5,
+                 pixel_format:str="yuv420p", max_workers:int=1, max_pending:int=2):
+        """
+        Initializes the writer.
+
+        Parameters:
+        - fps: The frame rate of the written videos.
+        - codec: The ffmpeg video codec, e.g., 'libx264', 'libvpx-vp9' or 'mpeg4'.
+        - bitrate: A constant bitrate, e.g., '4M'. Overrides quality when provided.
+        - quality: The variable bitrate quality, from 0 (lowest) to 10 (highest).
+        - pixel_format: The ffmpeg pixel format of the output. 'yuv420p' plays in most players.
+        - max_workers: The number of threads encoding videos.
+        - max_pending: The maximum number of videos queued or being encoded. submit blocks once it is reached.
+        """
+        self.fps = fps
+        self.codec = codec
+        self.bitrate = bitrate
+        self.quality = None if bitrate is not None else quality
+        self.pixel_format = pixel_format
+        self.max_workers = max_workers
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def write(self, frames, save_path:str, fps:Optional[int]=None) -> str:
+        """
+        Encodes frames to save_path on the calling thread.
+
+        Parameters:
+        - frames: A uint8 (T, H, W, C) numpy array or torch tensor on any device, with RGB channels.
+        - save_path: The destination. Its extension selects the container, e.g., '.mp4'.
+        - fps: Overrides the frame rate of the writer for this video.
+
+        Return: save_path.
+        """
+        import imageio_ffmpeg
+
+        if hasattr(frames, "detach"): # torch tensor, possibly still on the accelerator
+            frames = frames.detach().cpu().numpy()
+        frames = np.ascontiguousarray(frames) # no copy if already contiguous
+        if frames.dtype != np.uint8 or frames.ndim != 4 or frames.shape[-1] != 3:
+            raise ValueError(f"Frames must be a uint8 (T, H, W, 3) array, got {frames.dtype} {frames.shape}.")
+
+        extension = os.path.splitext(save_path)[1]
+        with atomic_path(save_path, suffix=f".part{extension}") as tmp_path: # ffmpeg picks the container from the extension
+            writer = imageio_ffmpeg.write_frames(tmp_path, (frames.shape[2], frames.shape[1]), fps=fps or self.fps,
+                                                 codec=self.codec, bitrate=self.bitrate, quality=self.quality,
+                                                 pix_fmt_out=self.pixel_format)
+            writer.send(None) # starts ffmpeg
+            for frame in frames: # each frame is a view into the contiguous array
+                writer.send(frame)
+            writer.close()
+        return save_path
+
+    def submit(self, frames, save_path:str, callback:Optional[Callable]=None, fps:Optional[int]=None, span=None) -> Future:
+        """
+        Encodes frames to save_path on a background thread, blocking while max_pending videos are already queued.
+
+        Parameters:
+        - frames, save_path, fps: See write.
+        - callback: If provided, called on the writer thread with save_path once the video is written, or None if encoding failed.
+        - span: If provided, a context manager entered around the encoding on the writer thread, e.g., a span of
+          models.instrumentation.
+
+        Return: a Future resolving to save_path (None if encoding failed) once the callback has returned.
+        """
+        def task():
+            try:
+                try:
+                    with span if span is not None else contextlib.nullcontext():
+                        result = self.write(frames, save_path, fps=fps)
+                except Exception as e:
+                    print(f"Failed to write the video to {save_path}:", repr(e))
+                    result = None
+                if callback is not None:
+                    callback(result)
+                return result
+            finally:
+                self.slots.release()
+
+        self.slots.acquire()
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="video-write")
+            return self.executor.submit(task)
+
+    def submit_all(self, videos, save_paths:list, callback:Optional[Callable]=None, fps:Optional[int]=None,
+                   spans=None) -> Future:
+        """
+        Encodes several videos, e.g., the samples of one prompt, on the background threads.
+
+        Parameters:
+        - videos: A sequence of uint8 (T, H, W, C) arrays or tensors, aligned with save_paths.
+        - save_paths: The destinations of the videos.
+        - callback: If provided, called with the list of paths (None for videos that failed) once all are written.
+        - spans: If provided, one context manager per video, see submit.
+
+        Return: a Future resolving to the list of paths once the callback has returned, or raising what the callback raised.
+        """
+        future = Future()
+        results = [None] * len(save_paths)
+        remaining = [len(save_paths)]
+        lock = threading.Lock()
+
+        def written(k):
+            def record(save_path):
+                results[k] = save_path
+                with lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    try:
+                        if callback is not None:
+                            callback(results)
+                    except BaseException as e: # raised by the Future, not lost on the writer thread
+                        future.set_exception(e)
+                    else:
+                        future.set_result(results)
+            return record
+
+        for k, (frames, save_path) in enumerate(zip(videos, save_paths)):
+            self.submit(frames, save_path, callback=written(k), fps=fps, span=spans[k] if spans is not None else None)
+        return future
+
+    def close(self):
+        """ Waits for queued videos to be written. """
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+
+
+_shared_writer = None
+_shared_writer_lock = threading.Lock()
+
+def get_video_writer() -> VideoWriter:
+    """ Returns the VideoWriter shared by all local video models in this process. """
+    global _shared_writer
+    with _shared_writer_lock:
+        if _shared_writer is None:
+            _shared_writer = VideoWriter()
+        return _shared_writer
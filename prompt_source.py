@@ -0,0 +1,98 @@
+"""
+This file contains the prompt loader shared by the generation drivers.
+
+Prompt files are either a JSON array of objects or JSONL with one object per line. Each object needs an "id"
+and a "prompt" key; any other field (e.g. "prompt in Chinese" or the per-model "models" map of
+data/Sora_prompts.json) is kept as is. Records are streamed lazily instead of loading the whole file, and can be
+split across workers with shard_index/num_shards striding and filtered by id.
+"""
+
+import itertools
+import json
+import re
+from typing import Container, Iterator, Optional
+
+CHUNK_SIZE = 1 << 16
+_SEPARATOR = re.compile(r"[\s,]*")
+
+def _is_jsonl(path:str) -> bool:
+    if path.endswith(".jsonl"):
+        return True
+    with open(path, "r", encoding="utf-8") as f:
+        while True:
+            char = f.read(1)
+            if not char or not char.isspace():
+                return char != "["
+
+def _iter_json_array(f, chunk_size:int=CHUNK_SIZE) -> Iterator[dict]:
+    """ Yields the elements of the JSON array in file f, reading chunk_size characters at a time. """
+    decoder = json.JSONDecoder()
+    buffer = f.read(chunk_size).lstrip()
+    if not buffer.startswith("["):
+        raise ValueError("Prompt file must contain a JSON array or JSON lines.")
+    pos = 1
+    eof = False
+
+    while True:
+        pos = _SEPARATOR.match(buffer, pos).end()
+        if buffer.startswith("]", pos):
+            return
+        try:
+            record, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+        yield record
+
+def _iter_records(path:str) -> Iterator:
+    """
+    Yields a zero-argument callable per record that parses it. JSONL lines are only parsed when called,
+    so workers skip the lines that belong to other shards without decoding them.
+    """
+    if _is_jsonl(path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield lambda line=line: json.loads(line)
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            for record in _iter_json_array(f):
+                yield lambda record=record: record
+
+def iter_prompts(path:str, shard_index:int=0, num_shards:int=1, ids:Optional[Container]=None,
+                 exclude_ids:Optional[Container]=None, start_idx:Optional[int]=None, end_idx:Optional[int]=None) -> Iterator[dict]:
+    """
+    Lazily yields the prompt records stored in path.
+
+    Parameters:
+    - path: Path to a JSON array or JSONL prompt file.
+    - shard_index: The shard to yield, between 0 and num_shards - 1. Record i belongs to shard i % num_shards.
+    - num_shards: The number of workers the file is split across.
+    - ids: If provided, only records whose id is in ids are yielded.
+    - exclude_ids: If provided, records whose id is in exclude_ids are skipped, e.g., ids completed by a previous run.
+    - start_idx, end_idx: If provided, only records with start_idx <= position < end_idx in the file are considered.
+
+    Yields:
+    - The record dicts, with all their fields.
+    """
+    assert 0 <= shard_index < num_shards, "shard_index must be between 0 and num_shards - 1."
+
+    records = itertools.islice(_iter_records(path), start_idx, end_idx)
+    for index, parse in enumerate(records):
+        if index % num_shards != shard_index:
+            continue
+        record = parse()
+        if ids is not None and record["id"] not in ids:
+            continue
+        if exclude_ids is not None and record["id"] in exclude_ids:
+            continue
+        yield record
+
+def load_prompts(path:str, **kwargs) -> list:
+    """ Returns the list of prompt records in path. Accepts the same filters as iter_prompts. """
+    return list(iter_prompts(path, **kwargs))
@@ -0,0 +1,207 @@
+"""
+Runs one local model over a prompt file with one worker process per device.
+
+Each worker loads the model once (on its own GPU, or on a slice of the CPU cores with thread limits set) and asks
+the parent for prompts from one shared queue. Finished prompts are journaled by the parent and merged into a single
+log.json. Prompts held by a worker that dies are put back on the queue for the other workers.
+"""
+
+import collections
+import multiprocessing as mp
+import os
+import queue
+from journal import GenerationJournal
+from models.instrumentation import Tracer
+from models.output_cache import OutputCache
+from prompt_source import iter_prompts
+from utils import list_devices
+
+IMAGE_MODELS = ["DeepFloyd_I_XL_v1", "SDXL_2_1", "SDXL_Base", "SDXL_Turbo"]
+VIDEO_MODELS = ["ModelScope", "ZeroScope"]
+
+def _worker_main(worker_id, model_name, device, num_threads, folder_path, batch_size, inbox, outbox, trace_folder_path,
+                 preset=None):
+    """ Worker process: loads model_name on device, then generates the batches it receives until it gets None. """
+    if device.startswith("cuda:"):
+        # Some pipelines ignore the device they are given, so each worker only sees its own GPU
+        os.environ["CUDA_VISIBLE_DEVICES"] = device.split(":")[1]
+        device = "cuda"
+    if num_threads:
+        for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+            os.environ[var] = str(num_threads)
+        import torch
+        torch.set_num_threads(num_threads)
+
+    if model_name in VIDEO_MODELS:
+        from generate_videos import get_model
+        model = get_model(model_name, device=device, preset=preset)
+    else:
+        from generate_images import get_model
+        model = get_model(model_name, device=device, batch_size=batch_size, preset=preset)
+    model.tracer = Tracer(jsonl_path=os.path.join(trace_folder_path, f"spans.worker-{worker_id}.jsonl"))
+    outbox.put(("ready", worker_id, (model.cache_identity(), getattr(model, "preset", None))))
+
+    while True:
+        jobs = inbox.get()
+        if jobs is None:
+            model.tracer.write_prometheus(os.path.join(trace_folder_path, f"metrics.worker-{worker_id}.prom"))
+            model.tracer.close()
+            return
+        ids = [id for id, _, _ in jobs]
+        try:
+            save_paths = model.generate_batch([text_prompt for _, text_prompt, _ in jobs],
+                                              [filename for _, _, filename in jobs],
+                                              folder_path=folder_path, batch_size=batch_size)
+        except Exception as e:
+            print(f"Worker {worker_id} ({device}) failed:", repr(e))
+            outbox.put(("failed", worker_id, ids))
+            continue
+        outbox.put(("done", worker_id, list(zip(ids, save_paths))))
+
+def _worker_specs(devices, cpu_workers):
+    """ Returns one (device, num_threads) pair per worker to start. """
+    if devices == ["cpu"] and cpu_workers:
+        num_threads = max(1, (os.cpu_count() or 1) // cpu_workers)
+        return [("cpu", num_threads)] * cpu_workers
+    return [(device, None) for device in devices]
+
+def run(model_name:str, prompts_path:str, output_folder_path:str, devices=None, cpu_workers=None, batch_size=1,
+        max_attempts=3, max_restarts=1, output_cache=True, preset=None, **prompt_filters):
+    """
+    Generates the prompts in prompts_path with model_name on several devices at once.
+
+    Parameters:
+    - model_name: One of IMAGE_MODELS or VIDEO_MODELS.
+    - prompts_path: Path to the prompt file, see prompt_source.iter_prompts.
+    - output_folder_path: Folder for the outputs and log.json, laid out like generate_images.py / generate_videos.py.
+    - devices: The devices to start one worker on each, e.g., ['cuda:0', 'cuda:1']. Defaults to utils.list_devices().
+    - cpu_workers: When running on CPU only, the number of workers to start, each limited to its share of the cores.
+    - batch_size: The number of prompts handed to a worker at a time and sent to the pipeline together.
+    - max_attempts: The number of times a prompt is tried before it is given up, e.g., because it keeps crashing workers.
+    - max_restarts: The number of times a dead worker is restarted on the same device.
+    - output_cache: True for the default OutputCache(), an OutputCache, or None. Prompts generated before for the same
+      request are linked from the cache instead of being sent to the workers, see generate_images.generate.
+    - preset: The latency/quality preset of the model, 'draft', 'balanced' or 'full'. Defaults to $PRESET, or to the
+      model's own default if unset, see models.presets. It is recorded in every log.json entry.
+    - prompt_filters: Additional filters passed to iter_prompts, e.g., ids.
+    """
+    assert model_name in IMAGE_MODELS + VIDEO_MODELS, f"model_name must be one of {IMAGE_MODELS + VIDEO_MODELS}"
+    if model_name in VIDEO_MODELS:
+        folder_path, extension, path_key = os.path.join(output_folder_path, "data"), "mp4", "video_path"
+    else:
+        folder_path, extension, path_key = output_folder_path, "jpeg", "image_path"
+    if not os.path.exists(folder_path):
+        os.makedirs(folder_path)
+
+    journal = GenerationJournal(output_folder_path)
+    prompts = {prompt["id"]: prompt for prompt in iter_prompts(prompts_path, exclude_ids=journal, **prompt_filters)}
+    pending = collections.deque(prompts)
+    attempts = collections.Counter()
+    print(f"{len(pending)} prompts to generate.")
+
+    cache = OutputCache() if output_cache is True else output_cache or None
+    identity = None # reported by the first worker to load the model
+    extra = {} # the preset of the model, recorded in every entry
+
+    def cache_keys(id):
+        # Workers pass no generation parameters, the preset settings they run with are part of identity
+        return [cache.key(identity, prompts[id]["prompt"], params={}, extension=f".{extension}")]
+
+    specs = _worker_specs(devices if devices is not None else list_devices(), cpu_workers)
+    ctx = mp.get_context("spawn")
+    outbox = ctx.Queue()
+    workers = {} # worker id -> (process, inbox)
+    restarts = collections.Counter()
+    in_flight = {} # worker id -> prompt ids it is working on
+    idle = set()
+
+    def start_worker(worker_id):
+        device, num_threads = specs[worker_id]
+        inbox = ctx.Queue()
+        process = ctx.Process(target=_worker_main, daemon=True,
+                              args=(worker_id, model_name, device, num_threads, folder_path, batch_size, inbox, outbox,
+                                    output_folder_path, preset))
+        process.start()
+        workers[worker_id] = (process, inbox)
+        print(f"Started worker {worker_id} on {device}" + (f" with {num_threads} threads" if num_threads else ""))
+
+    def requeue(ids):
+        for id in ids:
+            attempts[id] += 1
+            if attempts[id] < max_attempts:
+                pending.appendleft(id)
+            else:
+                print(f"Giving up on prompt {id} after {attempts[id]} attempts.")
+
+    def dispatch():
+        for worker_id in list(idle):
+            if not pending:
+                return
+            batch = [pending.popleft() for _ in range(min(batch_size, len(pending)))]
+            in_flight[worker_id] = batch
+            idle.discard(worker_id)
+            workers[worker_id][1].put([(id, prompts[id]["prompt"], f"{id}.{extension}") for id in batch])
+
+    with journal:
+        for worker_id in range(len(specs)):
+            start_worker(worker_id)
+
+        while pending or in_flight:
+            try:
+                kind, worker_id, payload = outbox.get(timeout=5)
+            except queue.Empty:
+                kind = None
+
+            if kind == "ready" and identity is None:
+                identity, model_preset = payload
+                if model_preset is not None:
+                    extra["preset"] = model_preset
+                if cache is not None:
+                    for id in list(pending):
+                        save_path = os.path.join(folder_path, f"{id}.{extension}")
+                        if cache.fetch(cache_keys(id), [save_path]):
+                            pending.remove(id)
+                            journal.append({"id": id, "prompt": prompts[id]["prompt"], path_key: save_path, **extra, "cache_hit": True})
+                    print(f"{cache.hits} prompts found in the output cache, {len(pending)} to generate.")
+            elif kind == "done":
+                in_flight.pop(worker_id, None)
+                for id, save_path in payload:
+                    if save_path is None:
+                        print(f"Prompt {id} failed.")
+                        continue
+                    if cache is not None:
+                        cache.store(cache_keys(id), [save_path])
+                    journal.append({"id": id, "prompt": prompts[id]["prompt"], path_key: save_path, **extra, "cache_hit": False})
+            elif kind == "failed":
+                requeue(in_flight.pop(worker_id, []))
+            if kind is not None and worker_id in workers:
+                idle.add(worker_id)
+
+            for worker_id, (process, _) in list(workers.items()):
+                if process.is_alive():
+                    continue
+                print(f"Worker {worker_id} died with exit code {process.exitcode}. Requeuing its prompts.")
+                del workers[worker_id]
+                idle.discard(worker_id)
+                requeue(in_flight.pop(worker_id, []))
+                if restarts[worker_id] < max_restarts:
+                    restarts[worker_id] += 1
+                    start_worker(worker_id)
+
+            if not workers:
+                raise RuntimeError("All workers died.")
+            dispatch()
+            if kind == "done":
+                print(f"Progress: {len(journal)} done, {sum(map(len, in_flight.values()))} in progress, {len(pending)} queued.")
+
+        for process, inbox in workers.values():
+            inbox.put(None)
+        for process, _ in workers.values():
+            process.join(timeout=60)
+
+
+if __name__ == '__main__':
+    MODEL = "SDXL_Turbo" # Change me
+    prompts_path = "./data/t2v_prompts.json" # Change me
+
+    run(model_name=MODEL, prompts_path=prompts_path, output_folder_path=f"./output/{MODEL}")
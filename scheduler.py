@@ -0,0 +1,199 @@
+"""
+Runs several models, from both the models.t2image and models.t2video registries, over one prompt file at the same
+time, so benchmarking every model takes about as long as the slowest model alone.
+
+Models run on one of two lanes:
+    - network lane: the API models (DALLE, Midjourney), which spend their time waiting on the network. Up to
+      max_network_models run at once, each with api_batch_size requests in flight (the model's default if None).
+    - device lane: the local models, which are bound by the accelerator. Each device runs max_models_per_device
+      models at a time (one by default, so a model never competes with another for memory), and local models are
+      spread over every device of utils.list_devices().
+Both lanes run at once. Each model runs through generate_images.generate or generate_videos.generate, with its
+outputs and log.json in output_folder_path/{model}, so an interrupted schedule resumes like a single run does.
+
+A shared progress view prints the done/total count, rate and ETA of every model every report_interval seconds.
+"""
+
+import gc
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from journal import read_entries
+from models.t2video import is_video_model
+from prompt_source import iter_prompts
+from utils import list_devices
+
+API_MODELS = ["DALLE", "Midjourney"]
+
+def model_folder_path(output_folder_path, name):
+    """ Returns where the outputs and log.json of name are written, as generate_images.py / generate_videos.py lay them out. """
+    return os.path.join(output_folder_path, name)
+
+class Progress:
+    def __init__(self):
+        """ The shared progress of every scheduled model. """
+        self.models = {} # name -> state dict
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+
+    def add(self, name, lane, total):
+        with self.lock:
+            self.models[name] = {"lane": lane, "status": "queued", "done": 0, "total": total, "start": None, "end": None, "error": None}
+
+    def start(self, name, device=None):
+        with self.lock:
+            self.models[name].update(status="running" if device is None else f"running on {device}", start=time.time())
+
+    def advance(self, name, n=1):
+        with self.lock:
+            self.models[name]["done"] += n
+
+    def finish(self, name, error=None):
+        with self.lock:
+            self.models[name].update(status="failed" if error else "done", end=time.time(), error=error)
+
+    def eta(self, state, now):
+        """ Returns the seconds state still needs at its current rate, or None if it is unknown. """
+        if state["status"] in ("done", "failed"):
+            return 0
+        if state["start"] is None or state["done"] == 0:
+            return None
+        rate = state["done"] / (now - state["start"])
+        return (state["total"] - state["done"]) / rate
+
+    def render(self) -> str:
+        now = time.time()
+        format_seconds = lambda seconds: "-" if seconds is None else time.strftime("%H:%M:%S", time.gmtime(seconds))
+        lines = [f"{'model':<20}{'lane':<9}{'status':<18}{'done':>12}{'per min':>9}{'ETA':>10}"]
+        etas = []
+        with self.lock:
+            for name, state in self.models.items():
+                elapsed = (state["end"] or now) - state["start"] if state["start"] else 0
+                rate = f"{state['done'] / elapsed * 60:.1f}" if elapsed > 0 and state["done"] else "-"
+                eta = self.eta(state, now)
+                etas.append(eta)
+                done = f"{state['done']}/{state['total']}"
+                lines.append(f"{name:<20}{state['lane']:<9}{state['status']:<18}{done:>12}{rate:>9}{format_seconds(eta):>10}")
+        # Models that have not started yet have no rate, so the overall ETA only exists once every model has one
+        overall = max(etas) if etas and None not in etas else None
+        lines.append(f"Elapsed {format_seconds(now - self.start_time)}, ETA {format_seconds(overall)}")
+        return "\n".join(lines)
+
+def _run_model(name, prompts_path, output_folder_path, progress, device=None, batch_size=4, **kwargs):
+    """ Runs one model with its driver, reporting every journaled prompt to progress. """
+    on_record = lambda entry: progress.advance(name)
+    folder_path = model_folder_path(output_folder_path, name)
+    try:
+        if is_video_model(name):
+            from generate_videos import generate
+            generate(model_name=name, prompts_path=prompts_path, model_folder_path=folder_path, device=device,
+                     on_record=on_record, **kwargs)
+        else:
+            from generate_images import generate
+            generate(model_name=name, prompts_path=prompts_path, output_folder_path=folder_path, device=device,
+                     batch_size=batch_size, on_record=on_record, **kwargs)
+    except Exception as e:
+        print(f"{name} failed:", repr(e))
+        progress.finish(name, error=repr(e))
+    else:
+        progress.finish(name)
+    finally:
+        gc.collect() # the model goes out of scope with the driver, release its memory before the next one loads
+        try:
+            import torch
+            if device is not None and str(device).startswith("cuda"):
+                with torch.cuda.device(device):
+                    torch.cuda.empty_cache()
+        except ImportError:
+            pass
+
+def run(models:list, prompts_path:str, output_folder_path="./output", devices=None, max_network_models=2,
+        max_models_per_device=1, api_batch_size=None, local_batch_size=4, report_interval=30, **kwargs):
+    """
+    Runs every model in models over prompts_path, API models and local models at the same time.
+
+    Parameters:
+    - models: Model names from models.t2image and models.t2video, e.g., ['DALLE', 'Midjourney', 'SDXL_Turbo', 'ZeroScope'].
+    - prompts_path: Path to the prompt file shared by every model, see prompt_source.iter_prompts.
+    - output_folder_path: Each model writes to output_folder_path/{model}.
+    - devices: The devices of the device lane. Defaults to utils.list_devices(). Must not be empty if models has local models.
+    - max_network_models: The number of API models running at once.
+    - max_models_per_device: The number of local models running at once on each device.
+    - api_batch_size: The number of requests each API model keeps in flight, see generate_images.generate. Defaults to
+      8 concurrent DALLE calls and every Midjourney prompt submitted at once.
+    - local_batch_size: The micro-batch size of local image models.
+    - report_interval: Seconds between two prints of the progress view.
+    - kwargs: Additional arguments passed to every driver, e.g., ids or seeds.
+
+    Return: a dict with, for each model, its final status, done/total counts, run time in seconds and error if it failed.
+    """
+    from models import t2image, t2video
+    unknown = [name for name in models if name not in t2image.ALL_MODEL_NAMES + t2video.ALL_MODEL_NAMES]
+    if unknown:
+        raise ValueError(f"Unknown models {unknown}. Choose from {t2image.ALL_MODEL_NAMES + t2video.ALL_MODEL_NAMES}.")
+
+    network_models = [name for name in models if name in API_MODELS]
+    device_models = [name for name in models if name not in API_MODELS]
+    devices = devices if devices is not None else (list_devices() if device_models else [])
+    if device_models and (not devices or max_models_per_device < 1): # the device lane would wait for a device forever
+        raise ValueError(f"Local models {device_models} need at least one device and max_models_per_device >= 1, "
+                         f"got devices={devices} and max_models_per_device={max_models_per_device}.")
+
+    progress = Progress()
+    for name in models:
+        completed = read_entries(model_folder_path(output_folder_path, name))
+        total = sum(1 for _ in iter_prompts(prompts_path, ids=kwargs.get("ids"), exclude_ids=completed))
+        progress.add(name, "network" if name in API_MODELS else "device", total)
+
+    free_devices = queue.Queue()
+    for device in devices:
+        for _ in range(max_models_per_device):
+            free_devices.put(device)
+
+    def run_network(name):
+        progress.start(name)
+        _run_model(name, prompts_path, output_folder_path, progress, api_batch_size=api_batch_size, **kwargs)
+
+    def run_device(name):
+        device = free_devices.get() # waits for a device with room for one more model
+        try:
+            progress.start(name, device)
+            _run_model(name, prompts_path, output_folder_path, progress, device=device, batch_size=local_batch_size, **kwargs)
+        finally:
+            free_devices.put(device)
+
+    # Import the drivers (and torch, for the local models) once here: modules imported by two lanes at once can be
+    # seen half-initialized by one of them
+    import generate_images, generate_videos
+    if device_models:
+        import torch
+    network_lane = ThreadPoolExecutor(max_workers=max(1, max_network_models), thread_name_prefix="network-lane")
+    device_lane = ThreadPoolExecutor(max_workers=max(1, len(devices) * max_models_per_device), thread_name_prefix="device-lane")
+    futures = [network_lane.submit(run_network, name) for name in network_models]
+    futures += [device_lane.submit(run_device, name) for name in device_models]
+
+    last_report = time.time()
+    while not all(future.done() for future in futures):
+        time.sleep(1)
+        if report_interval and time.time() - last_report >= report_interval:
+            last_report = time.time()
+            print(progress.render())
+    network_lane.shutdown()
+    device_lane.shutdown()
+    for future in futures:
+        future.result()
+
+    print(progress.render())
+    return {name: {"status": state["status"], "done": state["done"], "total": state["total"],
+                   "seconds": state["end"] - state["start"] if state["start"] else 0, "error": state["error"]}
+            for name, state in progress.models.items()}
+
+
+if __name__ == '__main__':
+    MODELS = ["DALLE", "Midjourney", "SDXL_Turbo", "SDXL_Base", "SDXL_2_1", "DeepFloyd_I_XL_v1"] # Change me
+    prompts_path = "./data/t2v_prompts.json" # Change me
+
+    run(models=MODELS, prompts_path=prompts_path, output_folder_path="./output")
@@ -0,0 +1,262 @@
+"""
+A long-lived local generation service that keeps models from both the models.t2image and models.t2video registries
+loaded between runs, so trying a new prompt set does not pay for from_pretrained and .to(device) again.
+
+Resident models are evicted least-recently-used once their parameters exceed the memory budget, skipping models that
+a request is still using, and identical requests that arrive while one is already being generated share its result.
+
+Endpoints (localhost HTTP, JSON):
+    - POST /generate {"model", "prompt", "folder_path"?, "filename"?, "params"?} -> {"path"}, with a list of paths if
+      params draws several samples, e.g., {"seeds": [0, 1]}
+    - GET /models -> {"resident": [...], "resident_gb"}
+    - GET /metrics -> the time and peak memory of the spans recorded by the models, in the Prometheus text format
+
+Clients can use submit() below:
+    submit({"model": "SDXL_Turbo", "prompt": "A red apple on a table", "filename": "apple.jpeg"})
+"""
+
+import contextlib
+import gc
+import hashlib
+import json
+import os
+import threading
+import urllib.error
+import urllib.request
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from models.t2video import is_video_model
+from utils import detect_device
+
+DEFAULT_URL = "http://127.0.0.1:8765"
+
+def load_model(name, device):
+    """ Loads name from whichever registry defines it. """
+    if is_video_model(name):
+        from generate_videos import get_model
+    else:
+        from generate_images import get_model
+    return get_model(name, device=device)
+
+def model_size_bytes(model):
+    """ Returns the bytes taken by the parameters of every torch module held by model or its pipelines. """
+    seen = set()
+    total = 0
+
+    def visit(obj):
+        nonlocal total
+        parameters = getattr(obj, "parameters", None)
+        if callable(parameters):
+            for parameter in parameters():
+                if id(parameter) not in seen:
+                    seen.add(id(parameter))
+                    total += parameter.numel() * parameter.element_size()
+        for component in getattr(obj, "components", {}).values():
+            if component is not None and component is not obj:
+                visit(component)
+
+    for value in vars(model).values():
+        visit(value)
+    return total
+
+class ModelPool:
+    def __init__(self, device, memory_budget_gb=None):
+        """
+        Keeps loaded models resident on device.
+
+        Parameters:
+        - device: The device local models are loaded on.
+        - memory_budget_gb: If provided, least recently used models are evicted once the resident parameters exceed this many GB.
+          Models held by a request (see use) are never evicted, so the budget may be exceeded until they are released.
+        """
+        self.device = device
+        self.memory_budget = memory_budget_gb * 1024**3 if memory_budget_gb else None
+        self.models = OrderedDict() # name -> (model, size in bytes, lock)
+        self.lock = threading.Lock()
+        self.loading = {} # name -> Future of a model being loaded
+        self.users = Counter() # name -> number of requests holding the model, loading included
+
+    def resident_bytes(self):
+        return sum(size for _, size, _ in self.models.values())
+
+    @contextlib.contextmanager
+    def use(self, name):
+        """ Yields (model, lock) for name, see get, and keeps the model from being evicted until the block exits. """
+        with self.lock:
+            self.users[name] += 1
+        try:
+            yield self.get(name)
+        finally:
+            with self.lock:
+                self.users[name] -= 1
+                if not self.users[name]:
+                    del self.users[name]
+                    self.evict() # models released while over budget
+
+    def get(self, name):
+        """
+        Returns (model, lock) for name, loading it and evicting least recently used models if needed.
+
+        Unless the caller holds name through use, the model may be evicted (and loaded again by the next request) as soon
+        as another model is loaded.
+        """
+        with self.lock:
+            if name in self.models:
+                self.models.move_to_end(name)
+                model, _, lock = self.models[name]
+                return model, lock
+            future = self.loading.get(name)
+            loader = future is None
+            if loader:
+                future = self.loading[name] = Future()
+
+        if not loader: # another request is already loading this model
+            return future.result()
+
+        try:
+            print(f"Loading {name}...")
+            model = load_model(name, self.device)
+            entry = (model, model_size_bytes(model), threading.Lock())
+            with self.lock:
+                self.models[name] = entry
+                self.evict(keep=name)
+            future.set_result((entry[0], entry[2]))
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.loading[name]
+        return entry[0], entry[2]
+
+    def evict(self, keep=None):
+        """ Evicts least recently used models other than keep that no request holds until the resident models fit the
+        memory budget. Called with self.lock held. """
+        if self.memory_budget is None:
+            return
+        while self.resident_bytes() > self.memory_budget:
+            name = next((name for name in self.models if name != keep and not self.users[name]), None)
+            if name is None:
+                print("Every resident model is in use, the memory budget is exceeded until one is released.")
+                return
+            print(f"Evicting {name} to stay within the memory budget.")
+            del self.models[name]
+            gc.collect()
+            try:
+                import torch
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+            except ImportError:
+                pass
+
+class GenerationService:
+    def __init__(self, pool:ModelPool, output_folder_path="./output"):
+        self.pool = pool
+        self.output_folder_path = output_folder_path
+        self.in_flight = {} # request key -> Future
+        self.lock = threading.Lock()
+
+    def generate(self, job:dict):
+        """ Runs job, or waits for the identical job already running, and returns the output path (a list of paths with
+        several samples). """
+        job = {
+            "model": job["model"],
+            "prompt": job["prompt"],
+            "folder_path": job.get("folder_path") or os.path.join(self.output_folder_path, job["model"]),
+            "filename": job.get("filename") or None,
+            "params": job.get("params") or {},
+        }
+        key = json.dumps(job, sort_keys=True)
+        if job["filename"] is None: # the wrappers' default filenames would be shared by every prompt
+            extension = "mp4" if is_video_model(job["model"]) else "jpeg"
+            job["filename"] = f"{hashlib.sha256(key.encode()).hexdigest()[:16]}.{extension}"
+        with self.lock:
+            future = self.in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self.in_flight[key] = Future()
+        if not owner:
+            return future.result()
+
+        try:
+            if not os.path.exists(job["folder_path"]):
+                os.makedirs(job["folder_path"], exist_ok=True)
+            kwargs = dict(job["params"], folder_path=job["folder_path"], filename=job["filename"])
+            with self.pool.use(job["model"]) as (model, lock), lock:
+                path = model.generate(job["prompt"], **kwargs)
+            if isinstance(path, (list, tuple)):
+                future.set_result([str(sample_path) if sample_path is not None else None for sample_path in path])
+            else:
+                future.set_result(str(path) if path is not None else None)
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+        return future.result()
+
+class _Handler(BaseHTTPRequestHandler):
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == "/models":
+            self.send_json(200, {"resident": list(service.pool.models),
+                                 "resident_gb": service.pool.resident_bytes() / 1024**3})
+        elif self.path == "/metrics":
+            from models.instrumentation import get_tracer
+            payload = get_tracer().prometheus_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/generate":
+            self.send_json(404, {"error": "not found"})
+            return
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            path = self.server.service.generate(job)
+        except Exception as e:
+            self.send_json(500, {"error": repr(e)})
+            return
+        self.send_json(200, {"path": path})
+
+def serve(host="127.0.0.1", port=8765, device=None, memory_budget_gb=None, output_folder_path="./output"):
+    """ Starts the service and blocks. """
+    if device is None:
+        device, _ = detect_device()
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.service = GenerationService(ModelPool(device, memory_budget_gb), output_folder_path)
+    print(f"Serving on http://{host}:{port} (device {device})")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+def submit(job:dict, url=DEFAULT_URL, timeout=None):
+    """ Sends a generation job to a running service and returns the output path, or the list of sample paths. """
+    request = urllib.request.Request(f"{url}/generate", data=json.dumps(job).encode(),
+                                     headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read())["path"]
+    except urllib.error.HTTPError as e:
+        raise RuntimeError(f"Generation failed: {json.loads(e.read()).get('error')}") from e
+
+
+if __name__ == '__main__':
+    MEMORY_BUDGET_GB = None # Change me: e.g. 20 to keep at most ~20GB of weights resident
+    serve(port=8765, memory_budget_gb=MEMORY_BUDGET_GB)
@@ -0,0 +1,177 @@
+"""
+Local stand-ins for the remote APIs used by the API models, so their concurrency and retry logic
+can be tested without network access or API keys.
+"""
+
+import base64
+import json
+import threading
+import time
+import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 1x1 white PNG
+FAKE_IMAGE_BYTES = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010802000000907753de"
+    "0000000c49444154789c63f8ffff3f0005fe02fe0def46b80000000049454e44ae426082"
+)
+
+class FakeServer:
+    """ Runs a ThreadingHTTPServer with the given handler class on a free localhost port. """
+    def __init__(self, handler_class):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+        self.server.fake = self
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        try:
+            self.wfile.write(payload)
+        except BrokenPipeError: # the client timed out, e.g., on a hung list-by-condition call
+            pass
+
+    def send_image(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(FAKE_IMAGE_BYTES)))
+        self.end_headers()
+        self.wfile.write(FAKE_IMAGE_BYTES)
+
+
+class _FakeOpenAIHandler(_Handler):
+    def do_POST(self):
+        fake = self.server.fake
+        body = self.read_json()
+        with fake.lock:
+            fake.num_requests += 1
+            throttle = fake.num_requests <= fake.num_rate_limited
+        if throttle:
+            self.send_json(429, {"error": {"message": "Rate limit reached", "type": "requests"}},
+                           headers={"retry-after": "0.1"})
+            return
+        if body.get("response_format") == "b64_json":
+            data = [{"b64_json": base64.b64encode(FAKE_IMAGE_BYTES).decode(), "revised_prompt": body.get("prompt")}
+                    for _ in range(body.get("n", 1))]
+        else:
+            data = [{"url": f"{fake.url}/images/{i}.png", "revised_prompt": body.get("prompt")} for i in range(body.get("n", 1))]
+        self.send_json(200, {"created": 0, "data": data})
+
+    def do_GET(self):
+        with self.server.fake.lock:
+            self.server.fake.num_downloads += 1
+        self.send_image()
+
+
+class FakeOpenAIServer(FakeServer):
+    """
+    Serves POST /v1/images/generations like the OpenAI images API (with url or b64_json results) and the returned image URLs.
+    The first num_rate_limited requests are answered with 429 and a 'retry-after' header.
+    """
+    def __init__(self, num_rate_limited=0):
+        super().__init__(_FakeOpenAIHandler)
+        self.num_rate_limited = num_rate_limited
+        self.num_requests = 0
+        self.num_downloads = 0
+        self.base_url = f"{self.url}/v1"
+
+
+class _FakeMidjourneyHandler(_Handler):
+    def do_POST(self):
+        fake = self.server.fake
+        body = self.read_json()
+        if self.path.endswith("/mj/submit/imagine"):
+            with fake.lock:
+                existing_id = fake.submissions.get(body.get("state"))
+                if existing_id is not None: # the same submission id again
+                    self.send_json(200, {"code": 21, "description": "Already exists", "result": existing_id})
+                    return
+                task_id = str(len(fake.tasks) + 1)
+                if body.get("state"):
+                    fake.submissions[body["state"]] = task_id
+                fake.tasks[task_id] = {"id": task_id, "prompt": body["prompt"], "status": "SUBMITTED", "polls": 0,
+                                       "imageUrl": f"{fake.url}/images/{task_id}.png", "failureReason": None}
+            if fake.push_delay is not None and body.get("notifyHook"):
+                threading.Timer(fake.push_delay, fake.push, args=(task_id, body["notifyHook"])).start()
+            self.send_json(200, {"code": 1, "description": "Success", "result": task_id})
+        elif self.path.endswith("/mj/task/list-by-condition"):
+            fake.num_list_calls += 1
+            if fake.num_list_calls <= fake.num_hung_list_calls:
+                time.sleep(fake.hang_seconds)
+            self.send_json(200, [fake.poll(task_id) for task_id in body["ids"] if task_id in fake.tasks])
+        else:
+            self.send_json(404, {})
+
+    def do_GET(self):
+        fake = self.server.fake
+        if self.path.startswith("/images/"):
+            self.send_image()
+        elif self.path.endswith("/fetch"):
+            task_id = self.path.split("/")[-2]
+            self.send_json(200, fake.poll(task_id))
+        else:
+            self.send_json(404, {})
+
+
+class FakeMidjourneyProxy(FakeServer):
+    """
+    Serves the subset of the midjourney-proxy API used by the Midjourney class.
+    Each task reports IN_PROGRESS for polls_to_finish status checks and then SUCCESS. Submitting the same state
+    (submission id) twice is answered with code 21 and the existing task id.
+    With push_delay, tasks submitted with a notifyHook finish push_delay seconds after their submission, and the
+    final update is posted to the hook, except for the first num_dropped_pushes tasks, whose update is lost.
+    The first num_hung_list_calls list-by-condition calls only answer after hang_seconds.
+    """
+    def __init__(self, polls_to_finish=2, push_delay=None, num_dropped_pushes=0, num_hung_list_calls=0, hang_seconds=2):
+        super().__init__(_FakeMidjourneyHandler)
+        self.polls_to_finish = polls_to_finish
+        self.push_delay = push_delay
+        self.num_dropped_pushes = num_dropped_pushes
+        self.num_hung_list_calls = num_hung_list_calls
+        self.hang_seconds = hang_seconds
+        self.tasks = {}
+        self.submissions = {} # state -> task id
+        self.num_list_calls = 0
+        self.num_pushes = 0
+
+    def poll(self, task_id):
+        with self.lock:
+            task = self.tasks[task_id]
+            task["polls"] += 1
+            task["status"] = "SUCCESS" if task["polls"] > self.polls_to_finish else "IN_PROGRESS"
+            return {key: value for key, value in task.items() if key != "polls"}
+
+    def push(self, task_id, notify_hook):
+        with self.lock:
+            task = self.tasks[task_id]
+            task["polls"] = max(task["polls"], self.polls_to_finish) # finished for the polls too
+            task["status"] = "SUCCESS"
+            update = {key: value for key, value in task.items() if key != "polls"}
+            self.num_pushes += 1
+            dropped = self.num_pushes <= self.num_dropped_pushes
+        if not dropped:
+            requests.post(notify_hook, json=update, timeout=10)
@@ -1,6 +1,8 @@
 from models.t2image import get_model_class, print_all_model_names
 from utils import detect_device
+from tests.fake_endpoints import FakeOpenAIServer, FakeMidjourneyProxy
 import os
+import torch
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -24,6 +26,31 @@ def test_dalle(openai_api_key:str):
     save_path = model.generate(text_prompt="A red apple on a table", folder_path=SAVE_PATH, filename="dalle2-image-test.jpeg", download=True, size="512x512", version=2)
     print("Done. Image saved at", save_path)
 
+def test_dalle_concurrent(): # Runs offline against a local fake endpoint
+    print("--Testing DALLE concurrent mode...", end="")
+    with FakeOpenAIServer(num_rate_limited=3) as server:
+        model = get_model_class('DALLE')("fake-key", version=3, base_url=server.base_url, requests_per_minute=600)
+        jobs = [(f"{i:05d}", f"Prompt number {i}", f"dalle-concurrent-test-{i}.jpeg") for i in range(10)]
+        results = dict(model.generate_concurrent(jobs, folder_path=SAVE_PATH, max_workers=4))
+
+        assert sorted(results) == [prompt_id for prompt_id, _, _ in jobs]
+        assert all(save_path is not None and os.path.exists(save_path) for save_path in results.values())
+        assert server.num_requests == len(jobs) + 3, "rate limited requests must be retried"
+    print("Done. Images saved at", list(results.values()))
+
+def test_dalle_b64(): # Runs offline against a local fake endpoint
+    print("--Testing DALLE inline b64_json results...", end="")
+    with FakeOpenAIServer() as server:
+        model = get_model_class('DALLE')("fake-key", version=2, base_url=server.base_url, response_format="b64_json")
+        save_paths = model.generate_batch(["A red apple on a table", "A green pear on a table"],
+                                          ["dalle-b64-test-0.jpeg", "dalle-b64-test-1.jpeg"], folder_path=SAVE_PATH, n=3)
+        assert [os.path.basename(save_path) for save_path in save_paths[1]] == [f"dalle-b64-test-1_{k}.jpeg" for k in range(3)]
+        assert all(os.path.exists(save_path) for paths in save_paths for save_path in paths)
+        image = model.generate("A red apple on a table", download=False)
+        assert image.size == (1, 1)
+        assert server.num_downloads == 0, "inline results must not be fetched again"
+    print("Done. Images saved at", save_paths)
+
 def test_midjourney(host_url:str):
     print("Initializing Midjourney v5...", end="")
     args = {
@@ -36,6 +63,129 @@ def test_midjourney(host_url:str):
     save_path = model.generate(text_prompt="A red apple on a table", folder_path=SAVE_PATH, filename="mj-image-test.jpeg", download=True)
     print("Done. Image saved at", save_path)
 
+def test_midjourney_batch(): # Runs offline against a local stand-in proxy
+    print("--Testing Midjourney batch mode...", end="")
+    with FakeMidjourneyProxy(polls_to_finish=2) as proxy:
+        model = get_model_class('Midjourney')(proxy.url + "/", version=6.0)
+        text_prompts = [f"Prompt number {i}" for i in range(5)]
+        filenames = [f"mj-batch-test-{i}.jpeg" for i in range(5)]
+        save_paths = model.generate_batch(text_prompts, filenames, folder_path=SAVE_PATH, min_poll_interval=0.05)
+
+        assert all(save_path is not None and os.path.exists(save_path) for save_path in save_paths)
+        assert proxy.num_list_calls == 3, "all outstanding tasks must be polled with one call per tick"
+    print("Done. Images saved at", save_paths)
+
+def test_midjourney_poll_timeout(): # Runs offline against a local stand-in proxy
+    print("--Testing Midjourney polls timing out...", end="")
+    with FakeMidjourneyProxy(polls_to_finish=1, num_hung_list_calls=1, hang_seconds=1) as proxy:
+        model = get_model_class('Midjourney')(proxy.url + "/", read_timeout=0.2, version=6.0)
+        text_prompts = [f"Prompt number {i}" for i in range(3)]
+        filenames = [f"mj-timeout-test-{i}.jpeg" for i in range(3)]
+        save_paths = model.generate_batch(text_prompts, filenames, folder_path=SAVE_PATH, min_poll_interval=0.05)
+
+        assert all(save_path is not None and os.path.exists(save_path) for save_path in save_paths)
+        assert proxy.num_list_calls == 3, "the timed out poll must be retried on the next tick"
+    print("Done. Images saved at", save_paths)
+
+def test_midjourney_notify_hook(): # Runs offline against a local stand-in proxy
+    print("--Testing Midjourney notifyHook updates...", end="")
+    import time
+    from models.t2image.notify_hook import NotifyHookReceiver
+    with FakeMidjourneyProxy(polls_to_finish=1, push_delay=0.1, num_dropped_pushes=1) as proxy, \
+         NotifyHookReceiver(host="127.0.0.1") as receiver:
+        model = get_model_class('Midjourney')(proxy.url + "/", notify_hook=receiver, version=6.0)
+        text_prompts = [f"Prompt number {i}" for i in range(4)]
+        filenames = [f"mj-notify-test-{i}.jpeg" for i in range(4)]
+        start = time.time()
+        save_paths = model.generate_batch(text_prompts, filenames, folder_path=SAVE_PATH, max_poll_interval=1)
+        assert all(save_path is not None and os.path.exists(save_path) for save_path in save_paths)
+        assert receiver.num_notifications == 3 and proxy.num_list_calls == 1, "only the dropped update must be polled"
+        assert time.time() - start < 5
+
+        start = time.time()
+        save_path = model.generate("A red apple on a table", folder_path=SAVE_PATH, filename="mj-notify-test-single.jpeg")
+        assert save_path is not None and time.time() - start < 5, "generate must not wait for the next poll"
+    print("Done. Images saved at", save_paths)
+
+def test_midjourney_ledger(): # Runs offline against local stand-in proxies
+    print("--Testing Midjourney task ledger...", end="")
+    ledger_path = os.path.join(SAVE_PATH, "mj-ledger-test.jsonl")
+    if os.path.exists(ledger_path):
+        os.remove(ledger_path)
+    text_prompts = [f"Ledger prompt {i}" for i in range(3)]
+    filenames = [f"mj-ledger-test-{i}.jpeg" for i in range(3)]
+    with FakeMidjourneyProxy(polls_to_finish=1) as proxy:
+        model = get_model_class('Midjourney')(proxy.url + "/", ledger=ledger_path, version=6.0)
+        task_ids = [model.submit_task(text_prompt) for text_prompt in text_prompts[:2]] # then the run is killed
+        assert model.submit_task(text_prompts[0]) == task_ids[0], "a pending task must not be submitted again"
+        model.ledger.close()
+
+        model = get_model_class('Midjourney')(proxy.url + "/", ledger=ledger_path, version=6.0) # restarted run
+        save_paths = model.generate_batch(text_prompts, filenames, folder_path=SAVE_PATH, min_poll_interval=0.05)
+        assert all(save_path is not None for save_path in save_paths)
+        assert len(proxy.tasks) == 3, "only the prompt never submitted must be submitted"
+        assert model.ledger.get(model.submission_id(text_prompts[0]))["status"] == "SUCCESS"
+
+        # Without a ledger, the deterministic submission id makes the proxy answer ALREADY_EXISTS
+        assert get_model_class('Midjourney')(proxy.url + "/", version=6.0).submit_task(text_prompts[2]) == "3"
+        model.ledger.close()
+
+    with FakeMidjourneyProxy(polls_to_finish=1) as proxy: # a proxy that lost the pending tasks
+        model = get_model_class('Midjourney')(proxy.url + "/", ledger=ledger_path, version=6.0)
+        model.ledger.record(model.submission_id(text_prompts[1]), status="SUBMITTED")
+        os.remove(save_paths[1])
+        save_paths = model.generate_batch(text_prompts, filenames, folder_path=SAVE_PATH, min_poll_interval=0.05)
+        assert all(save_path is not None for save_path in save_paths) and len(proxy.tasks) == 1
+        model.ledger.close()
+    print("Done. Ledger saved at", ledger_path)
+
+def test_grid_split():
+    print("--Testing Midjourney grid splitting...", end="")
+    from PIL import Image
+    from models.t2image.grid import split_grid_file, split_grid_folder
+    folder_path = os.path.join(SAVE_PATH, "grid-split-test")
+    os.makedirs(folder_path, exist_ok=True)
+    colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0)] # quadrants 1 to 4
+    for i in range(3):
+        grid = Image.new("RGB", (64, 48))
+        for q, color in enumerate(colors):
+            grid.paste(color, ((q % 2) * 32, (q // 2) * 24, (q % 2 + 1) * 32, (q // 2 + 1) * 24))
+        grid.save(os.path.join(folder_path, f"{i:05d}.png"))
+
+    save_paths = split_grid_file(os.path.join(folder_path, "00000.png"), quadrants=[2, 3])
+    assert [os.path.basename(save_path) for save_path in save_paths] == ["00000_2.png", "00000_3.png"]
+    results = split_grid_folder(folder_path, processes=2)
+    assert len(results) == 3, "quadrant files must not be split again"
+    for grid_path, quadrant_paths in results.items():
+        for quadrant_path, color in zip(quadrant_paths, colors):
+            with Image.open(quadrant_path) as image:
+                assert image.size == (32, 24) and image.getpixel((16, 12)) == color
+    print("Done. Quadrants saved in", folder_path)
+
+def test_crop_for_left_top():
+    print("--Testing in-place cropping of Midjourney grids...", end="")
+    import io
+    from PIL import Image
+    from utils import crop_for_left_top
+    folder_path = os.path.join(SAVE_PATH, "crop-in-place-test")
+    os.makedirs(folder_path, exist_ok=True)
+    for i in range(2):
+        grid = Image.new("RGB", (64, 48), (0, 0, 255))
+        grid.paste((255, 0, 0), (0, 0, 32, 24))
+        grid.save(os.path.join(folder_path, f"{i:05d}.jpeg"))
+    with Image.open(os.path.join(folder_path, "00000.jpeg")) as grid: # cropped and saved with PIL's defaults
+        expected = io.BytesIO()
+        grid.crop((0, 0, 32, 24)).save(expected, format="JPEG")
+
+    results = crop_for_left_top(folder_path, folder_path, processes=1) # same folder: the grids are replaced
+    assert len(results) == 2 and all(paths is not None for paths in results.values())
+    for i in range(2):
+        with Image.open(os.path.join(folder_path, f"{i:05d}.jpeg")) as image:
+            assert image.size == (32, 24) and image.getpixel((16, 12))[0] > 200
+    with open(os.path.join(folder_path, "00000.jpeg"), "rb") as file:
+        assert file.read() == expected.getvalue(), "crops must keep PIL's default JPEG quality"
+    print("Done. Images cropped in", folder_path)
+
 def test_deepfloyd(device:str): # Running on CPU is not supported
 
     print("Initializing DeepFloyd_I_XL_v1...", end="")
@@ -47,6 +197,19 @@ def test_deepfloyd(device:str): # Running on CPU is not supported
     print("Done. Image saved at", save_path)
 
 
+def test_deepfloyd_pipelined(device:str, stage_2_device:str=None): # Running on CPU is not supported
+    print("Initializing DeepFloyd_I_XL_v1 in pipelined mode...", end="")
+    model = get_model_class('DeepFloyd_I_XL_v1')(device=device, stage_2_device=stage_2_device, pipelined=True)
+    print("Done.")
+
+    print("--Testing DeepFloyd pipelined batch...", end="")
+    text_prompts = ["A red apple on a table", "A green pear on a table", "A yellow banana on a wooden table in the kitchen"]
+    filenames = [f"df-pipelined-test-{i}.jpeg" for i in range(len(text_prompts))]
+    save_paths = model.generate_batch(text_prompts, filenames, folder_path=SAVE_PATH, batch_size=1)
+    assert all(save_path is not None for save_path in save_paths)
+    print("Done. Images saved at", save_paths)
+
+
 def test_sdxl_turbo(device:str): # Running on CPU is not supported
     print("Initializing SDXL_Turbo...", end="")
     model = get_model_class('SDXL_Turbo')(device=device)
@@ -56,6 +219,79 @@ def test_sdxl_turbo(device:str): # Running on CPU is not supported
     save_path = model.generate(text_prompt="A red apple on a table", folder_path=SAVE_PATH, filename="sdxl-turbo-image-test.jpeg")
     print("Done. Image saved at", save_path)
 
+def test_sdxl_turbo_batch(device:str): # Running on CPU is not supported
+    print("Initializing SDXL_Turbo...", end="")
+    model = get_model_class('SDXL_Turbo')(device=device)
+    print("Done.")
+
+    print("--Testing SDXL_Turbo batch...", end="")
+    text_prompts = ["A red apple on a table", "A green pear on a table", "A yellow banana on a wooden table in the kitchen"]
+    filenames = [f"sdxl-turbo-batch-test-{i}.jpeg" for i in range(len(text_prompts))]
+    save_paths = model.generate_batch(text_prompts, filenames, folder_path=SAVE_PATH, batch_size=2)
+    assert all(save_path is not None for save_path in save_paths)
+    print("Done. Images saved at", save_paths)
+
+def test_image_writer():
+    print("--Testing ImageWriter...", end="")
+    import numpy as np
+    from PIL import Image
+    from models.image_writer import ImageWriter
+    writer = ImageWriter(max_pending=2)
+    images = [np.zeros((3, 64, 48), dtype=np.uint8), np.full((64, 48, 3), 255, dtype=np.uint8), Image.new("RGBA", (48, 64))]
+    saved = []
+    futures = [writer.submit(image, os.path.join(SAVE_PATH, f"image-writer-test-{i}.jpeg"), callback=saved.append)
+               for i, image in enumerate(images)]
+    save_paths = [future.result() for future in futures]
+    writer.close()
+    assert sorted(saved) == sorted(save_paths)
+    for save_path in save_paths:
+        with Image.open(save_path) as image:
+            assert image.format == "JPEG" and image.size == (48, 64)
+    print("Done. Images saved at", save_paths)
+
+def test_instrumentation(): # Runs offline against a local fake endpoint
+    print("--Testing instrumentation spans...", end="")
+    import json
+    from models.instrumentation import Tracer
+    with FakeOpenAIServer() as server:
+        model = get_model_class('DALLE')("fake-key", version=3, base_url=server.base_url)
+        with Tracer(jsonl_path=os.path.join(SAVE_PATH, "spans-test.jsonl")) as model.tracer:
+            jobs = [(f"{i:05d}", f"Prompt number {i}", f"instrumentation-test-{i}.jpeg") for i in range(3)]
+            list(model.generate_concurrent(jobs, folder_path=SAVE_PATH, max_workers=2))
+            with model.span("pipeline") as span:
+                for step in range(4): # as called by callback_on_step_end
+                    span.step(None, step, 999 - step, {"latents": None})
+
+    summary = model.tracer.summary()
+    assert summary[("DALLE", "api_call")]["count"] == 3 and summary[("DALLE", "download")]["count"] == 3
+    with open(os.path.join(SAVE_PATH, "spans-test.jsonl")) as f:
+        records = [json.loads(line) for line in f]
+    assert len(records[-1]["step_seconds"]) == 4 and records[-1]["peak_rss_bytes"] > 0
+    model.tracer.write_prometheus(os.path.join(SAVE_PATH, "metrics-test.prom"))
+    with open(os.path.join(SAVE_PATH, "metrics-test.prom")) as f:
+        assert 't2v_span_seconds_count{model="DALLE",span="api_call"} 3' in f.read()
+    print("Done. Spans saved at", os.path.join(SAVE_PATH, "spans-test.jsonl"))
+
+def test_output_cache(): # Runs offline against a local fake endpoint
+    print("--Testing the output cache...", end="")
+    from models.output_cache import OutputCache
+    cache = OutputCache(cache_dir=os.path.join(SAVE_PATH, "output-cache-test"))
+    with FakeOpenAIServer() as server:
+        model = get_model_class('DALLE')("fake-key", version=3, base_url=server.base_url)
+        keys = [cache.key(model.cache_identity(), "A red apple on a table", extension=".jpeg")]
+        save_path = model.generate("A red apple on a table", folder_path=SAVE_PATH, filename="output-cache-test-0.jpeg")
+        cache.store(keys, [save_path])
+
+        reused_path = os.path.join(SAVE_PATH, "output-cache-test-1.jpeg")
+        assert cache.fetch(keys, [reused_path]) and os.path.samefile(save_path, reused_path)
+        assert server.num_requests == 1
+        other_keys = [cache.key(model.cache_identity(), "A red apple on a table", seed=1, extension=".jpeg")]
+        assert not cache.fetch(other_keys, [os.path.join(SAVE_PATH, "output-cache-test-2.jpeg")])
+        hd_model = get_model_class('DALLE')("fake-key", version=3, base_url=server.base_url, quality="hd")
+        hd_keys = [cache.key(hd_model.cache_identity(), "A red apple on a table", extension=".jpeg")]
+        assert not cache.fetch(hd_keys, [os.path.join(SAVE_PATH, "output-cache-test-2.jpeg")]), "quality must be part of the key"
+    print("Done. Image reused at", reused_path)
+
 def test_sdxl_base(device:str): # Running on CPU is not supported
     print("Initializing SDXL...", end="")
     model = get_model_class('SDXL_Base')(device=device)
@@ -70,6 +306,16 @@ def test_sdxl_2_1(device:str): # Running on CPU is not supported
     save_path = model.generate(text_prompt="A red apple on a table", folder_path=SAVE_PATH, filename="sdxl-2-1-image-test.jpeg")
     print("Done. Image saved at", save_path)
 
+def test_presets(device:str): # Running on CPU is not supported
+    print("Initializing SDXL with the draft preset...", end="")
+    model = get_model_class('SDXL_Base')(device=device, preset="draft")
+    print("Done.")
+    assert type(model.model_pipe.scheduler).__name__ == model.PRESETS["draft"]["scheduler"]
+    assert model.model_pipe.unet.dtype == torch.float16, "the preset's dtype must be honored"
+    assert model.cache_identity() != {**model.cache_identity(), "preset": model.PRESETS["full"]}
+    save_path = model.generate(text_prompt="A red apple on a table", folder_path=SAVE_PATH, filename="sdxl-base-draft-image-test.jpeg")
+    print("Done. Image saved at", save_path)
+
 
 def test_all():
     OAI_KEY = os.getenv("OAI_KEY")
@@ -80,11 +326,25 @@ def test_all():
         os.makedirs(SAVE_PATH)
 
     test_dalle(openai_api_key=OAI_KEY)
+    test_dalle_concurrent()
+    test_dalle_b64()
     test_midjourney(host_url=MJ_SERVER_URL)
+    test_midjourney_batch()
+    test_midjourney_poll_timeout()
+    test_midjourney_notify_hook()
+    test_midjourney_ledger()
+    test_grid_split()
+    test_crop_for_left_top()
     test_deepfloyd(device=DEVICE)
+    test_deepfloyd_pipelined(device=DEVICE)
     test_sdxl_turbo(device=DEVICE)
+    test_sdxl_turbo_batch(device=DEVICE)
+    test_image_writer()
+    test_instrumentation()
+    test_output_cache()
     test_sdxl_base(device=DEVICE)
     test_sdxl_2_1(device=DEVICE)
+    test_presets(device=DEVICE)
 
 
 if __name__ == "__main__":
@@ -20,6 +20,35 @@ def test_modelscope(device:str): # Running on CPU is not supported
     save_path = model.generate(prompt="A red apple on a table", folder_path="./", filename="modelscope-video.mp4")
     print("Done. Video saved at", save_path)
 
+def test_video_writer():
+    print("--Testing VideoWriter...", end="")
+    import numpy as np
+    import imageio_ffmpeg
+    from models.video_writer import VideoWriter
+    frames = np.random.randint(0, 256, size=(12, 64, 96, 3), dtype=np.uint8)
+    writer = VideoWriter(fps=8, bitrate="1M")
+    saved = []
+    future = writer.submit(frames, os.path.join(SAVE_PATH, "video-writer-test.mp4"), callback=saved.append)
+    save_path = future.result()
+    writer.close()
+    assert saved == [save_path]
+    reader = imageio_ffmpeg.read_frames(save_path)
+    metadata = next(reader)
+    assert metadata["size"] == (96, 64) and sum(1 for _ in reader) == len(frames)
+
+    def failing_callback(save_paths):
+        raise OSError("journal append failed")
+    writer = VideoWriter(fps=8, bitrate="1M")
+    future = writer.submit_all([frames, frames], [os.path.join(SAVE_PATH, f"video-writer-test_{k}.mp4") for k in range(2)],
+                               callback=failing_callback)
+    try:
+        future.result(timeout=60)
+        assert False, "the callback's exception must be raised by the Future"
+    except OSError:
+        pass
+    writer.close()
+    print("Done. Video saved at", save_path)
+
 
 def test_all():
     if not os.path.exists(SAVE_PATH):
@@ -29,6 +58,7 @@ def test_all():
     
     test_zeroscope(device=DEVICE) # doesn't work on mps, cpu, 
     test_modelscope(device=DEVICE) # doesn't work on non cuda devices
+    test_video_writer()
 
 
 if __name__ == "__main__":
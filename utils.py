@@ -1,11 +1,8 @@
-import os
-from PIL import Image
-import torch
-
 def detect_device():
     """
     Detects the appropriate device to run on, and return the device and dtype.
     """
+    import torch # imported here so API-only drivers do not load torch
     if torch.cuda.is_available():
         return torch.device("cuda"), torch.float16
     elif torch.backends.mps.is_available():
@@ -14,22 +11,24 @@ def detect_device():
         return torch.device("cpu"), torch.float32
 
 
-def crop_for_left_top(input_folder, output_folder):
+def list_devices():
     """
-    crop the left top of the image for the Midjourney images
+    Returns the names of all accelerators available to run on, e.g., ['cuda:0', 'cuda:1'], or ['cpu'] if there is none.
     """
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-
-    for filename in os.listdir(input_folder):
-        if filename.endswith(".jpeg"):  
-            input_path = os.path.join(input_folder, filename)
-            output_path = os.path.join(output_folder, filename)
-
-            with Image.open(input_path) as img:
-                width, height = img.size
-
-                crop_img = img.crop((0, 0, width // 2, height // 2))
-                crop_img.save(output_path)
+    import torch
+    if torch.cuda.is_available():
+        return [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+    elif torch.backends.mps.is_available():
+        return ["mps"]
+    else:
+        return ["cpu"]
 
 
+def crop_for_left_top(input_folder, output_folder, processes=None):
+    """
+    crop the left top of the image for the Midjourney images, keeping their filenames. The grids are split in a
+    process pool, see models.t2image.grid.split_grid_folder to keep the other quadrants too.
+    """
+    from models.t2image.grid import split_grid_folder
+    return split_grid_folder(input_folder, output_folder, quadrants=[1], overwrite=True, name_format="{stem}{ext}",
+                             processes=processes, extensions=(".jpeg",), quality=75) # PIL's default, as before